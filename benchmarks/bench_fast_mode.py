@@ -0,0 +1,72 @@
+"""
+Benchmarks the default harness against the fast mode one on the example
+project. For each profile the harness is started, the example project's tests
+are executed a number of times and the harness is stopped. Run it from the
+repository root with postgres in the PATH and no harness running:
+
+$ python benchmarks/bench_fast_mode.py --runs 20 --tmpfs /dev/shm
+"""
+from optparse import OptionParser
+import time
+
+import pypgtap.core.test_kit.postgres_env as pe
+from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager
+
+EXAMPLE_PROJECT = 'example_project'
+
+
+def get_cli_options():
+    """
+    Returns the result of parser.parse_args() where parser is of type
+    OptionParser.
+    """
+    parser = OptionParser(usage="usage: %prog options")
+    parser.add_option(
+        "-n", "--runs", dest="runs", default=10, type="int",
+        help='how many times to execute the example project tests.')
+    parser.add_option(
+        "--tmpfs", dest="tmpfs_dir", default=None, metavar="DIR",
+        help='also benchmark the fast mode with the data dir in DIR.')
+    return parser.parse_args()
+
+
+def time_profile(runs, **harness_options):
+    """
+    Times one harness lifecycle with harness_options.
+
+    :return: The seconds spent starting the harness, executing the tests and
+        stopping the harness.
+    :rtype: tuple[float]
+    """
+    start = time.time()
+    pe.start_postgres_harness(**harness_options)
+    started = time.time()
+    try:
+        with PyPGTAPTestManager() as manager:
+            for _ in xrange(runs):
+                manager.execute_project_test(EXAMPLE_PROJECT)
+        executed = time.time()
+    finally:
+        pe.stop_postgres_harness()
+    return started - start, executed - started, time.time() - executed
+
+
+def main():
+    options, args = get_cli_options()
+    profiles = [('default', {}), ('fast', {'fast': True})]
+    if options.tmpfs_dir:
+        profiles.append(
+            ('fast+tmpfs', {'fast': True, 'tmpfs_dir': options.tmpfs_dir}))
+    results = [(name, time_profile(options.runs, **harness_options))
+               for name, harness_options in profiles]
+    print '{:<12}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'profile', 'start', 'tests', 'stop', 'total', 'speedup')
+    baseline = sum(results[0][1])
+    for name, timings in results:
+        print '{:<12}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>9.2f}x'.format(
+            name, timings[0], timings[1], timings[2], sum(timings),
+            baseline / sum(timings))
+
+
+if __name__ == '__main__':
+    main()
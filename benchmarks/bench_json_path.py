@@ -0,0 +1,107 @@
+"""
+Benchmarks the JSONPath parsing of copy_json: the parser of
+pypgtap.core.glue.utils.get_json_path_parser_fn, which decodes every line once
+and looks simple paths up directly, against decoding the line and running
+jsonpath_rw for every expression like it used to. The fixture has --columns
+simple paths and lines with nested objects and arrays:
+
+$ python benchmarks/bench_json_path.py --lines 20000 --columns 30
+"""
+import json
+from optparse import OptionParser
+import os
+import shutil
+import tempfile
+import time
+
+import jsonpath_rw
+
+from pypgtap.core.glue import utils
+
+
+def get_cli_options():
+    """
+    Returns the result of parser.parse_args() where parser is of type
+    OptionParser.
+    """
+    parser = OptionParser(usage="usage: %prog options")
+    parser.add_option(
+        "-n", "--lines", dest="lines", default=20000, type="int",
+        help='the number of JSON lines to parse.')
+    parser.add_option(
+        "-c", "--columns", dest="columns", default=30, type="int",
+        help='the number of JSONPath expressions, one per column.')
+    return parser.parse_args()
+
+
+def make_fixture(lines, columns):
+    """
+    :return: The JSONPath expressions and the JSON lines.
+    :rtype: tuple
+    """
+    json_paths = []
+    for i in xrange(columns):
+        if i % 3 == 0:
+            json_paths.append('$.col_{}'.format(i))
+        elif i % 3 == 1:
+            json_paths.append('$.nested.col_{}'.format(i))
+        else:
+            json_paths.append('$.items[{}].value'.format(i))
+    json_lines = []
+    for n in xrange(lines):
+        doc = {'nested': {}, 'items': []}
+        for i in xrange(columns):
+            if i % 3 == 0:
+                doc['col_{}'.format(i)] = 'value {} {}'.format(n, i)
+            elif i % 3 == 1:
+                doc['nested']['col_{}'.format(i)] = n * i
+            doc['items'].append({'value': [n, i]})
+        json_lines.append(json.dumps(doc))
+    return json_paths, json_lines
+
+
+def legacy_parser_fn(json_paths):
+    """
+    The parser as it was: the line is decoded again for every expression.
+    """
+    parsers = [jsonpath_rw.parse(expr) for expr in json_paths]
+
+    def apply_parsers(json_doc):
+        data_list = []
+        for parser in parsers:
+            found = parser.find(json.loads(json_doc, object_hook=utils._decode_dict))
+            data_list.append(json.dumps(found[0].value) if found else None)
+        return data_list
+    return apply_parsers
+
+
+def rows_per_second(parser_fn, json_lines):
+    start = time.time()
+    for line in json_lines:
+        parser_fn(line)
+    return len(json_lines) / (time.time() - start)
+
+
+def main():
+    options, args = get_cli_options()
+    json_paths, json_lines = make_fixture(options.lines, options.columns)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        json_path_file = os.path.join(tmp_dir, 'jsonpaths.json')
+        with open(json_path_file, 'w') as f:
+            json.dump({'jsonpaths': json_paths}, f)
+        parser_fn = utils.get_json_path_parser_fn(json_path_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+    legacy_fn = legacy_parser_fn(json_paths)
+    assert parser_fn(json_lines[0]) == legacy_fn(json_lines[0])
+    legacy = rows_per_second(legacy_fn, json_lines)
+    compiled = rows_per_second(parser_fn, json_lines)
+    print '{:<24}{:>14}'.format('parser', 'rows/s')
+    print '{:<24}{:>14.0f}'.format('decode per expression', legacy)
+    print '{:<24}{:>14.0f}'.format('decode once, compiled', compiled)
+    print 'speedup: {:.1f}x'.format(compiled / legacy)
+
+
+if __name__ == '__main__':
+    main()
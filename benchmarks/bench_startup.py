@@ -0,0 +1,116 @@
+"""
+Benchmarks the startup time of the console scripts: every entry point is run
+in a fresh interpreter with --help, or just imported for stop_harness which
+has no options, and the time over a bare interpreter start is reported.
+
+It doubles as a guard against regressions: it exits with 1 when an entry point
+imports one of the HEAVY_MODULES, which are only imported once they are used,
+or when it takes longer than --max-ms:
+
+$ python benchmarks/bench_startup.py --runs 20 --max-ms 100
+"""
+import json
+from optparse import OptionParser
+import os
+import subprocess
+import sys
+import time
+
+# Slow to import and not needed to parse the command line
+HEAVY_MODULES = ('pkg_resources', 'psycopg2', 'pyparsing', 'multiprocessing',
+                 'jsonpath_rw')
+
+ENTRY_POINTS = [
+    ('start_harness',
+     'from pypgtap.test_kit_scripts.start_harness import main; main()'),
+    ('stop_harness',
+     'from pypgtap.core.test_kit.postgres_env import stop_postgres_harness'),
+    ('run_all_tests',
+     'from pypgtap.test_kit_scripts.run_all_tests import main; main()'),
+    ('harness_daemon',
+     'from pypgtap.test_kit_scripts.harness_daemon import main; main()'),
+    ('load_json',
+     'from pypgtap.test_kit_scripts.load_json import main; main()'),
+]
+
+_RUNNER = '''
+import json
+import sys
+sys.argv = [{name!r}, '--help']
+try:
+    {code}
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps([m for m in {heavy!r} if m in sys.modules]))
+'''
+
+
+def get_cli_options():
+    """
+    Returns the result of parser.parse_args() where parser is of type
+    OptionParser.
+    """
+    parser = OptionParser(usage="usage: %prog options")
+    parser.add_option(
+        "-n", "--runs", dest="runs", default=10, type="int",
+        help='the number of times every entry point is started.')
+    parser.add_option(
+        "--max-ms", dest="max_ms", default=None, type="float",
+        help='fail when an entry point takes longer than this many ms.')
+    return parser.parse_args()
+
+
+def time_run(code):
+    """
+    :return: The wall time of running code in a new interpreter and what it
+        wrote to stderr.
+    :rtype: tuple
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    env.setdefault('USER', 'pypgtap')
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        p = subprocess.Popen(
+            [sys.executable, '-c', code], stdout=devnull,
+            stderr=subprocess.PIPE, env=env)
+        _, stderr = p.communicate()
+        elapsed = time.time() - start
+    if p.returncode != 0:
+        raise RuntimeError('{} failed:\n{}'.format(code, stderr))
+    return elapsed, stderr
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    options, args = get_cli_options()
+    baseline = median(
+        [time_run('pass')[0] for _ in xrange(options.runs)])
+    print 'interpreter start: {:.1f}ms'.format(baseline * 1000)
+    print '{:<16}{:>10}{:>10}  {}'.format('entry point', 'min', 'median',
+                                          'heavy imports')
+    failed = False
+    for name, code in ENTRY_POINTS:
+        runner = _RUNNER.format(name=name, code=code, heavy=HEAVY_MODULES)
+        times = []
+        for _ in xrange(options.runs):
+            elapsed, stderr = time_run(runner)
+            times.append(elapsed - baseline)
+        heavy = json.loads(stderr.splitlines()[-1])
+        print '{:<16}{:>8.1f}ms{:>8.1f}ms  {}'.format(
+            name, min(times) * 1000, median(times) * 1000,
+            ', '.join(heavy) or '-')
+        if heavy or (options.max_ms is not None
+                     and median(times) * 1000 > options.max_ms):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+"""
+A benchmark suite of the harness lifecycle, the bootstrap of the glue, the
+execution of test files, copy_json and TAP parsing. It generates a synthetic
+project with --files test files of --assertions assertions each and a JSON
+lines fixture of --fixture-lines lines and --fixture-columns columns, then
+times:
+
+* harness_start, harness_stop: start_postgres_harness and
+  stop_postgres_harness of an isolated harness, so a running harness is not
+  disturbed.
+* init_pgtap: PyPGTAPTestManager._init_pgtap, the bootstrap of the glue into a
+  new database.
+* project_execution, file_execution: execute_project_test of the synthetic
+  project and the time of each of its test files.
+* copy_json: the lines per second copy_json loads from the fixture. The time
+  of loading an empty fixture is subtracted.
+* tap_parse: the lines per second tap.tapOutputParser parses from the output
+  of the synthetic project.
+
+Every benchmark is run --runs times. The results are written as JSON to
+--output, and compared with those of an earlier run with --baseline:
+
+$ python benchmarks/bench_suite.py --files 50 --assertions 100 \\
+    --output before.json
+$ python benchmarks/bench_suite.py --files 50 --assertions 100 \\
+    --output after.json --baseline before.json
+
+Run it from the repository root with postgres in the PATH. --only tap_parse
+needs no postgres.
+"""
+import json
+from optparse import OptionParser
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pypgtap.core.test_kit.postgres_env as pe
+from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager
+from pypgtap.core.test_kit.utils import Harness
+from pypgtap.lib import tap
+
+BENCHMARKS = ('harness', 'init_pgtap', 'execution', 'copy_json', 'tap_parse')
+
+_TEST_TEMPLATE = '''BEGIN;
+SELECT plan({assertions});
+{lines}
+SELECT * FROM finish();
+ROLLBACK;
+'''
+
+_COPY_JSON_TEMPLATE = '''BEGIN;
+SELECT plan(1);
+CREATE TABLE bench_events ({columns});
+SELECT copy_json(
+    'public', 'bench_events', 'fixtures/{fixture}',
+    'fixtures/events_jsonpaths.json');
+SELECT is(count(*)::integer, {lines}, 'the fixture is loaded')
+FROM bench_events;
+SELECT * FROM finish();
+ROLLBACK;
+'''
+
+
+def get_cli_options():
+    """
+    Returns the result of parser.parse_args() where parser is of type
+    OptionParser.
+    """
+    parser = OptionParser(usage="usage: %prog options")
+    parser.add_option(
+        "--files", dest="files", default=20, type="int",
+        help='the number of test files of the synthetic project.')
+    parser.add_option(
+        "--assertions", dest="assertions", default=50, type="int",
+        help='the number of assertions of every test file.')
+    parser.add_option(
+        "--fixture-lines", dest="fixture_lines", default=10000, type="int",
+        help='the number of lines of the copy_json fixture.')
+    parser.add_option(
+        "--fixture-columns", dest="fixture_columns", default=10, type="int",
+        help='the number of columns of the copy_json fixture.')
+    parser.add_option(
+        "-n", "--runs", dest="runs", default=3, type="int",
+        help='how many times every benchmark is run.')
+    parser.add_option(
+        "--only", dest="only", default=','.join(BENCHMARKS),
+        help='comma separated benchmarks to run, of {}.'.format(
+            ', '.join(BENCHMARKS)))
+    parser.add_option(
+        "-f", "--fast", dest="fast", default=False, action="store_true",
+        help='run the harness in fast mode, see start_harness --fast.')
+    parser.add_option(
+        "-c", "--cache", dest="use_cache", default=False, action="store_true",
+        help='start the harness from the cluster cache.')
+    parser.add_option(
+        "--in-process", dest="in_process", default=False,
+        action="store_true", help='execute the tests in process.')
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", default=1, type="int",
+        help='the number of test files executed concurrently.')
+    parser.add_option(
+        "-o", "--output", dest="output", default='bench_results.json',
+        help='the file the results are written to.')
+    parser.add_option(
+        "--baseline", dest="baseline", default=None, metavar="FILE",
+        help='the results of an earlier run to compare with.')
+    options, args = parser.parse_args()
+    only = [b for b in options.only.split(',') if b]
+    unknown = set(only) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(unknown)))
+    options.only = only
+    return options, args
+
+
+def make_project(project_dir, files, assertions, fixture_lines,
+                 fixture_columns):
+    """
+    Generates the synthetic project: tests/test_NNNN.sql with the assertions
+    and, in a project of its own next to it, the copy_json tests and their
+    fixtures.
+
+    :return: The directory of the copy_json project.
+    """
+    test_dir = os.path.join(project_dir, 'tests')
+    os.makedirs(test_dir)
+    for n in xrange(files):
+        lines = []
+        for i in xrange(assertions):
+            if i % 3 == 0:
+                lines.append("SELECT ok(true, 'assertion {} of {}');".format(
+                    i, n))
+            elif i % 3 == 1:
+                lines.append("SELECT is({0} + 1, {1}, 'sum {0}');".format(
+                    i, i + 1))
+            else:
+                lines.append(
+                    "SELECT matches('value_{0}'::text, 'value_\\d+', "
+                    "'match {0}');".format(i))
+        with open(os.path.join(
+                test_dir, 'test_{:04d}.sql'.format(n)), 'w') as f:
+            f.write(_TEST_TEMPLATE.format(
+                assertions=assertions, lines='\n'.join(lines)))
+
+    copy_dir = project_dir + '_copy_json'
+    fixture_dir = os.path.join(copy_dir, 'fixtures')
+    os.makedirs(os.path.join(copy_dir, 'tests'))
+    os.makedirs(fixture_dir)
+    json_paths = []
+    for i in xrange(fixture_columns):
+        json_paths.append(
+            '$.col_{}'.format(i) if i % 2 == 0 else
+            '$.nested.col_{}'.format(i))
+    with open(os.path.join(fixture_dir, 'events_jsonpaths.json'), 'w') as f:
+        json.dump({'jsonpaths': json_paths}, f)
+    with open(os.path.join(fixture_dir, 'events.json'), 'w') as f:
+        for n in xrange(fixture_lines):
+            doc = {'nested': {}}
+            for i in xrange(fixture_columns):
+                value = 'value {} {}'.format(n, i)
+                if i % 2 == 0:
+                    doc['col_{}'.format(i)] = value
+                else:
+                    doc['nested']['col_{}'.format(i)] = value
+            f.write(json.dumps(doc) + '\n')
+    open(os.path.join(fixture_dir, 'empty.json'), 'w').close()
+    columns = ', '.join(
+        'col_{} text'.format(i) for i in xrange(fixture_columns))
+    for name, fixture, lines in [('empty', 'empty.json', 0),
+                                 ('events', 'events.json', fixture_lines)]:
+        with open(os.path.join(
+                copy_dir, 'tests', 'test_copy_{}.sql'.format(name)), 'w') as f:
+            f.write(_COPY_JSON_TEMPLATE.format(
+                columns=columns, fixture=fixture, lines=lines))
+    return copy_dir
+
+
+def make_tap_output(files, assertions):
+    """
+    :return: TAP output like that of the synthetic project, all its files in
+        one.
+    :rtype: str
+    """
+    total = files * assertions
+    lines = ['1..{}'.format(total)]
+    for num in xrange(1, total + 1):
+        if num % 50 == 7:
+            lines.append('not ok {} - assertion {}'.format(num, num))
+            lines.append('# Failed test {}: "assertion {}"'.format(num, num))
+        elif num % 50 == 13:
+            lines.append('not ok {} - assertion {} # TODO later'.format(
+                num, num))
+        else:
+            lines.append('ok {} - assertion {}'.format(num, num))
+    return '\n'.join(lines) + '\n'
+
+
+def stats(samples, unit='s'):
+    """
+    :return: The samples and their summary.
+    :rtype: dict
+    """
+    ordered = sorted(samples)
+    return {
+        'unit': unit, 'samples': samples, 'min': ordered[0],
+        'median': ordered[len(ordered) // 2], 'max': ordered[-1],
+        'mean': sum(ordered) / float(len(ordered))}
+
+
+def bench_harness(options):
+    start_times = []
+    stop_times = []
+    for _ in xrange(options.runs):
+        harness = Harness.allocate()
+        start = time.time()
+        try:
+            pe.start_postgres_harness(
+                use_cache=options.use_cache, fast=options.fast,
+                harness=harness)
+            start_times.append(time.time() - start)
+        finally:
+            stop = time.time()
+            pe.stop_postgres_harness(harness=harness, fast=options.fast)
+            stop_times.append(time.time() - stop)
+    return {'harness_start': stats(start_times),
+            'harness_stop': stats(stop_times)}
+
+
+def bench_init_pgtap(options, harness):
+    samples = []
+    for n in xrange(options.runs):
+        dbname = 'bench_init_pgtap_{}'.format(n)
+        manager = PyPGTAPTestManager(template_db=dbname, harness=harness)
+        start = time.time()
+        try:
+            manager._init_pgtap()
+            samples.append(time.time() - start)
+        finally:
+            manager.__exit__(None, None, None)
+            pe.drop_db(dbname, harness=harness)
+    return {'init_pgtap': stats(samples)}
+
+
+def bench_execution(options, harness, project_dir):
+    project_samples = []
+    file_samples = []
+    with PyPGTAPTestManager(
+            in_process=options.in_process, harness=harness) as manager:
+        for _ in xrange(options.runs):
+            manager.test_durations.clear()
+            start = time.time()
+            manager.execute_project_test(
+                project_dir, jobs=options.jobs, keep_output=False)
+            project_samples.append(time.time() - start)
+            file_samples.extend(manager.test_durations.values())
+    return {'project_execution': stats(project_samples),
+            'file_execution': stats(file_samples)}
+
+
+def bench_copy_json(options, harness, copy_dir):
+    samples = []
+    with PyPGTAPTestManager(
+            in_process=options.in_process, harness=harness) as manager:
+        tests = manager.get_project_test_scripts(copy_dir)
+        empty, events = sorted(tests)
+        for _ in xrange(options.runs):
+            manager.test_durations.clear()
+            manager.execute_project_test(copy_dir, keep_output=False)
+            elapsed = (manager.test_durations[events]
+                       - manager.test_durations[empty])
+            samples.append(options.fixture_lines / max(elapsed, 1e-6))
+    return {'copy_json': stats(samples, unit='lines/s')}
+
+
+def bench_tap_parse(options):
+    output = make_tap_output(options.files, options.assertions)
+    lines = output.count('\n')
+    samples = []
+    for _ in xrange(options.runs):
+        start = time.time()
+        tap.tapOutputParser.parseString(output)
+        samples.append(lines / max(time.time() - start, 1e-6))
+    return {'tap_parse': stats(samples, unit='lines/s')}
+
+
+def get_metadata(options):
+    try:
+        postgres = subprocess.check_output(['pg_ctl', '--version']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        postgres = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0], 'platform': platform.platform(),
+        'postgres': postgres, 'options': dict(
+            (name, getattr(options, name)) for name in (
+                'files', 'assertions', 'fixture_lines', 'fixture_columns',
+                'runs', 'only', 'fast', 'use_cache', 'in_process', 'jobs'))}
+
+
+def run_benchmarks(options, project_dir):
+    """
+    :return: The results of the options.only benchmarks by name.
+    :rtype: dict
+    """
+    results = {}
+    if 'tap_parse' in options.only:
+        results.update(bench_tap_parse(options))
+    if 'harness' in options.only:
+        results.update(bench_harness(options))
+    if not set(options.only) & set(['init_pgtap', 'execution', 'copy_json']):
+        return results
+    copy_dir = make_project(
+        project_dir, options.files, options.assertions,
+        options.fixture_lines, options.fixture_columns)
+    harness = Harness.allocate()
+    try:
+        pe.start_postgres_harness(
+            use_cache=options.use_cache, fast=options.fast, harness=harness)
+        if 'init_pgtap' in options.only:
+            results.update(bench_init_pgtap(options, harness))
+        if 'execution' in options.only:
+            results.update(bench_execution(options, harness, project_dir))
+        if 'copy_json' in options.only:
+            results.update(bench_copy_json(options, harness, copy_dir))
+    finally:
+        pe.stop_postgres_harness(harness=harness, fast=options.fast)
+    return results
+
+
+def print_results(results, baseline=None):
+    print '{:<20}{:>14}{:>14}{:>10}  {}'.format(
+        'benchmark', 'median', 'min', 'unit', 'vs baseline')
+    for name in sorted(results):
+        result = results[name]
+        comparison = ''
+        if baseline is not None and name in baseline:
+            ratio = result['median'] / baseline[name]['median']
+            # Lower is better for times, higher for throughputs
+            better = ratio < 1 if result['unit'] == 's' else ratio > 1
+            comparison = '{:.2f}x{}'.format(
+                ratio, '' if ratio == 1 else
+                ' (better)' if better else ' (worse)')
+        print '{:<20}{:>14.4f}{:>14.4f}{:>10}  {}'.format(
+            name, result['median'], result['min'], result['unit'], comparison)
+
+
+def main():
+    options, args = get_cli_options()
+    work_dir = tempfile.mkdtemp(prefix='pypgtap_bench_')
+    try:
+        results = run_benchmarks(
+            options, os.path.join(work_dir, 'bench_project'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    with open(options.output, 'w') as f:
+        json.dump({'metadata': get_metadata(options), 'results': results}, f,
+                  indent=2, sort_keys=True)
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+    print 'Results written to {}'.format(options.output)
+
+
+if __name__ == '__main__':
+    main()
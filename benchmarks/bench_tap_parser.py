@@ -0,0 +1,78 @@
+"""
+Benchmarks the line oriented pypgtap.lib.tap.tapOutputParser against the
+pyparsing grammar in pypgtap.lib.tap_grammar on generated TAP outputs with a
+mix of passing, failing, todo and skipped tests and diagnostics:
+
+$ python benchmarks/bench_tap_parser.py --sizes 10000,100000,1000000
+"""
+from optparse import OptionParser
+import time
+
+from pypgtap.lib import tap, tap_grammar
+
+
+def get_cli_options():
+    """
+    Returns the result of parser.parse_args() where parser is of type
+    OptionParser.
+    """
+    parser = OptionParser(usage="usage: %prog options")
+    parser.add_option(
+        "-s", "--sizes", dest="sizes", default='10000,100000,1000000',
+        help='comma separated numbers of TAP lines to parse.')
+    parser.add_option(
+        "--max-grammar-size", dest="max_grammar_size", default=None,
+        type="int", help=(
+            'skip the pyparsing grammar for the sizes above this, it can '
+            'take minutes on a million lines.'))
+    return parser.parse_args()
+
+
+def make_tap_output(size):
+    """
+    :return: TAP output with a plan and about size lines.
+    :rtype: str
+    """
+    lines = []
+    num = 0
+    while len(lines) < size - 1:
+        num += 1
+        kind = num % 50
+        if kind == 7:
+            lines.append('not ok {} - rows match in table_{}'.format(num, num))
+            lines.append('#   Failed test {}: "rows match"'.format(num))
+        elif kind == 13:
+            lines.append('not ok {} - loader # TODO not there yet'.format(num))
+        elif kind == 21:
+            lines.append('ok {} - network # SKIP no network'.format(num))
+        else:
+            lines.append('ok {} - column_{} is not null'.format(num, num))
+    lines.insert(0, '1..{}'.format(num))
+    return '\n'.join(lines) + '\n'
+
+
+def time_parser(parser, output):
+    start = time.time()
+    parser.parseString(output)
+    return time.time() - start
+
+
+def main():
+    options, args = get_cli_options()
+    print '{:>10}{:>12}{:>12}{:>10}'.format(
+        'lines', 'grammar', 'line', 'speedup')
+    for size in [int(s) for s in options.sizes.split(',')]:
+        output = make_tap_output(size)
+        line_time = time_parser(tap.tapOutputParser, output)
+        if (options.max_grammar_size is not None
+                and size > options.max_grammar_size):
+            print '{:>10}{:>12}{:>12.3f}{:>10}'.format(
+                size, '-', line_time, '-')
+            continue
+        grammar_time = time_parser(tap_grammar.tapOutputParser, output)
+        print '{:>10}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(
+            size, grammar_time, line_time, grammar_time / line_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -82,11 +82,15 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+-- The virtualenv is activated only once per session, the session's python
+-- interpreter remembers it in GD.
 CREATE OR REPLACE FUNCTION activate_virtual_env()
   RETURNS void AS
 $BODY$
         venv_dir_data = plpy.execute('SELECT get_virtual_env_dir() as venv_dir')
         venv = venv_dir_data[0]['venv_dir']
+        if GD.get('pypgtap_active_venv') == venv:
+            return
         import os, sys, subprocess, shlex
         if sys.platform in ('win32', 'win64', 'cygwin'):
             activate_this = os.path.join(venv, 'Scripts', 'activate_this.py')
@@ -104,6 +108,7 @@ $BODY$
                 os.environ['PATH'] = stdoutdata
             activate_this = os.path.join(venv, 'bin', 'activate_this.py')
             exec(open(activate_this).read(), dict(__file__=activate_this))
+        GD['pypgtap_active_venv'] = venv
 $BODY$
 LANGUAGE plpythonu;
 
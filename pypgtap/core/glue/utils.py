@@ -17,54 +17,287 @@ interpreter and so one may have to save it all in the SD, GD:
 Since these are internal functions(only called by plpython) we should be able to
 decorate them with utilities that can instantiate the loggers.
 """
+import bz2
+from contextlib import contextmanager
+import gzip
+import io
+import itertools
 import logging
+import mmap
 import os
 import json
-import jsonpath_rw
+import pipes
+import re
 
 _logger = logging.getLogger(__name__)
 
+# The number of JSON lines copy_json inserts with one statement by default.
+DEFAULT_BATCH_SIZE = 1000
+# The most parameters postgres allows in a statement
+_MAX_STATEMENT_PARAMETERS = 65535
+# The key of copy_json's data in the cache it's given
+_CACHE_KEY = 'pypgtap_copy_json'
 
-def copy_json(project_path, schema, table, json_file, json_path_file, database_accessor):
+
+def copy_json(project_path, schema, table, json_file, json_path_file, database_accessor,
+              batch_size=DEFAULT_BATCH_SIZE, cache=None):
     """
     See the copy_json() documentation in utils.sql.
 
+    The lines are inserted batch_size at a time with a multi row INSERT, so loading a big
+    file does not take a plpy.execute() per line.
+
     :param str project_path: The project path reachable from postgres harness's python runtime.
     :param str table: The table where you want to insert the data.
     :param str json_file: The json data file, typically, relative to the project directory and
-        should be some where reachable from postgres harness's python runtime.
+        should be some where reachable from postgres harness's python runtime. It can be
+        compressed, see open_fixture().
     :param str json_path_file: File containing the JSONPath expressions.  Path requirements are
         same as the json_file argument.
     :param plpy database_accessor: The plpy module to access the database:
         http://www.postgresql.org/docs/9.3/static/plpython-database.html
+    :param int batch_size: The number of lines to insert with one statement. It's lowered if
+        the statement would have more parameters than postgres allows.
+    :param dict cache: A dict that lives as long as the database session, like plpython's GD.
+        The columns and insert plans of the table and the parsed json_path_file are kept in it
+        for the next calls; They are looked up again when the table or the file change.
+    :raises ValueError: If the table does not exist or batch_size is not positive.
+    """
+    if batch_size < 1:
+        raise ValueError('batch_size must be a positive integer')
+    if cache is None:
+        cache = {}
+    cache = cache.setdefault(_CACHE_KEY, {})
+    columns, data_types, plans = _get_table_info(schema, table, database_accessor, cache)
+    _logger.debug('Column order: %s', columns)
+    _logger.debug('Data types: %s', data_types)
+    batch_size = max(1, min(batch_size, _MAX_STATEMENT_PARAMETERS // len(data_types)))
+
+    def insert(batch):
+        plan = plans.get(len(batch))
+        if plan is None:
+            plan = plans[len(batch)] = database_accessor.prepare(
+                _multi_row_insert_statement(schema, table, len(data_types), len(batch)),
+                data_types * len(batch))
+        database_accessor.execute(plan, list(itertools.chain.from_iterable(batch)))
+
+    # Get the function that will parse the json data.
+    fn_json_path_parser = _get_cached_json_path_parser_fn(
+        os.path.join(project_path, json_path_file), cache)
+    # Now open the json file
+    batch = []
+    with open_fixture(os.path.join(project_path, json_file)) as json_file:
+        for line in json_file:
+            # Parse the json file line by line, to get the values
+            batch.append(fn_json_path_parser(line))
+            if len(batch) == batch_size:
+                insert(batch)
+                batch = []
+    if batch:
+        insert(batch)
 
+
+@contextmanager
+def open_fixture(path):
+    """
+    Opens a fixture file for reading it line by line. Files ending with .gz or .bz2 are
+    decompressed while they are read, the others are memory mapped.
+
+    >>> with open_fixture('fixtures/events.json.gz') as lines:
+    ...     for line in lines:
+    ...         print line
+
+    :param str path: The path of the file.
+    :return: A context manager giving an iterator over the lines of the file.
     """
+    if path.endswith('.gz'):
+        # GzipFile's own readline is slow, buffering it makes up for that.
+        with io.BufferedReader(gzip.GzipFile(path, 'rb')) as f:
+            yield f
+    elif path.endswith('.bz2'):
+        with bz2.BZ2File(path) as f:
+            yield f
+    else:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files can't be mapped
+                yield f
+                return
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield iter(mapped.readline, '')
+            finally:
+                mapped.close()
+
+
+def _get_table_info(schema, table, database_accessor, cache):
+    """
+    Looks up the columns of schema.table, in their order, with their data types. They are
+    cached by the OID of the table along with the xmin of its pg_class row, which changes when
+    the table is altered.
+
+    :return: The column names, their data types and a dict for the insert plans of the table
+        by the number of rows they insert.
+    :rtype: tuple
+    :raises ValueError: If there is no such table.
+    """
+    version_plan = cache.get('table_version_plan')
+    if version_plan is None:
+        version_plan = cache['table_version_plan'] = database_accessor.prepare(
+            "SELECT c.oid, c.xmin FROM pg_class c JOIN pg_namespace n"
+            " ON n.oid = c.relnamespace WHERE n.nspname = $1 AND c.relname = $2",
+            ["text", "text"])
+    rows = database_accessor.execute(version_plan, [schema, table])
+    if not rows:
+        raise ValueError('Seems there is no table {}.{}'.format(schema, table))
+    oid, version = rows[0]['oid'], rows[0]['xmin']
+    tables = cache.setdefault('tables', {})
+    if oid in tables and tables[oid][0] == version:
+        return tables[oid][1:]
     plan = database_accessor.prepare(
         "SELECT column_name, data_type from information_schema.columns where"
-        " table_schema = $1 and table_name = $2", ["text", "text"])
+        " table_schema = $1 and table_name = $2 ORDER BY ordinal_position",
+        ["text", "text"])
     rows = database_accessor.execute(plan, [schema, table])
     if not rows:
         raise ValueError('Seems there is no table {}.{}'.format(schema, table))
     columns = [row['column_name'] for row in rows]
     data_types = [row['data_type'] for row in rows]
-    _logger.debug('Column order: %s' % columns)
-    _logger.debug('Data types: %s' % data_types)
-    # The data types of the columns
-    data_type_format_str = ', '.join('$%d' % (i + 1) for i in xrange(len(data_types)))
-    # Prepare a plan for executing efficiently
-    plan = database_accessor.prepare(
-        "INSERT into {}.{} values ({})".format(schema, table, data_type_format_str),
-        data_types)
-    # Get the function that will parse the json data.
-    fn_json_path_parser = get_json_path_parser_fn(
-        os.path.join(project_path, json_path_file))
-    # Now open the json file
-    with(open(os.path.join(project_path, json_file))) as json_file:
-        for line in json_file:
-            # Parse the json file line by line, to get the values
-            data_values = fn_json_path_parser(line)
-            # Insert all the values.
-            database_accessor.execute(plan, data_values)
+    tables[oid] = (version, columns, data_types, {})
+    return tables[oid][1:]
+
+
+def _get_cached_json_path_parser_fn(json_path_file, cache):
+    """
+    get_json_path_parser_fn(json_path_file), cached by the path and modification time of
+    json_path_file.
+    """
+    mtime = os.path.getmtime(json_path_file)
+    parsers = cache.setdefault('json_path_parsers', {})
+    cached = parsers.get(json_path_file)
+    if cached is None or cached[0] != mtime:
+        cached = parsers[json_path_file] = (mtime, get_json_path_parser_fn(json_path_file))
+    return cached[1]
+
+
+def _multi_row_insert_statement(schema, table, num_columns, num_rows):
+    """
+    :return: An INSERT of num_rows rows of num_columns parameters each into schema.table, like
+        INSERT into s.t values ($1, $2), ($3, $4)
+    :rtype: str
+    """
+    rows = []
+    for row in xrange(num_rows):
+        rows.append('({})'.format(', '.join(
+            '$%d' % (row * num_columns + i + 1) for i in xrange(num_columns))))
+    return "INSERT into {}.{} values {}".format(schema, table, ', '.join(rows))
+
+
+def copy_delimited(project_path, schema, table, data_file, database_accessor, delimiter=None,
+                   ignore_header=0, null_as=None, date_format=None, csv=False, escape=False):
+    """
+    See the copy_delimited() documentation in utils.sql. The options are the ones of Redshift's
+    COPY and mean the same, they are mapped onto a postgres COPY of data_file by the server.
+
+    :param str project_path: The project path reachable from postgres harness's python runtime.
+    :param str schema: The schema of the table.
+    :param str table: The table where you want to load the data.
+    :param str data_file: The data file relative to project_path. Files ending with .gz or
+        .bz2 are decompressed.
+    :param plpy database_accessor: The plpy module to access the database.
+    :param str delimiter: DELIMITER; Defaults to '|', or ',' with csv.
+    :param int ignore_header: IGNOREHEADER, the number of lines to skip.
+    :param str null_as: NULL AS; Defaults to '\\N', or an empty field with csv.
+    :param str date_format: DATEFORMAT, like 'MM/DD/YYYY'. None or 'auto' leaves it to
+        postgres.
+    :param bool csv: CSV, the fields can be quoted with double quotes.
+    :param bool escape: ESCAPE, a backslash escapes the next character. Without it backslashes
+        are plain characters, like in Redshift.
+    :raises ValueError: If an option has no postgres equivalent.
+    """
+    datestyle = _datestyle(date_format)
+    statement = _copy_delimited_statement(
+        schema, table, os.path.join(project_path, data_file), database_accessor.quote_ident,
+        database_accessor.quote_literal, delimiter, ignore_header, null_as, csv, escape)
+    _logger.debug('Copy statement: %s', statement)
+    if datestyle is None:
+        database_accessor.execute(statement)
+        return
+    old_datestyle = database_accessor.execute(
+        "SELECT current_setting('datestyle') AS datestyle")[0]['datestyle']
+    database_accessor.execute(
+        "SELECT set_config('datestyle', {}, false)".format(
+            database_accessor.quote_literal('ISO, ' + datestyle)))
+    try:
+        database_accessor.execute(statement)
+    finally:
+        database_accessor.execute(
+            "SELECT set_config('datestyle', {}, false)".format(
+                database_accessor.quote_literal(old_datestyle)))
+
+
+def _copy_delimited_statement(schema, table, path, quote_ident, quote_literal, delimiter=None,
+                              ignore_header=0, null_as=None, csv=False, escape=False):
+    """
+    :return: The postgres COPY of path into schema.table for the Redshift COPY options, see
+        copy_delimited().
+    :rtype: str
+    :raises ValueError: If ignore_header is negative or csv and escape are both set.
+    """
+    if ignore_header < 0:
+        raise ValueError('ignore_header must not be negative')
+    if csv and escape:
+        raise ValueError('ESCAPE can not be used with CSV')
+    if delimiter is None:
+        delimiter = ',' if csv else '|'
+    if escape:
+        options = ['FORMAT text']
+    elif csv:
+        options = ['FORMAT csv']
+    else:
+        # Only postgres' csv format has no escape character. A quote character that can't be
+        # in the data turns its quoting off too.
+        options = ["FORMAT csv", "QUOTE E'\\x01'"]
+        if null_as is None:
+            null_as = '\\N'
+    options.append('DELIMITER ' + quote_literal(delimiter))
+    if null_as is not None:
+        options.append('NULL ' + quote_literal(null_as))
+    # The header option of postgres skips a single line and only in csv format.
+    if ignore_header == 1 and not escape:
+        options.append('HEADER true')
+        ignore_header = 0
+    commands = []
+    if path.endswith('.gz'):
+        commands.append('gzip -dc ' + pipes.quote(path))
+    elif path.endswith('.bz2'):
+        commands.append('bzip2 -dc ' + pipes.quote(path))
+    if ignore_header:
+        commands.append('tail -n +{} {}'.format(
+            ignore_header + 1, '' if commands else pipes.quote(path)).rstrip())
+    if commands:
+        source = 'PROGRAM ' + quote_literal(' | '.join(commands))
+    else:
+        source = quote_literal(path)
+    return 'COPY {}.{} FROM {} WITH ({})'.format(
+        quote_ident(schema), quote_ident(table), source, ', '.join(options))
+
+
+def _datestyle(date_format):
+    """
+    :return: The order of the day, month and year of the Redshift DATEFORMAT date_format as a
+        postgres DateStyle, like MDY for 'MM/DD/YYYY', or None for 'auto'.
+    :rtype: str
+    :raises ValueError: If there is no DateStyle for date_format.
+    """
+    if date_format is None or date_format.lower() == 'auto':
+        return None
+    upper = date_format.upper()
+    positions = dict((part, upper.find(part)) for part in 'YMD')
+    order = ''.join(sorted((p for p in positions if positions[p] != -1), key=positions.get))
+    if order not in ('MDY', 'DMY', 'YMD'):
+        raise ValueError('DATEFORMAT {} has no postgres DateStyle'.format(date_format))
+    return order
 
 
 def get_json_path_parser_fn(json_path_file):
@@ -74,57 +307,135 @@ def get_json_path_parser_fn(json_path_file):
     json path expression in json_path_file. Factoring this function out can later facilitate the
     modularity of the callee, copy_json(...)
 
+    Simple expressions that are just a chain of names and indexes, like $.a.b[0] or $['a'], are
+    compiled to the keys and indexes to look up. Only the others go through jsonpath_rw.
+
     :param str json_path_file: The JSONPath file that follows the format specified here:
         http://goo.gl/5ZOLyQ
     :returns: A function that you can call with a JSON Document which will return you a list of
         data items matching the JSONPath expressions in json_path_file
     :raises ValueError: If there are no expressions in the json_path_file
     """
-    json_path_parsers = []
     with open(json_path_file) as f:
         json_path_obj = json.load(f)
         json_paths = json_path_obj['jsonpaths']
-        json_path_parsers = [jsonpath_rw.parse(expr) for expr in json_paths]
-    if not json_path_parsers:
+    finders = [_get_json_path_finder(expr) for expr in json_paths]
+    if not finders:
         raise ValueError('No json parsed paths found in %s' % json_path_file)
 
     def apply_parsers(json_doc):
         """
-        Given a JSON document apply the json_path_parsers to json_doc and return the values
-        associated with the JSONPath expressions in the json_path_parser list.
+        Given a JSON document apply the JSONPath expressions to json_doc and return the values
+        associated with them in the order of the expressions.
 
         :param str json_doc: a string representing the json line, read from a file. Note that
         :return: a list of values that are gotten by applying the json path expressions.
         :raises ValueError: If more that one value is found corresponding to the JSONPath
             expression
         """
+        # The document is decoded once for all the expressions
+        doc = json.loads(json_doc)
         data_list = []
-        data_keys = []
-        for json_path_parser in json_path_parsers:
-            # We don't want the u' prefix in the json objects because this messes up JSON
-            # parsing of embedded objects.
-            parsed_paths = json_path_parser.find(json.loads(json_doc, object_hook=_decode_dict))
-            if len(parsed_paths) > 1:
-                    raise ValueError(
-                        " JSONPath expression must specify the explicit path to a single name"
-                        " element in a JSON hierarchical data structure; Multiple paths"
-                        " were found: {}".format(parsed_paths))
-            if parsed_paths:
-                data_list.append(json.dumps(parsed_paths[0].value))
-                data_keys.append(parsed_paths[0].path.fields[0])
-            else:
+        for expr, finder in itertools.izip(json_paths, finders):
+            value = finder(doc)
+            if value is _NOT_FOUND:
                 # If no data is found for a parsed JSONPath expression we insert null into it as
                 # per http://goo.gl/0jdkjc. Adding None here does the trick.
-                msg = 'JSON path parser: {} returned no results on json doc {}'.format(
-                    json_path_parser, json_doc)
-                _logger.error(msg)
+                _logger.error(
+                    'JSON path parser: %s returned no results on json doc %s', expr, json_doc)
                 data_list.append(None)
-                data_keys.append(None)
-        _logger.debug("Data values: {}".format(data_list))
-        _logger.debug("Data keys: {}".format(data_keys))
+            else:
+                # We don't want the u' prefix in the json objects because this messes up JSON
+                # parsing of embedded objects.
+                data_list.append(json.dumps(_decode_value(value)))
+        _logger.debug("Data values: %s", data_list)
         return data_list
     return apply_parsers
 
+
+# What a JSONPath finder returns when the expression matches nothing, None is JSON's null.
+_NOT_FOUND = object()
+
+# One step of a simple JSONPath: .name, [index], ['name'] or ["name"]. The names are the
+# identifiers jsonpath_rw allows after a dot.
+_SIMPLE_JSON_PATH_STEP = re.compile(
+    r"""\.([A-Za-z_@][\w@-]*)|\[(\d+)\]|\['([^'\\]*)'\]|\["([^"\\]*)"\]""")
+
+
+def _compile_simple_json_path(expr):
+    """
+    :param str expr: A JSONPath expression.
+    :return: The names and indexes expr looks up in turn, if it's a simple chain of those
+        starting at the root like $.a.b[0], else None.
+    :rtype: tuple
+    """
+    expr = expr.strip()
+    if not expr.startswith('$'):
+        return None
+    steps = []
+    position = 1
+    while position < len(expr):
+        match = _SIMPLE_JSON_PATH_STEP.match(expr, position)
+        if match is None:
+            return None
+        name, index, single_quoted, double_quoted = match.groups()
+        if index is not None:
+            steps.append(int(index))
+        else:
+            steps.append(next(
+                step for step in (name, single_quoted, double_quoted) if step is not None))
+        position = match.end()
+    return tuple(steps)
+
+
+def _get_json_path_finder(expr):
+    """
+    :param str expr: A JSONPath expression.
+    :return: A function that returns the value expr matches in a decoded JSON document or
+        _NOT_FOUND.
+    :raises ValueError: If expr is not simple and it matches more than one value.
+    """
+    steps = _compile_simple_json_path(expr)
+    if steps is not None:
+        def find_simple(doc):
+            for step in steps:
+                if isinstance(step, int):
+                    if not isinstance(doc, list) or step >= len(doc):
+                        return _NOT_FOUND
+                elif not isinstance(doc, dict) or step not in doc:
+                    return _NOT_FOUND
+                doc = doc[step]
+            return doc
+        return find_simple
+
+    # Imported here, jsonpath_rw is slow to import and only needed for the
+    # paths that are not simple.
+    import jsonpath_rw
+    json_path_parser = jsonpath_rw.parse(expr)
+
+    def find(doc):
+        parsed_paths = json_path_parser.find(doc)
+        if len(parsed_paths) > 1:
+            raise ValueError(
+                " JSONPath expression must specify the explicit path to a single name"
+                " element in a JSON hierarchical data structure; Multiple paths"
+                " were found: {}".format(parsed_paths))
+        if not parsed_paths:
+            return _NOT_FOUND
+        return parsed_paths[0].value
+    return find
+
+
+def _decode_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return _decode_list(value)
+    elif isinstance(value, dict):
+        return _decode_dict(value)
+    return value
+
+
 def _decode_list(data):
     rv = []
     for item in data:
@@ -7,11 +7,16 @@ BEGIN
 END
 $$ LANGUAGE plpgsql strict;
 
+-- Older versions of copy_json had no batch_size, which would make the calls
+-- of the new one ambiguous.
+DROP FUNCTION IF EXISTS copy_json(varchar, varchar, varchar, varchar);
+
 CREATE OR REPLACE FUNCTION copy_json(
     schema varchar,
     table_name varchar,
     json_file varchar,
-    json_path_file varchar)
+    json_path_file varchar,
+    batch_size integer DEFAULT 1000)
 
 --    This function copies JSON lines from json_file by parsing each line using
 --    JSONPath specification in the json_path_file and inserting it into the
@@ -36,14 +41,71 @@ CREATE OR REPLACE FUNCTION copy_json(
 --    JSONPaths array elements must match the order of the columns in the target
 --    table. If an element referenced by a JSONPath expression is not found in
 --    the JSON data, this function will load a null value for it.
+--
+--    The json_file can be compressed with gzip or bzip2, if its name ends
+--    with .gz or .bz2 it's decompressed while it's read.
+--
+--    The lines are inserted batch_size at a time with multi row INSERTs. The
+--    table's columns and the parsed json_path_file are cached for the rest of
+--    the session, until the table or the file change.
 RETURNS SETOF void
 AS $$
-    plpy.execute('SELECT activate_virtual_env()')
-    import os
+    # The virtualenv only needs to be activated once per session, see
+    # activate_virtual_env()
+    if 'pypgtap_active_venv' not in GD:
+        plpy.execute('SELECT activate_virtual_env()')
     project_path_data = plpy.execute('SELECT get_project_path()')
-    from pypgtap.core.project.utils import copy_json
+    from pypgtap.core.glue.utils import copy_json
     copy_json(
         project_path_data[0]['get_project_path'], schema,
-        table_name, json_file, json_path_file, plpy)
+        table_name, json_file, json_path_file, plpy, batch_size, cache=GD)
     return ''
 $$ LANGUAGE plpythonu strict;
+
+CREATE OR REPLACE FUNCTION copy_delimited(
+    schema varchar,
+    table_name varchar,
+    data_file varchar,
+    delimiter varchar DEFAULT NULL,
+    ignore_header integer DEFAULT 0,
+    null_as varchar DEFAULT NULL,
+    date_format varchar DEFAULT NULL,
+    csv boolean DEFAULT false,
+    escape boolean DEFAULT false)
+
+--    This function loads the delimited or CSV data_file, relative to the
+--    project directory, into the table with the options of Redshift's COPY:
+--    http://docs.aws.amazon.com/redshift/latest/dg/copy-parameters-data-format.html
+--    so the fixtures of the Redshift loads can be used as they are. The file
+--    is read by the server with a native COPY.
+--
+--    delimiter: DELIMITER, defaults to '|' or to ',' if csv.
+--    ignore_header: IGNOREHEADER, the number of lines to skip.
+--    null_as: NULL AS, defaults to \N or to an empty field if csv.
+--    date_format: DATEFORMAT, like 'MM/DD/YYYY' or 'YYYY-MM-DD'; Only the
+--        order of the year, month and day is used. NULL or 'auto' leaves the
+--        dates to postgres.
+--    csv: CSV, the fields can be quoted with double quotes.
+--    escape: ESCAPE, a backslash escapes the next character.
+--
+--    The data_file can be compressed with gzip or bzip2 if its name ends with
+--    .gz or .bz2. Compressed files and ignore_header > 1 are read with COPY
+--    FROM PROGRAM, which needs postgres 9.3.
+--
+--    Example:
+--    SELECT copy_delimited('public', 'events', 'fixtures/events.csv.gz',
+--                          ignore_header := 1, csv := true);
+RETURNS SETOF void
+AS $$
+    # The virtualenv only needs to be activated once per session, see
+    # activate_virtual_env()
+    if 'pypgtap_active_venv' not in GD:
+        plpy.execute('SELECT activate_virtual_env()')
+    project_path_data = plpy.execute('SELECT get_project_path()')
+    from pypgtap.core.glue.utils import copy_delimited
+    copy_delimited(
+        project_path_data[0]['get_project_path'], schema, table_name,
+        data_file, plpy, delimiter, ignore_header or 0, null_as, date_format,
+        bool(csv), bool(escape))
+    return ''
+$$ LANGUAGE plpythonu;
@@ -0,0 +1,512 @@
+"""
+A long lived harness daemon. It keeps an isolated harness running with the
+pypgTAP glue bootstrapped in its template database, so test runs and test
+suites don't pay for initializing, starting and stopping a cluster every time.
+
+Clients lease a database of their own, a clone of the template, for as long as
+they need it:
+
+>>> with lease_db() as lease:
+...     with PyPGTAPTestManager(
+...             template_db=lease.dbname, harness=lease.harness) as manager:
+...         manager.execute_project_test(project_dir)
+
+lease_db() starts the daemon if it's not running. The daemon keeps a few spare
+clones ready so a lease does not wait for CREATE DATABASE. Released databases
+are dropped and replaced by fresh clones in the background. A lease expires
+after its ttl, unless it's renewed, or when the process that took it exits;
+The garbage collector then drops its database along with the clones the client
+made of it. After idle_timeout seconds without leases the daemon stops.
+
+The daemon listens on a unix socket in its root dir. Every request is a line of
+JSON with an "op" and the response is a line of JSON with "ok" and, when it's
+false, the "error". See the harness_daemon script for the command line.
+"""
+import fcntl
+import itertools
+import json
+import logging
+import os
+import Queue
+import shutil
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from pypgtap.core.test_kit import postgres_env
+from pypgtap.core.test_kit.pypgtap_error import PyPGTAPDaemonError
+from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager, \
+    PYPGTAP_TEMPLATE_DB
+from pypgtap.core.test_kit.utils import ExecuteQueryHelper, Harness, \
+    get_glue_hash
+
+_logger = logging.getLogger(__name__)
+
+DAEMON_ROOT_DIR = os.path.join(
+        tempfile.gettempdir(),
+        '__pypgtap_daemon')
+
+# The seconds a lease lasts unless it's renewed
+DEFAULT_LEASE_TTL = 3600
+# The number of clones of the template kept ready to be leased
+DEFAULT_SPARES = 2
+# The seconds between the garbage collections of expired leases
+GC_INTERVAL = 5
+# The seconds a client waits for a daemon it started to be ready
+DEFAULT_START_TIMEOUT = 120
+
+_SOCKET = 'daemon.sock'
+_LOCK = 'daemon.lock'
+_LOG = 'daemon.log'
+_HARNESS_DIR = 'harness'
+
+
+class HarnessDaemon(object):
+    """
+    The daemon itself; serve() runs it in the calling process until it's
+    stopped. Only one daemon can serve a root dir, a second one exits right
+    away.
+
+    *Thread Safe*
+    """
+
+    def __init__(self, root_dir=DAEMON_ROOT_DIR, spares=DEFAULT_SPARES,
+                 idle_timeout=None, fast=True, gc_interval=GC_INTERVAL):
+        """
+        :param str root_dir: Where the daemon keeps its socket, log and
+            harness.
+        :param int spares: The number of clones kept ready to be leased.
+        :param int idle_timeout: The seconds without leases after which the
+            daemon stops. None to run until it's stopped.
+        :param bool fast: Run the harness in fast mode, see
+            postgres_env.start_postgres_harness.
+        :param int gc_interval: The seconds between garbage collections.
+        """
+        self.root_dir = root_dir
+        self.spares = spares
+        self.idle_timeout = idle_timeout
+        self.fast = fast
+        self.gc_interval = gc_interval
+        self.harness = None
+        self._manager = None
+        # lease id -> _Lease
+        self._leases = {}
+        self._lease_ids = itertools.count(1)
+        self._spare_dbs = []
+        self._lock = threading.Lock()
+        # Serializes the uses of self._manager, which is not thread safe.
+        # PostgreSQL also refuses to copy the template while another session
+        # is connected to it, e.g. to make another copy.
+        self._manager_lock = threading.Lock()
+        # The databases to drop in the background
+        self._drops = Queue.Queue()
+        self._last_activity = time.time()
+        self._server = None
+        self._stopped = threading.Event()
+
+    def serve(self):
+        """
+        Starts the harness and serves the clients until the daemon is stopped.
+
+        :return: False if another daemon already serves the root dir.
+        :rtype: bool
+        """
+        if not os.path.exists(self.root_dir):
+            os.makedirs(self.root_dir)
+        lock_file = open(os.path.join(self.root_dir, _LOCK), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            _logger.info('A daemon already serves {}'.format(self.root_dir))
+            lock_file.close()
+            return False
+        try:
+            self._start_harness()
+            socket_path = os.path.join(self.root_dir, _SOCKET)
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._server = _DaemonServer(socket_path, _RequestHandler)
+            self._server.harness_daemon = self
+            threads = [threading.Thread(target=self._recycle),
+                       threading.Thread(target=self._collect_garbage)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            _logger.info('Serving {} on {}'.format(self.harness, socket_path))
+            try:
+                self._server.serve_forever(poll_interval=0.5)
+            finally:
+                self._stopped.set()
+                self._server.server_close()
+                os.remove(socket_path)
+                for thread in threads:
+                    thread.join()
+        finally:
+            if self.harness is not None:
+                postgres_env.stop_postgres_harness(harness=self.harness)
+            lock_file.close()
+        return True
+
+    def stop(self):
+        """
+        Makes serve() return. The harness is stopped and all the leased
+        databases are gone with it.
+        """
+        if self._server is not None:
+            # shutdown() waits for serve_forever to return, which it can't do
+            # while this thread handles one of its requests.
+            threading.Thread(target=self._server.shutdown).start()
+
+    def _start_harness(self):
+        harness_dir = os.path.join(self.root_dir, _HARNESS_DIR)
+        if os.path.exists(harness_dir):
+            # Left behind by a daemon that did not stop cleanly
+            try:
+                postgres_env.stop_postgres_harness(
+                    harness=Harness.load(harness_dir))
+            except IOError:
+                shutil.rmtree(harness_dir)
+        self.harness = Harness.allocate(root_dir=harness_dir)
+        postgres_env.start_postgres_harness(
+            use_cache=True, fast=self.fast, harness=self.harness)
+        self._manager = PyPGTAPTestManager(
+            template_db=PYPGTAP_TEMPLATE_DB, harness=self.harness)
+        self._manager.__enter__()
+
+    def _new_db(self):
+        """
+        A new clone of the template. It's marked as bootstrapped, so a manager
+        using it as its template_db does not bootstrap it again.
+        """
+        with self._manager_lock:
+            dbname = self._manager._clone_db(PYPGTAP_TEMPLATE_DB)
+            self._manager._set_db_glue_hash(
+                dbname, get_glue_hash(), harness=self.harness)
+        return dbname
+
+    def _drop_db(self, dbname):
+        """
+        Drops dbname and the databases cloned from it, their names start with
+        dbname + '_'.
+        """
+        pattern = dbname.replace('_', '\\_') + '\\_%'
+        for clone_db in _list_databases(pattern, harness=self.harness):
+            postgres_env.drop_db(clone_db, harness=self.harness)
+        postgres_env.drop_db(dbname, harness=self.harness)
+
+    def handle(self, request):
+        """
+        :param dict request: A request with an op of lease, renew, release,
+            status or stop.
+        :return: The response
+        :rtype: dict
+        """
+        self._last_activity = time.time()
+        op = request.get('op')
+        if op == 'lease':
+            return self.lease(
+                request.get('ttl') or DEFAULT_LEASE_TTL, request.get('pid'))
+        if op == 'renew':
+            return self.renew(request['lease_id'], request.get('ttl'))
+        if op == 'release':
+            return self.release(request['lease_id'])
+        if op == 'status':
+            return self.status()
+        if op == 'stop':
+            self.stop()
+            return {}
+        raise ValueError('Unknown op {}'.format(op))
+
+    def lease(self, ttl, pid=None):
+        """
+        Leases a database, a spare one if there is any.
+        """
+        with self._lock:
+            dbname = self._spare_dbs.pop(0) if self._spare_dbs else None
+        if dbname is None:
+            dbname = self._new_db()
+        # Wakes the recycler up to replace the spare
+        self._drops.put(None)
+        lease = _Lease(next(self._lease_ids), dbname, ttl, pid)
+        with self._lock:
+            self._leases[lease.lease_id] = lease
+        _logger.info('Leased {} to {}'.format(dbname, pid))
+        return {'lease_id': lease.lease_id, 'dbname': dbname,
+                'harness_root_dir': self.harness.root_dir,
+                'expires': lease.expires}
+
+    def renew(self, lease_id, ttl=None):
+        with self._lock:
+            lease = self._leases.get(lease_id)
+            if lease is None:
+                raise ValueError('Lease {} has expired'.format(lease_id))
+            lease.renew(ttl)
+        return {'expires': lease.expires}
+
+    def release(self, lease_id):
+        with self._lock:
+            lease = self._leases.pop(lease_id, None)
+        if lease is not None:
+            _logger.info('Released {}'.format(lease.dbname))
+            self._drops.put(lease.dbname)
+        return {}
+
+    def status(self):
+        with self._lock:
+            return {
+                'harness_root_dir': self.harness.root_dir,
+                'port': self.harness.port,
+                'leases': [lease.to_dict() for lease in
+                           self._leases.itervalues()],
+                'spares': list(self._spare_dbs)}
+
+    def _recycle(self):
+        """
+        Drops the released and expired databases and keeps the spares filled.
+        """
+        while not self._stopped.is_set():
+            try:
+                dbname = self._drops.get(timeout=0.5)
+            except Queue.Empty:
+                dbname = None
+            try:
+                if dbname is not None:
+                    self._drop_db(dbname)
+                while (len(self._spare_dbs) < self.spares
+                       and not self._stopped.is_set()):
+                    spare_db = self._new_db()
+                    with self._lock:
+                        self._spare_dbs.append(spare_db)
+            except Exception:
+                _logger.error('Recycling failed', exc_info=1)
+                self._stopped.wait(self.gc_interval)
+
+    def _collect_garbage(self):
+        """
+        Expires the leases that ran out of time or whose process exited, and
+        stops the daemon when it has been idle for idle_timeout.
+        """
+        while not self._stopped.wait(self.gc_interval):
+            now = time.time()
+            idle = self._expire_leases(now)
+            if (idle and self.idle_timeout is not None
+                    and now - self._last_activity > self.idle_timeout):
+                _logger.info('Stopping after {}s idle'.format(
+                    self.idle_timeout))
+                self.stop()
+                return
+
+    def _expire_leases(self, now):
+        """
+        Ends the leases that expired by now and queues their databases to be
+        dropped.
+
+        :return: True if no lease is left.
+        :rtype: bool
+        """
+        with self._lock:
+            expired = [lease for lease in self._leases.itervalues()
+                       if lease.expired(now)]
+            for lease in expired:
+                del self._leases[lease.lease_id]
+            idle = not self._leases
+        for lease in expired:
+            _logger.info('Lease of {} expired'.format(lease.dbname))
+            self._drops.put(lease.dbname)
+        return idle
+
+
+@ExecuteQueryHelper()
+def _list_databases(pattern, cursor):
+    """
+    :return: The names of the databases LIKE pattern.
+    :rtype: list[str]
+    """
+    cursor.execute(
+        "SELECT datname FROM pg_database WHERE datname LIKE %s;", (pattern,))
+    return [name for name, in cursor.fetchall()]
+
+
+class _Lease(object):
+    """
+    A leased database.
+    """
+
+    def __init__(self, lease_id, dbname, ttl, pid=None):
+        self.lease_id = lease_id
+        self.dbname = dbname
+        self.pid = pid
+        self.ttl = ttl
+        self.renew()
+
+    def renew(self, ttl=None):
+        self.ttl = ttl or self.ttl
+        self.expires = time.time() + self.ttl
+
+    def expired(self, now):
+        return now > self.expires or (
+            self.pid is not None and not postgres_env._is_process_alive(self.pid))
+
+    def to_dict(self):
+        return {'lease_id': self.lease_id, 'dbname': self.dbname,
+                'pid': self.pid, 'expires': self.expires}
+
+
+class _DaemonServer(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            response = self.server.harness_daemon.handle(
+                json.loads(self.rfile.readline()))
+            response['ok'] = True
+        except Exception as e:
+            _logger.error('Request failed', exc_info=1)
+            response = {'ok': False, 'error': str(e)}
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+###### Clients ########
+
+
+class HarnessLease(object):
+    """
+    A database leased from the daemon, see lease_db(). Release it when done,
+    or use it as a context manager.
+    """
+
+    def __init__(self, lease_id, dbname, harness, root_dir=DAEMON_ROOT_DIR):
+        self.lease_id = lease_id
+        self.dbname = dbname
+        self.harness = harness
+        self.root_dir = root_dir
+
+    def renew(self, ttl=None):
+        """
+        Extends the lease by ttl seconds from now, by default its ttl.
+        """
+        daemon_request(
+            {'op': 'renew', 'lease_id': self.lease_id, 'ttl': ttl},
+            self.root_dir)
+
+    def release(self):
+        daemon_request(
+            {'op': 'release', 'lease_id': self.lease_id}, self.root_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+def daemon_request(request, root_dir=DAEMON_ROOT_DIR):
+    """
+    Sends a request to the daemon serving root_dir.
+
+    :param dict request: The request, see HarnessDaemon.handle().
+    :return: The response.
+    :rtype: dict
+    :raises PyPGTAPDaemonError: If there is no daemon or the request failed.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(os.path.join(root_dir, _SOCKET))
+        except socket.error as e:
+            raise PyPGTAPDaemonError(
+                'No harness daemon serves {}: {}'.format(root_dir, e))
+        client.sendall(json.dumps(request) + '\n')
+        response = client.makefile().readline()
+    finally:
+        client.close()
+    if not response:
+        raise PyPGTAPDaemonError('The harness daemon closed the connection')
+    response = json.loads(response)
+    if not response.pop('ok'):
+        raise PyPGTAPDaemonError(response['error'])
+    return response
+
+
+def is_daemon_running(root_dir=DAEMON_ROOT_DIR):
+    try:
+        daemon_request({'op': 'status'}, root_dir)
+    except PyPGTAPDaemonError:
+        return False
+    return True
+
+
+def start_daemon(root_dir=DAEMON_ROOT_DIR, timeout=DEFAULT_START_TIMEOUT,
+                 spares=DEFAULT_SPARES, idle_timeout=None):
+    """
+    Starts a daemon serving root_dir in the background, unless one is
+    running, and waits until it's ready. Its output goes to daemon.log in
+    root_dir.
+
+    :param int timeout: The seconds to wait for the daemon.
+    :raises PyPGTAPDaemonError: If the daemon is not ready in time.
+    """
+    if is_daemon_running(root_dir):
+        return
+    if not os.path.exists(root_dir):
+        os.makedirs(root_dir)
+    cmd_lst = [sys.executable, '-m', 'pypgtap.test_kit_scripts.harness_daemon',
+               '--root-dir', root_dir, '--spares', str(spares)]
+    if idle_timeout is not None:
+        cmd_lst.extend(['--idle-timeout', str(idle_timeout)])
+    cmd_lst.append('run')
+    with open(os.path.join(root_dir, _LOG), 'a') as log:
+        # In its own session so it outlives the client and its terminal
+        p = subprocess.Popen(
+            cmd_lst, stdout=log, stderr=log, close_fds=True,
+            preexec_fn=os.setsid)
+    deadline = time.time() + timeout
+    while not is_daemon_running(root_dir):
+        if p.poll() is not None and p.returncode != 0:
+            raise PyPGTAPDaemonError(
+                'The harness daemon exited with {}, see {}'.format(
+                    p.returncode, os.path.join(root_dir, _LOG)))
+        if time.time() > deadline:
+            raise PyPGTAPDaemonError(
+                'The harness daemon was not ready in {}s, see {}'.format(
+                    timeout, os.path.join(root_dir, _LOG)))
+        time.sleep(0.2)
+
+
+def stop_daemon(root_dir=DAEMON_ROOT_DIR):
+    """
+    Stops the daemon serving root_dir, if any.
+    """
+    try:
+        daemon_request({'op': 'stop'}, root_dir)
+    except PyPGTAPDaemonError:
+        return
+    while is_daemon_running(root_dir):
+        time.sleep(0.2)
+
+
+def lease_db(ttl=DEFAULT_LEASE_TTL, root_dir=DAEMON_ROOT_DIR, start=True):
+    """
+    Leases a database from the daemon serving root_dir. The lease ends when
+    it's released, after ttl seconds, or when this process exits.
+
+    :param int ttl: The seconds the lease lasts unless it's renewed.
+    :param bool start: Start the daemon if it's not running.
+    :rtype: HarnessLease
+    :raises PyPGTAPDaemonError: If there is no daemon or it can't lease.
+    """
+    if start:
+        start_daemon(root_dir)
+    response = daemon_request(
+        {'op': 'lease', 'ttl': ttl, 'pid': os.getpid()}, root_dir)
+    return HarnessLease(
+        response['lease_id'], str(response['dbname']),
+        Harness.load(response['harness_root_dir']), root_dir)
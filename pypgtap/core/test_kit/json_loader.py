@@ -0,0 +1,320 @@
+"""
+A client side loader of JSON lines fixtures. It loads a fixture into a table
+the way the copy_json() glue function does, see utils.sql, but without
+plpython or the virtualenv in the server: The lines are parsed by a pool of
+processes and the rows are streamed into the table with COPY FROM STDIN.
+
+>>> load_json('public', 'events', 'fixtures/events.json',
+...           'fixtures/events_jsonpaths.json', dbname='my_test_db')
+
+load_json() loads in a connection and a transaction of its own, which it
+commits: The table must be committed before, and the rows stay once the test
+rolls back. Pass it the connection of the caller to load in the caller's
+transaction instead. From a psql test script the rows are best streamed into
+the test's own transaction with psql's \\copy, the load_json script writing
+them with --stdout, see write_json_rows():
+
+\\copy events (id, name) FROM PROGRAM 'load_json --stdout ev.json paths.json'
+
+The load_json script can also load on its own, connecting to the database of
+the test. It can't see what the test did in its transaction then, and it
+waits for the locks the test holds, forever since the test waits for it;
+See pypgtap.test_kit_scripts.load_json:
+
+\\! load_json public events fixtures/events.json fixtures/events_jsonpaths.json
+
+Neither \\copy nor \\! is supported by the in process executor.
+"""
+from cStringIO import StringIO
+import json
+import logging
+import os
+
+from pypgtap.core.glue.utils import get_json_path_parser_fn, open_fixture
+from pypgtap.core.test_kit.utils import LazyModule, current_harness
+
+psyc = LazyModule('psycopg2')
+
+_logger = logging.getLogger(__name__)
+
+# The bytes of the fixture each process parses at a time
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+# The parser of a pool process, see _init_worker
+_worker_parser = None
+
+_COMPRESSED_EXTENSIONS = ('.gz', '.bz2')
+
+
+def load_json(schema, table, json_file, json_path_file, dbname=None,
+              user_name=None, harness=None, project_path=None, processes=None,
+              chunk_size=DEFAULT_CHUNK_SIZE, connection=None):
+    """
+    Loads the JSON lines of json_file into schema.table. Like copy_json() the
+    values are found with the JSONPath expressions of json_path_file, in the
+    order of the table's columns, and the ones that are not found are loaded
+    as NULL. The whole file is loaded in one transaction, which is committed
+    unless a connection is given.
+
+    :param str schema: The schema of the table.
+    :param str table: The table where you want to insert the data.
+    :param str json_file: The json data file, relative to project_path. If
+        it ends with .gz or .bz2 it's decompressed while it's read.
+    :param str json_path_file: File containing the JSONPath expressions,
+        relative to project_path.
+    :param str dbname: The database of the table. Defaults to libpq's
+        default, the PGDATABASE environment variable or the user's database.
+    :param str user_name: Defaults to the USER environment variable.
+    :param utils.Harness harness: The harness to connect to. Defaults to the
+        one PGHOST/PGPORT point at, which a test script's \\! commands are
+        given, and else to the current_harness().
+    :param str project_path: The directory the files are relative to.
+        Defaults to the get_project_path() of the database, or else the
+        working directory.
+    :param int processes: The number of processes parsing the file. Defaults
+        to the number of cores.
+    :param int chunk_size: The bytes of the file a process parses at a time.
+    :param psycopg2.extensions.connection connection: A connection to load
+        with, in its current transaction. It's neither committed nor closed,
+        and dbname, user_name and harness are ignored.
+    :return: The number of rows loaded.
+    :rtype: int
+    :raises ValueError: If there is no such table or it has fewer columns
+        than there are JSONPath expressions.
+    """
+    conn = connection or _connect(dbname, user_name, harness)
+    try:
+        with conn.cursor() as cursor:
+            if project_path is None:
+                project_path = _get_project_path(cursor)
+            json_file = os.path.join(project_path, json_file)
+            json_path_file = os.path.join(project_path, json_path_file)
+            with open(json_path_file) as f:
+                num_paths = len(json.load(f)['jsonpaths'])
+            columns = _get_columns(cursor, schema, table)
+            if len(columns) < num_paths:
+                raise ValueError(
+                    'Table {}.{} has {} columns but there are {} JSONPath '
+                    'expressions'.format(schema, table, len(columns), num_paths))
+            copy_statement = 'COPY {}.{} ({}) FROM STDIN'.format(
+                _quote_ident(schema), _quote_ident(table),
+                ', '.join(_quote_ident(c) for c in columns[:num_paths]))
+            rows = 0
+            chunks = _parse_chunks(
+                json_file, json_path_file, processes, chunk_size)
+            try:
+                for chunk_rows, chunk in chunks:
+                    cursor.copy_expert(copy_statement, StringIO(chunk))
+                    rows += chunk_rows
+            finally:
+                # Stops the pool right away if the COPY failed
+                chunks.close()
+        if connection is None:
+            conn.commit()
+    finally:
+        if connection is None:
+            conn.close()
+    _logger.debug('Loaded {} rows into {}.{}'.format(rows, schema, table))
+    return rows
+
+
+def write_json_rows(json_file, json_path_file, out, dbname=None,
+                    user_name=None, harness=None, project_path=None,
+                    processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes the rows of the JSON lines of json_file to out in COPY's text
+    format, the values of a row in the order of the JSONPath expressions of
+    json_path_file. A COPY FROM STDIN, e.g. psql's \\copy, then loads them
+    into the columns named in that order, in the transaction of its own
+    connection.
+
+    :param file out: Where the rows are written.
+    :param str dbname: The database of the project path, only connected to
+        if project_path is None. See load_json() for it and the others.
+    :return: The number of rows written.
+    :rtype: int
+    """
+    if project_path is None:
+        conn = _connect(dbname, user_name, harness)
+        try:
+            with conn.cursor() as cursor:
+                project_path = _get_project_path(cursor)
+        finally:
+            conn.close()
+    rows = 0
+    chunks = _parse_chunks(
+        os.path.join(project_path, json_file),
+        os.path.join(project_path, json_path_file), processes, chunk_size)
+    try:
+        for chunk_rows, chunk in chunks:
+            out.write(chunk)
+            rows += chunk_rows
+    finally:
+        chunks.close()
+    return rows
+
+
+def _connect(dbname, user_name, harness):
+    """
+    Connects like load_json() says.
+    """
+    if harness is None and (os.environ.get('PGHOST') or
+                            os.environ.get('PGPORT')):
+        # Leave the host and port to libpq, they are those of the test
+        # script's harness, which need not be the current_harness().
+        connect_kwargs = {}
+    else:
+        connect_kwargs = (harness or current_harness()).connect_kwargs()
+    if dbname is not None:
+        connect_kwargs['dbname'] = dbname
+    user_name = os.environ.get('USER', user_name)
+    if user_name:
+        connect_kwargs['user'] = user_name
+    return psyc.connect(**connect_kwargs)
+
+
+def _get_project_path(cursor):
+    """
+    The get_project_path() of the database or the working directory if the
+    database has none. It's looked up in a savepoint so a database without
+    the glue doesn't abort the transaction of the connection.
+    """
+    cursor.execute('SAVEPOINT pypgtap_project_path')
+    try:
+        cursor.execute('SELECT get_project_path()')
+        project_path = cursor.fetchone()[0]
+        cursor.execute('RELEASE SAVEPOINT pypgtap_project_path')
+    except psyc.Error:
+        cursor.execute('ROLLBACK TO SAVEPOINT pypgtap_project_path')
+        project_path = None
+    return project_path or os.getcwd()
+
+
+def _get_columns(cursor, schema, table):
+    cursor.execute(
+        "SELECT column_name from information_schema.columns where"
+        " table_schema = %s and table_name = %s ORDER BY ordinal_position",
+        (schema, table))
+    columns = [row[0] for row in cursor.fetchall()]
+    if not columns:
+        raise ValueError('Seems there is no table {}.{}'.format(schema, table))
+    return columns
+
+
+def _quote_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _parse_chunks(json_file, json_path_file, processes, chunk_size):
+    """
+    Parses json_file, chunk_size bytes at a time, with a pool of processes.
+    The processes read their own byte range of a plain file. A compressed
+    file can only be read from the start, so it's read here and its lines
+    are sent to the processes instead.
+
+    :return: An iterator of (number of rows, rows in COPY's text format) for
+        the chunks, in the order of the file.
+    """
+    # Imported here, multiprocessing is slow to import and only needed once
+    # the fixture is parsed.
+    import multiprocessing
+    if json_file.endswith(_COMPRESSED_EXTENSIONS):
+        parse, chunks = _parse_lines, _line_chunks(json_file, chunk_size)
+    else:
+        size = os.path.getsize(json_file)
+        parse, chunks = _parse_range, [
+            (json_file, start, min(start + chunk_size, size))
+            for start in xrange(0, size, chunk_size)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1 or (isinstance(chunks, list) and len(chunks) < 2):
+        _init_worker(json_path_file)
+        for chunk in chunks:
+            yield parse(chunk)
+        return
+    if isinstance(chunks, list):
+        processes = min(processes, len(chunks))
+    pool = multiprocessing.Pool(processes, _init_worker, (json_path_file,))
+    try:
+        for chunk in pool.imap(parse, chunks):
+            yield chunk
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _line_chunks(json_file, chunk_size):
+    """
+    Reads json_file with open_fixture and yields lists of its lines of about
+    chunk_size bytes.
+    """
+    with open_fixture(json_file) as lines:
+        chunk, size = [], 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield chunk
+                chunk, size = [], 0
+        if chunk:
+            yield chunk
+
+
+def _init_worker(json_path_file):
+    global _worker_parser
+    _worker_parser = get_json_path_parser_fn(json_path_file)
+
+
+def _parse_range(file_range):
+    """
+    Parses the lines that start in [start, end) of json_file.
+
+    :param tuple file_range: The (json_file, start, end) to parse.
+    :return: The number of rows and the rows in COPY's text format.
+    :rtype: tuple
+    """
+    json_file, start, end = file_range
+    with open(json_file, 'rb') as f:
+        position = start
+        if start > 0:
+            # The line that starts before start belongs to the previous range
+            f.seek(start - 1)
+            position = start - 1 + len(f.readline())
+
+        def lines():
+            for line in iter(f.readline, ''):
+                yield line
+                if f.tell() >= end:
+                    break
+        if position >= end:
+            return 0, ''
+        return _parse_lines(lines())
+
+
+def _parse_lines(lines):
+    """
+    :param iterable lines: JSON lines.
+    :return: The number of rows and the rows in COPY's text format.
+    :rtype: tuple
+    """
+    out = StringIO()
+    rows = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        out.write('\t'.join(
+            _copy_text_value(v) for v in _worker_parser(line)))
+        out.write('\n')
+        rows += 1
+    return rows, out.getvalue()
+
+
+def _copy_text_value(value):
+    """
+    A value in COPY's text format.
+    """
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
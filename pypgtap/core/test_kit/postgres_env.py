@@ -11,24 +11,85 @@ Couple of important things:
 * The pg_ctl, createdb command should be present in the PATH or reachable.
 * The output of the command is not redirected so it will go to stdout/stderr.
 """
+import errno
+import hashlib
 import os
+import socket
+import struct
 import subprocess
 import sys
 import shutil
 import shlex
+import tempfile
+import threading
+import time
 
 from pypgtap.core.test_kit.utils import pre_create_harness_data_dir
-from pypgtap.core.test_kit.utils import PG_HARNESS_DATA_DIR
+from pypgtap.core.test_kit.utils import current_harness
+from pypgtap.core.test_kit.utils import get_glue_hash
+from pypgtap.core.test_kit.utils import PG_HARNESS_CACHE_DIR
+from pypgtap.core.test_kit.utils import CONNECTION_POOL
 from pypgtap.core.test_kit.pypgtap_error import PyPGTAPSubprocessError
 
+# Server settings of the fast mode. The harness is throw away so there is no
+# point in paying for durability.
+# See: http://www.postgresql.org/docs/9.3/static/non-durability.html
+FAST_MODE_SETTINGS = [
+    ('fsync', 'off'),
+    ('synchronous_commit', 'off'),
+    ('full_page_writes', 'off'),
+    ('wal_level', 'minimal'),
+    ('max_wal_senders', '0'),
+    ('checkpoint_timeout', '1h'),
+    ('shared_buffers', '128MB'),
+    ('work_mem', '16MB'),
+]
+
+# How long, in seconds, a starting server has to accept connections
+READY_TIMEOUT = 60
+# A starting server writes its postmaster.pid within this many seconds, unless
+# it failed to start
+_PID_FILE_TIMEOUT = 10
+# The bounds of the pause between two probes of a starting server
+_MIN_PROBE_DELAY = 0.005
+_MAX_PROBE_DELAY = 0.25
+# How long, in seconds, a stopping server has to exit
+STOP_TIMEOUT = 60
+# The prefix of the names that stop_postgres_harness(fast=True) renames the
+# harness dirs to before they are removed
+_TRASH_PREFIX = '.pypgtap_trash_'
+
 
 @pre_create_harness_data_dir
-def start_postgres_harness(user_name=None):
+def start_postgres_harness(
+        user_name=None, use_cache=False, fast=False, tmpfs_dir=None,
+        harness=None):
     """
-    Using a writable PG_HARNESS_DATA_DIR we initialize a postgres process.
+    Using the writable data dir of the harness we initialize a postgres
+    process. The harness defaults to the current_harness(), which is the one in
+    PG_HARNESS_DATA_DIR unless the PYPGTAP_HARNESS environment variable names
+    an isolated one; See utils.Harness.
+
+    With fast the cluster is initialized without syncing to disk(initdb -N)
+    and the server runs with the FAST_MODE_SETTINGS, which trade durability
+    for speed. With tmpfs_dir, typically /dev/shm, the data dir is kept on
+    that memory backed file system and the harness data dir links to it.
+
+    With use_cache the freshly initialized cluster, with its default database
+    and the pypgTAP glue bootstrapped into the PYPGTAP_TEMPLATE_DB template
+    database, is saved under PG_HARNESS_CACHE_DIR. Later harnesses copy it
+    instead of running initdb and bootstrapping again. The cache is keyed by
+    the postgres version, the glue scripts and the user, see _cluster_cache_key.
+
+    The directories that earlier fast stops, stop_postgres_harness(fast=True),
+    left behind next to the data dir are removed in the background.
 
     :param str user_name: Typically the USER set in the underlying
         environment firing the query.
+    :param bool use_cache: Start from, and populate, the cluster cache.
+    :param bool fast: Use the fast mode server settings.
+    :param str tmpfs_dir: A directory on a tmpfs to keep the data dir in.
+    :param utils.Harness harness: The harness to start.
     :raises pypgTAPSubprocessError: if there was an error in the underlying
         subprocess call to pg_ctl.
     :raises EnvironmentError: If USER environment variable is not present
@@ -37,22 +98,67 @@ def start_postgres_harness(user_name=None):
     if user_name is None:
         raise EnvironmentError('USER env variable not set!')
 
-    if len(os.listdir(PG_HARNESS_DATA_DIR)) > 0:
+    if len(os.listdir(harness.data_dir)) > 0:
         raise EnvironmentError(
             'The harness dir is not empty, did you forget to run stop_harness?')
 
-    if not os.path.exists(PG_HARNESS_DATA_DIR):
+    # Left behind by fast stops whose background removal did not finish.
+    _remove_in_background(_find_trash(
+        [os.path.dirname(harness.data_dir), tmpfs_dir] +
+        ([os.path.dirname(harness.root_dir)] if harness.root_dir else [])))
+
+    if not os.path.exists(harness.data_dir):
         raise ValueError('data dir {} for PG does not exist'.format(
-            PG_HARNESS_DATA_DIR))
-    cmd_lst = shlex.split("pg_ctl initdb -w -D {}".format(PG_HARNESS_DATA_DIR))
+            harness.data_dir))
+
+    if tmpfs_dir is not None:
+        _link_data_dir(harness, tmpfs_dir)
+
+    cached_cluster = None
+    if use_cache:
+        cached_cluster = os.path.join(
+            PG_HARNESS_CACHE_DIR, _cluster_cache_key(user_name, fast))
+        if os.path.exists(cached_cluster):
+            _copy_cluster(cached_cluster, harness.data_dir)
+            _start_server(harness)
+            return
+
+    cmd_lst = shlex.split("pg_ctl initdb -w -D {}{}".format(
+        harness.data_dir, " -o '-N'" if fast else ''))
     rc1 = subprocess.call(cmd_lst, stdout=sys.stdout, stderr=sys.stderr)
     if rc1 != 0:
         # clean the data dir so that we can start afresh.
         # since the harness has not started yet this is fine
-        shutil.rmtree(PG_HARNESS_DATA_DIR)
+        _remove_data_dir(harness)
         raise PyPGTAPSubprocessError(
             'There was an error initializing the postgres DB.',
             rc=rc1, cmd=str(cmd_lst))
+    if fast:
+        # In postgresql.conf the settings survive restarts and caching.
+        _append_server_settings(harness, FAST_MODE_SETTINGS)
+    _start_server(harness)
+
+    # Finally create the default database
+    try:
+        create_default_db(user_name, harness=harness)
+    except Exception as e:
+        print ('Caught exception while creating default db'
+                ' If the harness is still running you'
+                ' SHOULD shut it down using stop_harness')
+        raise e
+    if cached_cluster is not None:
+        _cache_cluster(harness, cached_cluster)
+
+
+def _start_server(harness):
+    """
+    Starts the postgres process on the initialized data dir of the harness.
+
+    :raises pypgTAPSubprocessError: if there was an error in the underlying
+        subprocess call to pg_ctl.
+    :raises EnvironmentError: if the server did not accept connections in
+        READY_TIMEOUT seconds. It's stopped then.
+    """
     # Note to self(sid):
     # A few of the options like -h and -k are present to guard config options
     # that postgres pick things from the postgres.conf file causing issues in
@@ -63,79 +169,376 @@ def start_postgres_harness(user_name=None):
     # brew.
     # Maybe some postgres admin can help me iron out all the additional options
     # that make the subprocess call robust?(Psst! Review request here)
+    # pg_ctl -w polls the server only once a second, so it's not asked to
+    # wait; wait_until_ready returns as soon as connections are accepted.
     cmd_lst = shlex.split(
-        "pg_ctl start -w -D {} -o '-h localhost -k /tmp'".format(
-            PG_HARNESS_DATA_DIR))
+        "pg_ctl start -W -D {} -o '{}'".format(
+            harness.data_dir, harness.server_options()))
 
     rc2 = subprocess.call(cmd_lst, stdout=sys.stdout, stderr=sys.stderr)
     if rc2 != 0:
         # clean the data dir so that we can start afresh.
         # since the harness failed to start this is fine
-        shutil.rmtree(PG_HARNESS_DATA_DIR)
+        _remove_data_dir(harness)
         raise PyPGTAPSubprocessError(
             'There was an error starting the postgres DB.',
             rc=rc2, cmd=str(cmd_lst))
-
-    # Finally create the default database
     try:
-        create_default_db(user_name)
-    except Exception as e:
-        print ('Caught exception while creating default db'
-                ' If the harness is still running you'
-                ' SHOULD shut it down using stop_harness')
-        raise e
+        wait_until_ready(harness=harness)
+    except EnvironmentError:
+        if is_harness_running(harness=harness):
+            _stop_server(harness, immediate=True)
+        _remove_data_dir(harness)
+        raise
+
+
+def _stop_server(harness, immediate=False):
+    """
+    Stops the postgres process running on the data dir of the harness.
+
+    :param bool immediate: Abort the server instead of waiting for the
+        sessions to end and writing a checkpoint. Only for throw away data;
+        The server would have to recover its data dir on the next start.
+    :raises PyPGTAPSubprocessError: if there was an error in the underlying
+        subprocess call to pg_ctl.
+    :raises EnvironmentError: if an immediately stopped server did not exit
+        in STOP_TIMEOUT seconds.
+    """
+    CONNECTION_POOL.close(harness=harness)
+    if not immediate:
+        cmd_lst = shlex.split("pg_ctl stop -w -D {}".format(harness.data_dir))
+    else:
+        # Like with pg_ctl start -w, pg_ctl stop -w checks only once a second.
+        cmd_lst = shlex.split(
+            "pg_ctl stop -W -m immediate -D {}".format(harness.data_dir))
+    rc = subprocess.call(cmd_lst, stdout=sys.stdout, stderr=sys.stderr)
+    if rc != 0:
+        raise PyPGTAPSubprocessError(
+            'There was an issue stopping postgres.',
+            rc=rc, cmd=str(cmd_lst))
+    if immediate:
+        _wait_until_stopped(harness)
+
+
+def _wait_until_stopped(harness, timeout=STOP_TIMEOUT):
+    """
+    Waits for the server of the harness to exit, which it's done once its
+    postmaster.pid is gone.
+
+    :raises EnvironmentError: if it did not exit in time.
+    """
+    deadline = time.time() + timeout
+    delay = _MIN_PROBE_DELAY
+    while is_harness_running(harness=harness):
+        now = time.time()
+        if now >= deadline:
+            raise EnvironmentError(
+                'The postgres server of {} did not stop within {}s'.format(
+                    harness.data_dir, timeout))
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, _MAX_PROBE_DELAY)
 
 
 @pre_create_harness_data_dir
-def stop_postgres_harness():
+def stop_postgres_harness(harness=None, fast=False):
     """
     Stop a postgres test harness. Also cleans up the data dir of the underlying
     harness. If this process is invoked and the harness is not running it cleans
-    up the data dir only.
+    up the data dir only. The root dir of an isolated harness is removed too.
+
+    With fast the harness is stopped for good as quickly as possible: The
+    server is aborted(pg_ctl stop -m immediate) and the harness dirs are only
+    moved aside, then removed in the background. Whatever is left of them
+    when this process exits is removed by the next start_postgres_harness.
 
+    :param utils.Harness harness: The harness to stop. Defaults to the
+        current_harness().
+    :param bool fast: Abort the server and remove the dirs in the background.
     :raises PyPGTAPSubprocessError: if there was an error in the underlying
         subprocess call to pg_ctl.
     """
     try:
-        if is_harness_running():
-            cmd_lst = shlex.split("pg_ctl stop -w -D {}".format(
-                PG_HARNESS_DATA_DIR))
-            rc = subprocess.call(cmd_lst, stdout=sys.stdout, stderr=sys.stderr)
-            if rc != 0:
-                raise PyPGTAPSubprocessError(
-                    'There was an issue stopping postgres.',
-                    rc=rc, cmd=str(cmd_lst))
+        if is_harness_running(harness=harness):
+            _stop_server(harness, immediate=fast)
     finally:
-        shutil.rmtree(PG_HARNESS_DATA_DIR)
+        if fast:
+            _discard_harness_dirs(harness)
+        else:
+            _remove_data_dir(harness)
+            if harness.root_dir is not None:
+                shutil.rmtree(harness.root_dir, ignore_errors=True)
 
 
 ###### Helper Utilities ########
 
 
-def is_harness_running():
+def _append_server_settings(harness, settings):
+    """
+    Appends settings to the postgresql.conf of the harness. Later settings
+    override the earlier ones in the file.
+
+    :param list[tuple] settings: (name, value) pairs.
+    """
+    with open(os.path.join(harness.data_dir, 'postgresql.conf'), 'a') as f:
+        f.write('\n# Added by pypgTAP\n')
+        for name, value in settings:
+            f.write("{} = '{}'\n".format(name, value))
+
+
+def _link_data_dir(harness, tmpfs_dir):
+    """
+    Replaces the empty data dir of the harness with a link to a new directory
+    in tmpfs_dir, so the cluster lives in memory while everything else keeps
+    using the harness data dir.
+    """
+    target_dir = tempfile.mkdtemp(
+        prefix=os.path.basename(harness.data_dir) + '_', dir=tmpfs_dir)
+    os.rmdir(harness.data_dir)
+    os.symlink(target_dir, harness.data_dir)
+
+
+def _remove_data_dir(harness):
+    """
+    Removes the data dir of the harness and, if it links to a tmpfs, the
+    directory it links to.
+    """
+    if os.path.islink(harness.data_dir):
+        target_dir = os.path.realpath(harness.data_dir)
+        os.remove(harness.data_dir)
+        shutil.rmtree(target_dir)
+    else:
+        shutil.rmtree(harness.data_dir)
+
+
+def _discard_harness_dirs(harness):
+    """
+    Moves the data dir of the harness, the directory it links to and the root
+    dir of an isolated harness aside, and removes them in the background.
+
+    :return: The thread removing them.
+    """
+    dirs = []
+    if os.path.islink(harness.data_dir):
+        dirs.append(os.path.realpath(harness.data_dir))
+        os.remove(harness.data_dir)
+    if harness.root_dir is not None:
+        dirs.append(harness.root_dir)
+    elif os.path.exists(harness.data_dir):
+        dirs.append(harness.data_dir)
+    return _remove_in_background([_move_to_trash(d) for d in dirs])
+
+
+def _move_to_trash(path):
+    """
+    Renames path to a unique trash name next to it. That's atomic, so once
+    this returns a new harness can use path again.
+
+    :return: The new path
+    """
+    trash_path = os.path.join(
+        os.path.dirname(os.path.abspath(path)), '{}{}_{}'.format(
+            _TRASH_PREFIX, os.path.basename(path), os.urandom(16).encode('hex')))
+    os.rename(path, trash_path)
+    return trash_path
+
+
+def _find_trash(dirs):
+    """
+    :return: The trashed directories in any of dirs.
+    """
+    trash_dirs = []
+    for parent_dir in set(d for d in dirs if d):
+        try:
+            names = os.listdir(parent_dir)
+        except OSError:
+            continue
+        trash_dirs.extend(
+            os.path.join(parent_dir, name) for name in names
+            if name.startswith(_TRASH_PREFIX))
+    return trash_dirs
+
+
+def _remove_in_background(dirs):
+    """
+    Removes dirs in a daemon thread, so this process does not wait for them.
+
+    :return: The thread
+    """
+    def remove():
+        for d in dirs:
+            shutil.rmtree(d, ignore_errors=True)
+    thread = threading.Thread(target=remove, name='pypgtap-trash')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def is_harness_running(harness=None):
     """
     Determines the status of an underlying harness and return True if its
-    running and False otherwise.
+    running and False otherwise. Like pg_ctl status it checks that the process
+    in the postmaster.pid of the data dir is alive, without running pg_ctl.
+    The server may still be starting up, see wait_until_ready.
 
-    :raises PyPGTAPSubprocessError: if there was an error in the underlying
-        subprocess call to pg_ctl.
+    :param utils.Harness harness: Defaults to the current_harness().
     """
-    if not os.path.exists(PG_HARNESS_DATA_DIR):
-        return False
-    cmd_lst = shlex.split("pg_ctl status -D {}".format(PG_HARNESS_DATA_DIR))
-    rc1 = subprocess.call(cmd_lst, stdout=sys.stdout, stderr=sys.stderr)
-    if rc1 == 0:
-        return True
-    elif rc1 == 3:
+    harness = harness or current_harness()
+    postmaster = _read_postmaster_pid(harness)
+    return postmaster is not None and _is_process_alive(postmaster['pid'])
+
+
+def wait_until_ready(harness=None, timeout=READY_TIMEOUT):
+    """
+    Waits for the server of the harness to accept connections. The server is
+    probed like pg_isready does, more and more rarely the longer it takes.
+
+    :param utils.Harness harness: Defaults to the current_harness().
+    :param float timeout: How many seconds to wait at most.
+    :raises EnvironmentError: if the server is not running, exited or did not
+        accept connections in time.
+    """
+    harness = harness or current_harness()
+    start = time.time()
+    deadline = start + timeout
+    delay = _MIN_PROBE_DELAY
+    seen_pid = None
+    while True:
+        postmaster = _read_postmaster_pid(harness)
+        if postmaster is not None:
+            seen_pid = postmaster['pid']
+            if not _is_process_alive(seen_pid):
+                raise EnvironmentError(
+                    'The postgres server of {} exited'.format(
+                        harness.data_dir))
+            if _ping_server(harness, postmaster):
+                return
+        elif seen_pid is not None:
+            raise EnvironmentError(
+                'The postgres server of {} exited'.format(harness.data_dir))
+        elif time.time() - start > min(timeout, _PID_FILE_TIMEOUT):
+            raise EnvironmentError(
+                'The postgres server of {} did not start'.format(
+                    harness.data_dir))
+        now = time.time()
+        if now >= deadline:
+            raise EnvironmentError(
+                'The postgres server of {} did not accept connections within '
+                '{}s'.format(harness.data_dir, timeout))
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, _MAX_PROBE_DELAY)
+
+
+def _read_postmaster_pid(harness):
+    """
+    Reads the postmaster.pid of the data dir of the harness.
+    See: http://www.postgresql.org/docs/9.3/static/server-start.html
+
+    :return: A dict with the pid of the server and, where the file has them,
+        the port, socket_dir and listen_address it listens on. None if there
+        is no server or it's still writing the file.
+    """
+    try:
+        with open(os.path.join(harness.data_dir, 'postmaster.pid')) as f:
+            lines = f.read().split('\n')
+        # A negative pid is a single user mode server.
+        postmaster = {'pid': abs(int(lines[0]))}
+    except (IOError, ValueError):
+        return None
+    names = [(3, 'port'), (4, 'socket_dir'), (5, 'listen_address')]
+    for i, name in names:
+        if len(lines) > i + 1 and lines[i].strip():
+            postmaster[name] = lines[i].strip()
+    if 'port' in postmaster:
+        try:
+            postmaster['port'] = int(postmaster['port'])
+        except ValueError:
+            del postmaster['port']
+    return postmaster
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _ping_server(harness, postmaster):
+    """
+    Whether the server accepts connections, which is the case once it answers
+    a startup packet with anything but "the database system is starting up".
+    The rest of the connection, authentication included, is not needed for
+    that.
+
+    :param dict postmaster: The _read_postmaster_pid() of the harness.
+    """
+    port = postmaster.get('port') or harness.port or 5432
+    socket_dir = postmaster.get('socket_dir')
+    try:
+        if socket_dir:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = os.path.join(socket_dir, '.s.PGSQL.{}'.format(port))
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            host = postmaster.get('listen_address', '*')
+            address = ('localhost' if host == '*' else host, port)
+        try:
+            sock.settimeout(_MAX_PROBE_DELAY * 4)
+            sock.connect(address)
+            params = 'user\0{}\0database\0postgres\0\0'.format(
+                os.environ.get('USER', 'postgres'))
+            # Protocol version 3.0
+            sock.sendall(struct.pack('!ii', 8 + len(params), 196608) + params)
+            response = _recv_message(sock)
+            if response is None:
+                return False
+            kind, body = response
+            if kind == 'R':
+                if body[:4] == struct.pack('!i', 0):
+                    # Authenticated, say good bye like a well behaved client.
+                    sock.sendall('X' + struct.pack('!i', 4))
+                return True
+            if kind == 'E':
+                fields = dict(
+                    (field[0], field[1:]) for field in body.split('\0')
+                    if field)
+                # cannot_connect_now
+                return fields.get('C') != '57P03'
+            return True
+        finally:
+            sock.close()
+    except (socket.error, socket.timeout):
         return False
-    else:
-        raise PyPGTAPSubprocessError(
-            'There was an issue in determining the postgres process status.'
-            ' See: http://www.postgresql.org/docs/9.3/static/app-pg-ctl.html',
-            rc=rc1, cmd=str(cmd_lst))
 
 
-def create_default_db(user_name):
+def _recv_message(sock):
+    """
+    Receives a message of the postgres protocol.
+
+    :return: (type, body) or None if the connection was closed.
+    """
+    header = _recv_exactly(sock, 5)
+    if header is None:
+        return None
+    kind, length = struct.unpack('!ci', header)
+    body = _recv_exactly(sock, length - 4)
+    if body is None:
+        return None
+    return kind, body
+
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def create_default_db(user_name, harness=None):
     """
     We need to create a default database because the tests rely on using the
     database created by the user who made it. When PG installs it has a role
@@ -153,6 +556,7 @@ def create_default_db(user_name):
 
     :param str user_name: The user name. Typically the USER argument set
         in the environment.
+    :param utils.Harness harness: Defaults to the current_harness().
 
     :raises PyPGTAPSubprocessError: if the underlying command to createdb
         fails
@@ -160,9 +564,180 @@ def create_default_db(user_name):
     if not (user_name and isinstance(user_name, basestring)):
         raise ValueError('User name arguments must be non-empty string')
     cmd_lst = shlex.split(
-        "createdb -U {} -h localhost {}".format(user_name, user_name))
+        "createdb -U {} {} {}".format(
+            user_name, _client_options(harness), user_name))
     rc = subprocess.call(cmd_lst, stdout=sys.stdout, stderr=sys.stderr)
     if rc != 0:
         raise PyPGTAPSubprocessError(
             'There was an issue creating the default DB.',
             rc=rc, cmd=str(cmd_lst))
+
+
+def get_default_db_name(user_name=None):
+    """
+    The name of the database created by create_default_db(), which is the
+    one psql and ExecuteQueryHelper connect to by default.
+
+    :param str user_name: Typically the USER set in the underlying
+        environment.
+    :raises EnvironmentError: If USER environment variable is not present
+    """
+    user_name = os.environ.get('USER', user_name)
+    if user_name is None:
+        raise EnvironmentError('USER env variable not set!')
+    return user_name
+
+
+def create_db(db_name, template_db=None, user_name=None, harness=None):
+    """
+    Create a database in the running harness, optionally as a copy of
+    template_db. Cloning a database that has the pypgTAP glue already
+    installed is much cheaper than executing the glue scripts again, since
+    postgres copies the template at the file level.
+    See: http://www.postgresql.org/docs/9.3/static/manage-ag-templatedbs.html
+
+    :param str db_name: The name of the database to create.
+    :param str template_db: The database to clone. *No other session may be
+        connected to it while the clone is being made.* The idle pooled
+        connections to it are closed first.
+    :param str user_name: The user to connect as. Defaults to the USER
+        environment variable.
+    :param utils.Harness harness: Defaults to the current_harness().
+    :raises PyPGTAPSubprocessError: if the underlying command to createdb
+        fails
+    """
+    user_name = os.environ.get('USER', user_name)
+    if not (db_name and isinstance(db_name, basestring)):
+        raise ValueError('Database name must be a non-empty string')
+    template_opt = '-T {} '.format(template_db) if template_db else ''
+    if template_db:
+        CONNECTION_POOL.close(
+            dbname=template_db, harness=harness or current_harness())
+    cmd_lst = shlex.split("createdb -U {} {} {}{}".format(
+        user_name, _client_options(harness), template_opt, db_name))
+    rc = subprocess.call(cmd_lst, stdout=sys.stdout, stderr=sys.stderr)
+    if rc != 0:
+        raise PyPGTAPSubprocessError(
+            'There was an issue creating the DB {}.'.format(db_name),
+            rc=rc, cmd=str(cmd_lst))
+
+
+def drop_db(db_name, user_name=None, harness=None):
+    """
+    Drop a database from the running harness if it exists. The idle pooled
+    connections to it are closed first.
+
+    :param str db_name: The name of the database to drop.
+    :param str user_name: The user to connect as. Defaults to the USER
+        environment variable.
+    :param utils.Harness harness: Defaults to the current_harness().
+    :raises PyPGTAPSubprocessError: if the underlying command to dropdb
+        fails
+    """
+    user_name = os.environ.get('USER', user_name)
+    CONNECTION_POOL.close(dbname=db_name, harness=harness or current_harness())
+    cmd_lst = shlex.split("dropdb -U {} {} --if-exists {}".format(
+        user_name, _client_options(harness), db_name))
+    rc = subprocess.call(cmd_lst, stdout=sys.stdout, stderr=sys.stderr)
+    if rc != 0:
+        raise PyPGTAPSubprocessError(
+            'There was an issue dropping the DB {}.'.format(db_name),
+            rc=rc, cmd=str(cmd_lst))
+
+
+def _client_options(harness):
+    """
+    The connection options of the createdb and dropdb commands for the
+    harness. The default harness is reached through localhost.
+    """
+    harness = harness or current_harness()
+    return ' '.join(harness.client_args()) or '-h localhost'
+
+
+###### Cluster Cache ########
+
+
+def _cluster_cache_key(user_name, fast=False):
+    """
+    The key of a cached cluster. A cluster can't be reused with a different
+    postgres version, it has stale glue if the glue scripts change and its
+    superuser and default database are named after the user that created it.
+    A fast mode cluster has different settings.
+
+    :raises PyPGTAPSubprocessError: if pg_ctl --version fails.
+    """
+    cmd_lst = ['pg_ctl', '--version']
+    p = subprocess.Popen(cmd_lst, stdout=subprocess.PIPE)
+    (stdoutdata, _) = p.communicate()
+    if p.returncode != 0:
+        raise PyPGTAPSubprocessError(
+            'There was an issue determining the postgres version.',
+            rc=p.returncode, cmd=str(cmd_lst))
+    sha = hashlib.sha1()
+    for part in (stdoutdata.strip(), get_glue_hash(), user_name,
+                 'fast' if fast else 'default'):
+        sha.update(part)
+        sha.update('\0')
+    return sha.hexdigest()
+
+
+def _cache_cluster(harness, cached_cluster):
+    """
+    Bootstraps the glue into the template database of the running harness and
+    saves a copy of the cluster as cached_cluster. The server is stopped
+    while the copy is made so the copy is consistent.
+    """
+    # Imported here because pypgtap_testing depends on this module.
+    from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager, \
+        PYPGTAP_TEMPLATE_DB
+    with PyPGTAPTestManager(template_db=PYPGTAP_TEMPLATE_DB, harness=harness):
+        pass
+    _stop_server(harness)
+    try:
+        if not os.path.exists(PG_HARNESS_CACHE_DIR):
+            os.makedirs(PG_HARNESS_CACHE_DIR)
+        # Copy aside and rename so that concurrent harnesses never see a
+        # partial cache entry.
+        staging_dir = tempfile.mkdtemp(dir=PG_HARNESS_CACHE_DIR)
+        try:
+            _copy_cluster(harness.data_dir, staging_dir)
+            os.rename(staging_dir, cached_cluster)
+        except OSError:
+            # Most likely another harness cached the cluster first.
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not os.path.exists(cached_cluster):
+                raise
+    finally:
+        _start_server(harness)
+
+
+def _copy_cluster(src_dir, dst_dir):
+    """
+    Copies the contents of the cluster directory src_dir into the existing,
+    empty, dst_dir. Where the file system supports it the files are cloned
+    (cp --reflink=auto) which is nearly free. Hard links are never used since
+    postgres updates its files in place which would corrupt the source.
+    """
+    cmd_lst = ['cp', '-a', '--reflink=auto', os.path.join(src_dir, '.'), dst_dir]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            rc = subprocess.call(cmd_lst, stderr=devnull)
+    except OSError:
+        rc = -1
+    if rc != 0:
+        # Not a GNU cp, for example on OS X. Start over with a plain copy.
+        for name in os.listdir(dst_dir):
+            dst = os.path.join(dst_dir, name)
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            else:
+                os.remove(dst)
+        for name in os.listdir(src_dir):
+            src = os.path.join(src_dir, name)
+            dst = os.path.join(dst_dir, name)
+            if os.path.isdir(src) and not os.path.islink(src):
+                shutil.copytree(src, dst, symlinks=True)
+            else:
+                shutil.copy2(src, dst)
+    # postgres refuses to start unless only the owner can access the data dir
+    os.chmod(dst_dir, 0700)
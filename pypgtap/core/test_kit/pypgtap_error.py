@@ -24,3 +24,32 @@ class PyPGTAPSubprocessError(Exception):
         return 'A framework subprocess command failed. {}\n{}'.format(
             self.msg, 'The Return Code was: {}. Command args '
                'to subprocess.call were {}'.format(self.rc, self.cmd))
+
+
+class PyPGTAPScriptError(PyPGTAPSubprocessError):
+    """
+    Raised by the in-process sql_executor.SQLScriptExecutor when a script
+    fails. It carries the same data as the PyPGTAPSubprocessError that a psql
+    subprocess would have raised for the script, so callers can handle both
+    executors the same way.
+    """
+
+    def __str__(self):
+        return 'A sql script failed. {}\n{}'.format(
+            self.msg, 'The psql equivalent return code was: {}. The script '
+               'was {}'.format(self.rc, self.cmd))
+
+
+class PyPGTAPAbort(Exception):
+    """
+    Raised by a line_callback of PyPGTAPTestManager.execute_project_test() to
+    stop executing tests. The script that produced the line is killed and the
+    test files that have not started yet are not executed.
+    """
+
+
+class PyPGTAPDaemonError(Exception):
+    """
+    Raised by the clients of the harness daemon when the daemon can't be
+    reached or refuses a request, see harness_daemon.
+    """
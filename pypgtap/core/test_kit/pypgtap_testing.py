@@ -4,20 +4,50 @@ bootstrapping the pypgTAP test harness and executing tests on it.
 The running state of the harness is not managed by this module.
 In addition it also contains utilities to execute sql scripts.
 """
+from contextlib import contextmanager
+import functools
+import hashlib
+import itertools
+import json
 import logging
 import os
-import pkg_resources
 import subprocess
 import shlex
 import sys
-
-from pypgtap.core.test_kit.pypgtap_error import PyPGTAPSubprocessError
-from pypgtap.core.test_kit.utils import ExecuteQueryHelper
+import tempfile
+import threading
+import time
+
+from pypgtap.core.test_kit import postgres_env
+from pypgtap.core.test_kit.pypgtap_error import PyPGTAPAbort, \
+    PyPGTAPSubprocessError
+from pypgtap.core.test_kit.result_cache import TestOutcomes, get_test_hash
+from pypgtap.core.test_kit.sql_executor import SQLScriptExecutor
+from pypgtap.core.test_kit.utils import CONNECTION_POOL, ExecuteQueryHelper, \
+    LazyModule, current_harness, get_glue_hash
 
 _logger = logging.getLogger(__name__)
 
+pkg_resources = LazyModule('pkg_resources')
+
+# The database the glue is bootstrapped into when the manager runs in template
+# mode. Every project gets a clone of it.
+PYPGTAP_TEMPLATE_DB = 'pypgtap_template'
+
+# The manifest of a project's setup scripts, next to its test(s)/ directory.
+# See read_setup_manifest().
+SETUP_MANIFEST = 'pypgtap_setup.json'
+
+# The prefix of the databases holding the snapshots of the project setups
+SETUP_SNAPSHOT_DB_PREFIX = 'pypgtap_setup_'
+
+# The database the advisory locks of the setup snapshots are taken in.
+# Advisory locks are per database and this one is never cloned.
+_SNAPSHOT_LOCK_DB = 'postgres'
 
-def _execute_sql_script(sql_script):
+
+def _execute_sql_script(sql_script, dbname=None, harness=None,
+                        line_callback=None, keep_output=True):
     """
     Execute any psql script that is postgres compatible. This is used internally
     only by this module(See NOTE below).
@@ -25,6 +55,16 @@ def _execute_sql_script(sql_script):
     :param str sql_script: A string that is an sql scripts that people want to
         execute in their tests. Typically these are your not just your DDL and
         DML files but also psql files.
+    :param str dbname: The database to execute the script in. If None psql
+        picks its default, which is the database named after the user.
+    :param utils.Harness harness: The harness to connect to. If None psql
+        connects with its defaults, which reach the default harness.
+    :param callable line_callback: If given the output is read line by line
+        while psql is running and each line is passed to it as soon as it
+        arrives. If it raises psql is killed and the exception propagates.
+    :param bool keep_output: If False the output is only passed to
+        line_callback and an empty string is returned, so it's never held in
+        memory as a whole.
     :return: A byte string from the successful execution of the process. If the underlying command
         fails with a non zero exit code a PyPGTAPSubprocessError is raised
     :rtype: str
@@ -42,16 +82,132 @@ def _execute_sql_script(sql_script):
     cmd_lst = shlex.split(
         "psql -P format=unaligned -P pager -t -v QUIET=1 "
         "-v ON_ERROR_STOP=true -v ON_ERROR_ROLLBACK=1 -q -Xf {}".format(sql_script))
-    p = subprocess.Popen(cmd_lst, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (stdoutdata, stderrdata) = p.communicate()
+    # The commands the script runs with \! connect where psql does, which is
+    # how the load_json script finds the database of a test.
+    env = dict(os.environ)
+    if dbname is not None:
+        cmd_lst.extend(['-d', dbname])
+        env['PGDATABASE'] = dbname
+    if harness is not None:
+        cmd_lst.extend(harness.client_args())
+        for name, value in harness.connect_kwargs().iteritems():
+            env['PG' + name.upper()] = str(value)
+    if line_callback is None and keep_output:
+        p = subprocess.Popen(
+            cmd_lst, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        (stdoutdata, stderrdata) = p.communicate()
+        returncode = p.returncode
+    else:
+        (stdoutdata, stderrdata, returncode) = _stream_process_output(
+            cmd_lst, line_callback or (lambda line: None), keep_output, env)
     _logger.debug("Command output {}".format(stdoutdata))
-    if p.returncode != 0:
+    if returncode != 0:
         raise PyPGTAPSubprocessError(
                 "Error executing a sql script. Process Output(may be empty): %s" % stderrdata,
-                rc=p.returncode, cmd=str(sql_script))
+                rc=returncode, cmd=str(sql_script))
     return stdoutdata
 
 
+def _stream_process_output(cmd_lst, line_callback, keep_output=True, env=None):
+    """
+    Runs cmd_lst and passes each line of its stdout to line_callback as it
+    arrives. stderr goes to a temporary file so a chatty stderr can't block
+    the process while we are reading stdout.
+
+    :return: The (stdoutdata, stderrdata) of the process, like communicate(),
+        except that stdoutdata is empty unless keep_output, and its return
+        code.
+    :rtype: tuple
+    """
+    lines = []
+    with tempfile.TemporaryFile() as stderr_file:
+        p = subprocess.Popen(
+            cmd_lst, stdout=subprocess.PIPE, stderr=stderr_file, env=env)
+        try:
+            for line in iter(p.stdout.readline, ''):
+                if keep_output:
+                    lines.append(line)
+                line_callback(line)
+        except BaseException:
+            p.kill()
+            raise
+        finally:
+            p.stdout.close()
+            p.wait()
+        stderr_file.seek(0)
+        return ''.join(lines), stderr_file.read(), p.returncode
+
+
+def read_setup_manifest(project_dir):
+    """
+    Reads the setup manifest of a project, the SETUP_MANIFEST file in
+    project_dir. It lists the scripts that set up the database of every test,
+    like DDL, DML and copy_json() calls, and the fixtures they load:
+
+    {
+        "setup_scripts": ["tests/setup/schema.sql", "tests/setup/events.sql"],
+        "fixtures": ["tests/fixtures"]
+    }
+
+    The paths are relative to project_dir. The scripts are executed in the
+    order they are listed; A fixture can be a file or a directory of them.
+
+    :param str project_dir: The project directory.
+    :return: The absolute paths of the setup scripts and of the fixture files,
+        or None if the project has no manifest.
+    :rtype: tuple
+    :raises IOError: If a listed file does not exist.
+    :raises ValueError: If the manifest has no setup scripts.
+    """
+    manifest_file = os.path.join(project_dir, SETUP_MANIFEST)
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if not manifest.get('setup_scripts'):
+        raise ValueError('{} lists no setup_scripts'.format(manifest_file))
+    project_dir = os.path.abspath(project_dir)
+    scripts = []
+    for script in manifest['setup_scripts']:
+        script = os.path.join(project_dir, script)
+        if not os.path.isfile(script):
+            raise IOError('Setup script {} not found'.format(script))
+        scripts.append(script)
+    fixtures = []
+    for fixture in manifest.get('fixtures', []):
+        fixture = os.path.join(project_dir, fixture)
+        if os.path.isdir(fixture):
+            for dir_name, _, files in os.walk(fixture):
+                fixtures.extend(os.path.join(dir_name, f) for f in files)
+        elif os.path.isfile(fixture):
+            fixtures.append(fixture)
+        else:
+            raise IOError('Fixture {} not found'.format(fixture))
+    return scripts, sorted(fixtures)
+
+
+def get_setup_hash(project_dir, scripts, fixtures):
+    """
+    A hash of everything a project setup depends on: the glue, the project dir
+    and the virtualenv that are set in the database and the contents of the
+    setup scripts and fixtures. A snapshot of a setup with a different hash
+    is stale.
+
+    :return: The hex digest
+    :rtype: str
+    """
+    sha = hashlib.sha1()
+    sha.update(get_glue_hash())
+    sha.update(os.path.abspath(project_dir))
+    sha.update(sys.prefix)
+    for path in scripts + fixtures:
+        sha.update(os.path.relpath(path, project_dir))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), ''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
 class PyPGTAPTestManager(object):
     """
     This class takes care of bootstrapping the pypgTAP harness with pgtap and
@@ -74,12 +230,61 @@ class PyPGTAPTestManager(object):
     to do so to execute tests in multiple project directories. You should
     however not create multiple objects of this class.
 
+    If you pass a template_db the glue is bootstrapped once into that database
+    instead of the default one, and each call to execute_project_test() runs in
+    a fresh clone of it(CREATE DATABASE ... TEMPLATE). The clone is dropped
+    when the project's tests are done. This keeps the bootstrap cost the same
+    no matter how many projects you test:
+
+    >>> with PyPGTAPTestManager(template_db=PYPGTAP_TEMPLATE_DB) as r:
+    ...    for project_dir in project_dirs:
+    ...        r.execute_project_test(project_dir)
+
+    The test files of a project can also be executed concurrently by passing
+    jobs to execute_project_test(). Each of the jobs runs its share of the test
+    files in its own clone of the project's database.
+
+    A project can list the scripts that set up the database of its tests in a
+    manifest, see read_setup_manifest(). They are executed once, in a snapshot
+    database named after the project, and each test file runs in its own clone
+    of the snapshot. The snapshot is kept and reused, by later runs too, until
+    the hash of the setup changes, see get_setup_hash().
+
+    By default every sql script is executed by a psql subprocess, see
+    _execute_sql_script. With in_process=True they are executed by a
+    sql_executor.SQLScriptExecutor over one long lived connection per database
+    instead, which saves a process, a connection and a backend startup per
+    script. The connections are closed when the manager exits.
+
+    With a result_cache, a result_cache.ResultCache, the outcome of every
+    test file is recorded along with the hash of the files it depends on.
+    execute_project_test(changed_only=True) then skips the test files that
+    passed and have not changed since.
+
+    The manager works with the harness it's given, or else the
+    current_harness(), so managers of different harnesses can run side by
+    side.
+
     TODO(Sid): Maybe we can enforce the singleton(ish) behavior so API is not
     misused? Till then this is:
     *Not Thread Safe*
     """
-    def __init__(self):
+    def __init__(self, template_db=None, in_process=False, harness=None,
+                 result_cache=None):
         self._is_initialized = False
+        self.harness = harness or current_harness()
+        self.template_db = template_db
+        # The database the glue and the tests are executed in. None is the
+        # default database created with the harness.
+        self.dbname = template_db
+        self.in_process = in_process
+        self.result_cache = result_cache
+        # test file -> seconds it took to execute, of the tests executed so far
+        self.test_durations = {}
+        self._clone_ids = itertools.count(1)
+        # dbname -> SQLScriptExecutor, when in_process
+        self._executors = {}
+        self._executors_lock = threading.Lock()
 
     def __enter__(self):
         if self._is_initialized is False:
@@ -88,11 +293,16 @@ class PyPGTAPTestManager(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         """
-        We don't need any cleanup at this point. But we propagate exceptions
+        Closes the connections of the in process executors, if any. We
+        propagate exceptions.
         """
+        for dbname in list(self._executors):
+            self._close_executor(dbname)
         return False
 
-    def execute_project_test(self, project_dir, test_file=None):
+    def execute_project_test(
+            self, project_dir, test_file=None, jobs=1, line_callback=None,
+            keep_output=True, changed_only=False, only_tests=None):
         '''
         Execute the given tests in a project_dir directory. If there is a
         test(s)/ directory then the method looks for test_*.sql files in it.
@@ -108,10 +318,29 @@ class PyPGTAPTestManager(object):
             project_dir/test(s)/. For example if the test file is located
             in my_project/tests/ddl/my_first_test.ddl. The this param is
             'ddl/my_first_test.sql'
+        :param int jobs: The number of test files to execute concurrently.
+            When more than 1 each test file runs in a clone of the project
+            database of its own, which is dropped after it. The outputs are in
+            the same order as that of a serial run.
+        :param callable line_callback: If given it's called as
+            line_callback(test, line) with every line of TAP output as soon as
+            a test script produces it, which lets callers report failures
+            while the tests are still running. When jobs > 1 it's called from
+            several threads. It can raise PyPGTAPAbort to stop executing the
+            project's tests.
+        :param bool keep_output: If False the TAP outputs are only passed to
+            line_callback and not kept, the returned outputs are empty.
+        :param bool changed_only: If True the test files that passed the last
+            time and have not changed since, according to the result_cache,
+            are skipped. There is no output for them.
+        :param collection only_tests: If given only the test files in it are
+            executed, as they are returned by get_project_test_scripts(). For
+            example a shard of the tests, see sharding.shard_tests().
         :return: A list of TAP outputs
         :rtype: list[str]
         :raises PyPGTAPSubprocessError: If there is an error in executing the
             underlying script
+        :raises PyPGTAPAbort: If line_callback raised it.
         '''
         if not os.path.exists(project_dir):
             raise IOError(
@@ -123,9 +352,7 @@ class PyPGTAPTestManager(object):
                 'No tests found to exist in project dir {}'.format(
                     project_dir))
             return
-        sub_dirs = os.listdir(project_dir)
-        test_dir = os.path.join(
-            project_dir, 'test' if 'test' in sub_dirs else 'tests')
+        test_dir = self._get_test_dir(project_dir)
 
         # Your test must be in the test_dir dir!
         if (test_file is not None
@@ -133,22 +360,309 @@ class PyPGTAPTestManager(object):
             raise IOError('Test file {} not found in test dir {}'.format(
                 test_file, test_dir))
 
-        # Let the test infrastructure be aware of the project directory.
-        self._set_project_dir(os.path.abspath(project_dir))
-
-        self._set_virtual_env_dir()
+        if jobs < 1:
+            raise ValueError('jobs must be a positive integer')
+        if changed_only and self.result_cache is None:
+            raise ValueError('changed_only needs a result_cache')
+        manifest = read_setup_manifest(project_dir)
+        if manifest is not None:
+            # Hashed once for the snapshot and the hashes of the tests, the
+            # fixtures can be big.
+            setup_hash = get_setup_hash(project_dir, *manifest)
+            with self._setup_snapshot(
+                    project_dir, manifest[0], setup_hash) as snapshot_db:
+                return self._execute_project_test_in_db(
+                    project_dir, test_dir, test_file, jobs, snapshot_db,
+                    line_callback, keep_output, clone_per_test=True,
+                    changed_only=changed_only, only_tests=only_tests,
+                    setup_hash=setup_hash)
+        if self.template_db is None:
+            return self._execute_project_test_in_db(
+                project_dir, test_dir, test_file, jobs, None, line_callback,
+                keep_output, changed_only=changed_only, only_tests=only_tests)
+        clone_db = self._clone_db(self.template_db)
+        try:
+            return self._execute_project_test_in_db(
+                project_dir, test_dir, test_file, jobs, clone_db,
+                line_callback, keep_output, changed_only=changed_only,
+                only_tests=only_tests)
+        finally:
+            self._close_executor(clone_db)
+            postgres_env.drop_db(clone_db, harness=self.harness)
+
+    def _execute_project_test_in_db(
+            self, project_dir, test_dir, test_file, jobs, dbname,
+            line_callback=None, keep_output=True, clone_per_test=False,
+            changed_only=False, only_tests=None, setup_hash=None):
+        """
+        Executes the tests of execute_project_test() in the database dbname.
+        With clone_per_test dbname is a setup snapshot and every test runs in
+        its own clone of it. With a result_cache the outcomes of the tests are
+        recorded once they have all run, along with their hashes, which
+        depend on the setup_hash of the project, if it has a setup.
+        """
+        if not clone_per_test:
+            # Let the test infrastructure be aware of the project directory.
+            self._set_project_dir(
+                os.path.abspath(project_dir), dbname=dbname,
+                harness=self.harness)
+            self._set_virtual_env_dir(dbname=dbname, harness=self.harness)
         # Finally execute each of the test scripts OR if you asked for one
         # we execute that.
-        test_output = []
+        tests = []
         for test in self.get_test_scripts(test_dir):
+            if only_tests is not None and test not in only_tests:
+                continue
             if test_file is None or test.endswith(test_file):
-                p = _execute_sql_script(test)
-                test_output.append(p)
+                tests.append(test)
             else:
                 _logger.warn(
                     'Ignoring {} test, because {} test'
                     ' was specifically requested'.format(test, test_file))
-        return test_output
+        if self.result_cache is not None:
+            test_hashes = dict(
+                (test, get_test_hash(test, project_dir, setup_hash))
+                for test in tests)
+            if changed_only:
+                tests = self._skip_unchanged_tests(
+                    project_dir, tests, test_hashes)
+            line_callback = TestOutcomes(line_callback)
+        if not tests:
+            return []
+        if not clone_per_test and (jobs == 1 or len(tests) < 2):
+            outputs = [self._execute_test(
+                           test, dbname, line_callback, keep_output)
+                       for test in tests]
+        else:
+            outputs = self._execute_test_scripts_concurrently(
+                tests, jobs, dbname, line_callback, keep_output)
+        if self.result_cache is not None:
+            self.result_cache.record(project_dir, dict(
+                (test, (test_hashes[test], line_callback.passed(test)))
+                for test in tests))
+        return outputs
+
+    def get_test_hashes(self, project_dir, tests):
+        """
+        The result_cache.get_test_hash() of each of the tests of project_dir.
+        A test's hash changes when the test, the files it includes or the
+        project setup change.
+
+        :rtype: dict
+        """
+        manifest = read_setup_manifest(project_dir)
+        setup_hash = None
+        if manifest is not None:
+            setup_hash = get_setup_hash(project_dir, *manifest)
+        return dict(
+            (test, get_test_hash(test, project_dir, setup_hash))
+            for test in tests)
+
+    def _skip_unchanged_tests(self, project_dir, tests, test_hashes):
+        """
+        The tests that did not pass with their test_hashes the last time.
+        """
+        changed = []
+        for test in tests:
+            if self.result_cache.passed(project_dir, test, test_hashes[test]):
+                _logger.info('Skipping {}, it passed and has not changed'.format(
+                    test))
+            else:
+                changed.append(test)
+        return changed
+
+    def _execute_test_scripts_concurrently(
+            self, tests, jobs, dbname, line_callback=None, keep_output=True):
+        """
+        Executes the tests, up to jobs of them at a time, and returns their
+        outputs in the order of tests. Every test runs in a fresh clone of
+        dbname that is dropped after it, so like in a serial run it doesn't
+        see what the other tests did, whichever ran before it.
+
+        Once a test is aborted by a PyPGTAPAbort the tests that have not
+        started are skipped and the running ones are aborted at their next
+        line of output.
+        """
+        source_db = dbname or postgres_env.get_default_db_name()
+        # A database can't be cloned while there are connections to it.
+        self._close_executor(dbname)
+        aborted = threading.Event()
+
+        def abortable_callback(test, line):
+            if aborted.is_set():
+                raise PyPGTAPAbort('Aborted by another test')
+            if line_callback is not None:
+                line_callback(test, line)
+
+        def execute(test):
+            if aborted.is_set():
+                raise PyPGTAPAbort('Aborted by another test')
+            clone_db = self._clone_db(source_db)
+            try:
+                return self._execute_test(
+                    test, clone_db, abortable_callback, keep_output)
+            except PyPGTAPAbort:
+                aborted.set()
+                raise
+            finally:
+                self._drop_clone(clone_db)
+
+        # Imported here, multiprocessing is slow to import and only
+        # needed for concurrent runs.
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(jobs, len(tests)))
+        try:
+            return pool.map(execute, tests)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _clone_db(self, source_db):
+        """
+        Creates a new database from source_db, which must have been
+        bootstrapped, and returns its name.
+        """
+        clone_db = '{}_{}'.format(source_db, next(self._clone_ids))
+        self._close_executor(source_db)
+        postgres_env.drop_db(clone_db, harness=self.harness)
+        postgres_env.create_db(
+            clone_db, template_db=source_db, harness=self.harness)
+        return clone_db
+
+    def _drop_clone(self, clone_db):
+        """
+        Closes the connections to clone_db and drops it.
+        """
+        self._close_executor(clone_db)
+        postgres_env.drop_db(clone_db, harness=self.harness)
+
+    @contextmanager
+    def _setup_snapshot(self, project_dir, scripts, setup_hash):
+        """
+        The database with the snapshot of the project's setup, see
+        read_setup_manifest(), for the duration of the context. A snapshot
+        that is missing, or of another get_setup_hash() than setup_hash, is
+        (re)made from the database the project would otherwise run in: the
+        setup scripts are executed in a clone of it.
+
+        Other managers, e.g. of other run_all_tests processes or of other
+        leases of the harness daemon, share the snapshot. It's checked and
+        made under an exclusive advisory lock, and used under a shared one,
+        so none of them drops it while another makes or clones it.
+
+        :raises PyPGTAPSubprocessError: If a setup script fails.
+        """
+        project_dir = os.path.abspath(project_dir)
+        snapshot_db = SETUP_SNAPSHOT_DB_PREFIX + hashlib.sha1(
+            project_dir).hexdigest()[:16]
+        lock_key = int(hashlib.sha1(snapshot_db).hexdigest()[:15], 16)
+        user_name = os.environ.get('USER')
+        with CONNECTION_POOL.connection(
+                _SNAPSHOT_LOCK_DB, user_name, self.harness) as conn:
+            with conn.cursor() as cursor:
+                try:
+                    cursor.execute('SELECT pg_advisory_lock(%s)', (lock_key,))
+                    conn.commit()
+                    self._make_setup_snapshot(
+                        project_dir, scripts, setup_hash, snapshot_db)
+                    cursor.execute(
+                        'SELECT pg_advisory_lock_shared(%s)', (lock_key,))
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', (lock_key,))
+                    conn.commit()
+                    yield snapshot_db
+                finally:
+                    # The connection goes back to the pool, not the locks
+                    cursor.execute('SELECT pg_advisory_unlock_all()')
+                    conn.commit()
+
+    def _make_setup_snapshot(self, project_dir, scripts, setup_hash,
+                             snapshot_db):
+        """
+        (Re)makes snapshot_db unless it's a snapshot of the same setup.
+        """
+        if (self._get_db_glue_hash(snapshot_db, harness=self.harness)
+                == setup_hash):
+            _logger.debug('Reusing the setup snapshot {} of {}'.format(
+                snapshot_db, project_dir))
+            return
+        _logger.info('Making the setup snapshot {} of {}'.format(
+            snapshot_db, project_dir))
+        source_db = self.dbname or postgres_env.get_default_db_name()
+        self._close_executor(self.dbname)
+        self._drop_clone(snapshot_db)
+        postgres_env.create_db(
+            snapshot_db, template_db=source_db, harness=self.harness)
+        try:
+            self._set_project_dir(
+                project_dir, dbname=snapshot_db, harness=self.harness)
+            self._set_virtual_env_dir(dbname=snapshot_db, harness=self.harness)
+            for script in scripts:
+                self._execute_script(script, snapshot_db)
+            # The snapshot is cloned next, which needs it to be unused
+            self._close_executor(snapshot_db)
+            self._set_db_glue_hash(
+                snapshot_db, setup_hash, harness=self.harness)
+        except BaseException:
+            self._drop_clone(snapshot_db)
+            raise
+
+    def _execute_test(self, test, dbname, line_callback=None, keep_output=True):
+        """
+        Executes the test file like _execute_script() and records how long it
+        took in test_durations. The time of a test that was aborted or failed
+        to run is not recorded, it's not how long the test takes.
+        """
+        start = time.time()
+        output = self._execute_script(test, dbname, line_callback, keep_output)
+        self.test_durations[test] = time.time() - start
+        return output
+
+    def _execute_script(
+            self, sql_script, dbname, line_callback=None, keep_output=True):
+        """
+        Executes sql_script in dbname with psql or, when in_process, with the
+        SQLScriptExecutor of dbname. The lines of output are passed to
+        line_callback(sql_script, line) as they are produced.
+        """
+        if line_callback is not None:
+            line_callback = functools.partial(line_callback, sql_script)
+        if not self.in_process:
+            return _execute_sql_script(
+                sql_script, dbname=dbname, harness=self.harness,
+                line_callback=line_callback, keep_output=keep_output)
+        with self._executors_lock:
+            executor = self._executors.get(dbname)
+            if executor is None:
+                executor = SQLScriptExecutor(
+                    dbname=dbname, harness=self.harness)
+                self._executors[dbname] = executor
+        return executor.execute_script(sql_script, line_callback, keep_output)
+
+    def _close_executor(self, dbname):
+        """
+        Closes the connection of the SQLScriptExecutor of dbname, if any.
+        """
+        with self._executors_lock:
+            executor = self._executors.pop(dbname, None)
+        if executor is not None:
+            executor.close()
+
+    def _get_test_dir(self, project_dir):
+        sub_dirs = os.listdir(project_dir)
+        return os.path.join(
+            project_dir, 'test' if 'test' in sub_dirs else 'tests')
+
+    def get_project_test_scripts(self, project_dir):
+        """
+        The test_*.sql files of a project, sorted.
+
+        :param str project_dir: The project directory.
+        :rtype: list[str]
+        :raises IOError: If the project_dir has no test/ or tests/ directory.
+        """
+        if not self.is_valid_project_test_dir(project_dir):
+            return []
+        return sorted(self.get_test_scripts(self._get_test_dir(project_dir)))
 
     def is_valid_project_test_dir(self, project_dir):
         """
@@ -163,9 +677,7 @@ class PyPGTAPTestManager(object):
                 'Project dir {} is not a valid ETL directory.'
                 'It does not have a test/ or tests/ directory').format(
                     project_dir))
-        test_dir = os.path.join(
-            project_dir, 'test' if 'test' in sub_dirs else 'tests')
-        return any(self.get_test_scripts(test_dir))
+        return any(self.get_test_scripts(self._get_test_dir(project_dir)))
 
     def get_test_scripts(self, test_dir):
         """
@@ -234,13 +746,52 @@ class PyPGTAPTestManager(object):
         flattened_result = [r for r, in result if r]
         return flattened_result
 
+    @ExecuteQueryHelper()
+    def _get_db_glue_hash(self, db_name, cursor):
+        """
+        Get the hash of the glue db_name was bootstrapped with, or of the
+        setup for a setup snapshot, see _set_db_glue_hash.
+
+        :return: The hash or None if db_name does not exist or was never
+            bootstrapped.
+        :rtype: str
+        """
+        cursor.execute(
+            "SELECT shobj_description(oid, 'pg_database') FROM pg_database"
+            " WHERE datname = %s;", (db_name,))
+        result = cursor.fetchall()
+        return result[0][0] if result else None
+
+    @ExecuteQueryHelper()
+    def _set_db_glue_hash(self, db_name, glue_hash, cursor):
+        """
+        Record the hash of the glue, or of the setup, db_name was bootstrapped
+        with. It's kept as the comment of the database so that it can be read
+        without connecting to db_name, which would stop it from being cloned.
+        """
+        cursor.execute(
+            'COMMENT ON DATABASE "{}" IS %s;'.format(db_name), (glue_hash,))
+
     def _init_pgtap(self):
         """
         Internal call that executes the base.sql and other *.sql scripts needed
         by the pypgTAP framework.
         See the FAQ in the README for an elaborate explanation of how we read
         these in.
+
+        In template mode the template_db is (re)created first and the scripts
+        are executed in it, unless it was already bootstrapped with the same
+        glue; For example by a harness started from the cluster cache.
         """
+        if self.template_db is not None:
+            if (self._get_db_glue_hash(self.template_db, harness=self.harness)
+                    == get_glue_hash()):
+                _logger.debug('{} is already bootstrapped'.format(
+                    self.template_db))
+                self._is_initialized = True
+                return
+            postgres_env.drop_db(self.template_db, harness=self.harness)
+            postgres_env.create_db(self.template_db, harness=self.harness)
         # Place all base scripts in the parent directory.  TODO(Sid): this is
         # fine for now but we may want to walk and find all the .sql files to
         # execute.
@@ -257,10 +808,13 @@ class PyPGTAPTestManager(object):
         pypgtap_init_scripts.remove(base_script)
         abs_basescript_path = pkg_resources.resource_filename(
             'pypgtap.core.glue', base_script)
-        _execute_sql_script(abs_basescript_path)
+        self._execute_script(abs_basescript_path, self.dbname)
 
         for pypgtap_init_script in pypgtap_init_scripts:
             if pypgtap_init_script.endswith('.sql'):
-                _execute_sql_script(pkg_resources.resource_filename(
-                    'pypgtap.core.glue', pypgtap_init_script))
+                self._execute_script(pkg_resources.resource_filename(
+                    'pypgtap.core.glue', pypgtap_init_script), self.dbname)
+        if self.template_db is not None:
+            self._set_db_glue_hash(
+                self.template_db, get_glue_hash(), harness=self.harness)
         self._is_initialized = True
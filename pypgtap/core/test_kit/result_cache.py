@@ -0,0 +1,204 @@
+"""
+The result cache of incremental test runs. It remembers whether each test file
+passed, together with the hash of everything the outcome depends on, see
+get_test_hash(). A test file whose hash has not changed since it passed can be
+skipped:
+
+>>> cache = ResultCache()
+>>> with PyPGTAPTestManager(result_cache=cache) as manager:
+...     manager.execute_project_test(project_dir, changed_only=True)
+
+The results of a project are kept in a JSON file named after the project dir
+in the cache dir.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+from pypgtap.core.test_kit.sql_executor import split_psql_script
+from pypgtap.core.test_kit.utils import get_glue_hash, write_json_atomically
+from pypgtap.lib.tap import BailLine, TestLine, parseLine
+
+_logger = logging.getLogger(__name__)
+
+RESULT_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(),
+        '__pypgtap_result_cache')
+
+_INCLUDE_COMMANDS = ('i', 'include')
+_INCLUDE_RELATIVE_COMMANDS = ('ir', 'include_relative')
+
+# The string literals of a query, which may name fixtures
+_STRING_LITERAL = re.compile(r"'((?:[^']|'')*)'")
+
+
+def get_test_hash(test_file, project_dir, setup_hash=None):
+    """
+    A hash of everything the outcome of test_file depends on: the glue, the
+    test file, the files it includes with \\i or \\ir, recursively, and the
+    fixtures they reference. A fixture is any string literal, or argument of
+    a \\! command, that names a file in project_dir.
+
+    :param str test_file: The test file.
+    :param str project_dir: The project directory the fixtures are relative
+        to.
+    :param str setup_hash: The hash of the project setup the test runs on, see
+        pypgtap_testing.get_setup_hash().
+    :return: The hex digest
+    :rtype: str
+    """
+    sha = hashlib.sha1()
+    sha.update(get_glue_hash())
+    sha.update(setup_hash or '')
+    fixtures = set()
+    _hash_script(sha, os.path.abspath(test_file), project_dir, fixtures, set())
+    for fixture in sorted(fixtures):
+        sha.update(os.path.relpath(fixture, project_dir))
+        _hash_file(sha, fixture)
+    return sha.hexdigest()
+
+
+def _hash_script(sha, script, project_dir, fixtures, seen):
+    """
+    Adds the contents of script and of the scripts it includes to sha, and the
+    fixtures it references to fixtures.
+    """
+    if script in seen:
+        return
+    seen.add(script)
+    if not os.path.isfile(script):
+        # psql will fail on it, but maybe not once it's there
+        sha.update('missing ' + script)
+        return
+    with open(script) as f:
+        text = f.read()
+    sha.update(text)
+    for statement in split_psql_script(text):
+        if statement[0] == 'query':
+            for literal in _STRING_LITERAL.findall(statement[1]):
+                _add_fixture(literal.replace("''", "'"), project_dir, fixtures)
+            continue
+        _, command, arguments, _ = statement
+        if command in _INCLUDE_COMMANDS + _INCLUDE_RELATIVE_COMMANDS:
+            included = arguments.strip().strip("'")
+            if command in _INCLUDE_RELATIVE_COMMANDS:
+                included = os.path.join(os.path.dirname(script), included)
+            _hash_script(
+                sha, os.path.abspath(included), project_dir, fixtures, seen)
+        elif command == '!':
+            for argument in arguments.split():
+                _add_fixture(argument.strip("'\""), project_dir, fixtures)
+
+
+def _add_fixture(name, project_dir, fixtures):
+    path = os.path.join(project_dir, name)
+    if name and os.path.isfile(path):
+        fixtures.add(os.path.abspath(path))
+
+
+def _hash_file(sha, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            sha.update(block)
+
+
+class TestOutcomes(object):
+    """
+    A line_callback for PyPGTAPTestManager.execute_project_test() that tells
+    whether each test passed from its TAP output: It passed if it has no
+    failed test that is not a TODO, no Bail out! and ran the tests it
+    planned. The lines are passed on to line_callback, if any.
+    """
+
+    def __init__(self, line_callback=None):
+        self.line_callback = line_callback
+        # test -> [plan, tests run, failed]
+        self._outcomes = {}
+
+    def __call__(self, test, line):
+        parsed = parseLine(line)
+        if parsed is not None:
+            outcome = self._outcomes.setdefault(test, [None, 0, False])
+            if isinstance(parsed, int):
+                if outcome[0] is None:
+                    outcome[0] = parsed
+            elif isinstance(parsed, BailLine):
+                outcome[2] = True
+            elif isinstance(parsed, TestLine):
+                outcome[1] += 1
+                if not parsed.passed and parsed.directive != 'TODO':
+                    outcome[2] = True
+        if self.line_callback is not None:
+            self.line_callback(test, line)
+
+    def passed(self, test):
+        plan, run, failed = self._outcomes.get(test, (None, 0, True))
+        return not failed and (plan is None or plan == run)
+
+
+class ResultCache(object):
+    """
+    The outcomes of the test files of the projects and the hashes they were
+    run with.
+
+    *Thread Safe*
+    """
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _path(self, project_dir):
+        return os.path.join(self.cache_dir, '{}.json'.format(
+            hashlib.sha1(os.path.abspath(project_dir)).hexdigest()))
+
+    def _load(self, project_dir):
+        """
+        The {test: {'hash': ..., 'passed': ...}} results of project_dir, the
+        tests are relative to it.
+        """
+        project_dir = os.path.abspath(project_dir)
+        results = self._results.get(project_dir)
+        if results is None:
+            try:
+                with open(self._path(project_dir)) as f:
+                    results = json.load(f)
+            except (IOError, ValueError):
+                results = {}
+            self._results[project_dir] = results
+        return results
+
+    def passed(self, project_dir, test, test_hash):
+        """
+        Tells if test passed the last time it was run with test_hash.
+
+        :rtype: bool
+        """
+        with self._lock:
+            result = self._load(project_dir).get(
+                os.path.relpath(test, project_dir))
+        return (result is not None and result['hash'] == test_hash
+                and result['passed'])
+
+    def record(self, project_dir, outcomes):
+        """
+        Records the outcomes of tests of project_dir and saves them.
+
+        :param dict outcomes: {test: (test_hash, passed)}
+        """
+        with self._lock:
+            results = self._load(project_dir)
+            for test, (test_hash, passed) in outcomes.iteritems():
+                results[os.path.relpath(test, project_dir)] = {
+                    'hash': test_hash, 'passed': passed}
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            path = self._path(project_dir)
+            write_json_atomically(path, results)
+        _logger.debug('Recorded the results of {} tests in {}'.format(
+            len(outcomes), path))
@@ -0,0 +1,117 @@
+"""
+Splits test files into shards that take about the same time to run, so that a
+test run can be spread over several CI nodes. Every node is given the same
+test files and the same durations, and runs its own shard of them:
+
+>>> tests = shard_tests(all_tests, load_durations(project_dirs), 2, 4)
+
+The durations of the test files of a project are recorded by the runner in
+the DURATIONS_FILE of the project when asked, see record_durations(). Record
+them on a run of all the test files and hand the file to every node, e.g. as
+a CI artifact, so that all the nodes see the same history.
+"""
+import json
+import logging
+import os
+
+from pypgtap.core.test_kit.utils import write_json_atomically
+
+_logger = logging.getLogger(__name__)
+
+# The durations of the test files of a project, next to its test(s)/ directory
+DURATIONS_FILE = '.pypgtap_durations.json'
+
+
+def parse_shard(shard):
+    """
+    :param str shard: A shard as K/N, the K-th of N shards counting from 1.
+    :return: (K, N)
+    :rtype: tuple
+    :raises ValueError: If shard is not a K/N with 1 <= K <= N.
+    """
+    try:
+        index, count = [int(part) for part in shard.split('/')]
+    except ValueError:
+        raise ValueError('Shard {} is not K/N'.format(shard))
+    if not 1 <= index <= count:
+        raise ValueError('Shard {} is not one of 1/{}..{}/{}'.format(
+            shard, count, count, count))
+    return index, count
+
+
+def load_durations(project_dirs):
+    """
+    The recorded durations of the test files of the projects.
+
+    :param list[str] project_dirs: The project directories.
+    :return: The seconds each test file took the last time it ran, by its
+        path in project_dir.
+    :rtype: dict
+    """
+    durations = {}
+    for project_dir in project_dirs:
+        try:
+            with open(os.path.join(project_dir, DURATIONS_FILE)) as f:
+                recorded = json.load(f)
+        except (IOError, ValueError):
+            continue
+        for test, seconds in recorded.iteritems():
+            durations[os.path.join(project_dir, test)] = seconds
+    return durations
+
+
+def record_durations(project_dir, durations):
+    """
+    Records the durations of test files of project_dir, keeping the ones of
+    the other test files. A project dir that can't be written only gets a
+    warning, it's just history.
+
+    :param dict durations: The seconds each test file took, by its path.
+    """
+    if not durations:
+        return
+    path = os.path.join(project_dir, DURATIONS_FILE)
+    recorded = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                recorded = json.load(f)
+        except ValueError:
+            _logger.warn('Ignoring the corrupt durations in {}'.format(path))
+    for test, seconds in durations.iteritems():
+        recorded[os.path.relpath(test, project_dir)] = round(seconds, 3)
+    try:
+        write_json_atomically(path, recorded)
+    except (IOError, OSError) as e:
+        _logger.warn('Could not record the test durations in {}: {}'.format(
+            path, e))
+
+
+def shard_tests(tests, durations, index, count):
+    """
+    Splits tests into count shards of about the same duration and returns the
+    index-th one. The longest tests are placed first, each in the shard with
+    the least work so far. A test without a recorded duration is taken to
+    last the mean of the recorded ones, or a second if there are none, which
+    deals the tests out round robin in the order of their names. The split
+    only depends on the tests and durations, not on their order, so every
+    node computes the same one.
+
+    :param list[str] tests: The test files of all the shards.
+    :param dict durations: The recorded durations of test files in seconds.
+    :param int index: The shard to return, from 1 to count.
+    :param int count: The number of shards.
+    :return: The tests of the shard, in their order in tests.
+    :rtype: list[str]
+    """
+    known = [durations[t] for t in tests if t in durations]
+    fallback = sum(known) / len(known) if known else 1.0
+    estimates = dict((t, durations.get(t, fallback)) for t in tests)
+    loads = [0.0] * count
+    shard_of = {}
+    for test in sorted(set(tests), key=lambda t: (-estimates[t], t)):
+        shard = min(xrange(count), key=lambda s: (loads[s], s))
+        loads[shard] += estimates[test]
+        shard_of[test] = shard
+    _logger.debug('Estimated shard durations: {}'.format(loads))
+    return [t for t in tests if shard_of[t] == index - 1]
@@ -0,0 +1,442 @@
+"""
+This contains an in-process alternative to executing sql scripts with a psql
+subprocess, see pypgtap_testing._execute_sql_script. Forking psql for every
+test file pays for the process startup, a new connection and a new backend
+each time. The SQLScriptExecutor here instead executes the scripts over a single
+long lived psycopg2 connection.
+
+Only the part of psql that pypgTAP relies on is emulated:
+
+* The output is unaligned and tuples only(-P format=unaligned -t), that is one
+  line per row with the columns separated by '|' and NULLs printed as empty
+  strings. Command tags are not printed(-q -v QUIET=1).
+* The ON_ERROR_STOP and ON_ERROR_ROLLBACK variables, see:
+  http://www.postgresql.org/docs/9.3/static/app-psql.html#APP-PSQL-VARIABLES
+* The \\i, \\ir(\\include, \\include_relative), \\set, \\unset, \\echo,
+  \\qecho and \\g meta-commands. Any other meta-command is an error.
+
+Variable interpolation(:foo) and COPY ... FROM STDIN are not supported; Use the
+psql executor for scripts that need them.
+"""
+import logging
+import os
+
+from pypgtap.core.test_kit.pypgtap_error import PyPGTAPScriptError
+from pypgtap.core.test_kit.utils import LazyModule, current_harness
+
+_logger = logging.getLogger(__name__)
+
+psyc = LazyModule('psycopg2')
+extensions = LazyModule('psycopg2.extensions')
+
+# psql exits with this code when ON_ERROR_STOP stops a script.
+ON_ERROR_STOP_RC = 3
+
+# The savepoint psql uses to implement ON_ERROR_ROLLBACK.
+_SAVEPOINT = 'pg_psql_temporary_savepoint'
+
+_INCLUDE_COMMANDS = ('i', 'include')
+_INCLUDE_RELATIVE_COMMANDS = ('ir', 'include_relative')
+
+
+def split_psql_script(script):
+    """
+    A generator that splits the text of a psql script into the queries and
+    the meta-commands in it. Queries end at a semicolon that is not inside a
+    string, a quoted identifier, a dollar quoted body, a comment or
+    parentheses. A meta-command starts at a backslash outside of those and
+    runs till the end of the line. An unterminated query at the end of the
+    script is also returned, like psql would execute it.
+
+    :param str script: The text of a psql script.
+    :return: Tuples of ('query', query, line_number) or
+        ('meta', command, arguments, line_number). The query text does not
+        have the terminating semicolon.
+    """
+    buf = []
+    # If buf has anything other than white space and comments
+    has_sql = False
+    start_line = line = 1
+    paren_depth = 0
+    i = 0
+    n = len(script)
+    while i < n:
+        c = script[i]
+        if c == '\n':
+            line += 1
+        if c == '-' and script.startswith('--', i):
+            end = script.find('\n', i)
+            end = n if end == -1 else end
+            buf.append(script[i:end])
+            i = end
+            continue
+        if c == '/' and script.startswith('/*', i):
+            end = _find_comment_end(script, i)
+            line += script.count('\n', i, end)
+            buf.append(script[i:end])
+            i = end
+            continue
+        if c == '\\':
+            end = script.find('\n', i)
+            end = n if end == -1 else end
+            words = script[i + 1:end].split(None, 1)
+            command = words[0] if words else ''
+            args = words[1].strip() if len(words) > 1 else ''
+            i = end
+            if command == 'g':
+                if has_sql:
+                    yield ('query', ''.join(buf).strip(), start_line)
+                buf, has_sql, paren_depth = [], False, 0
+            else:
+                yield ('meta', command, args, line)
+            continue
+        if not has_sql:
+            if c.isspace():
+                buf.append(c)
+                i += 1
+                continue
+            has_sql = True
+            start_line = line
+        if c == "'":
+            end = _find_string_end(
+                script, i, escapes=_is_escape_string_prefix(script, i))
+        elif c == '"':
+            end = _find_string_end(script, i, escapes=False, quote='"')
+        elif c == '$' and _dollar_quote_tag(script, i):
+            tag = _dollar_quote_tag(script, i)
+            end = script.find(tag, i + len(tag))
+            end = n if end == -1 else end + len(tag)
+        elif c == ';' and paren_depth == 0:
+            yield ('query', ''.join(buf).strip(), start_line)
+            buf, has_sql = [], False
+            i += 1
+            continue
+        else:
+            if c == '(':
+                paren_depth += 1
+            elif c == ')':
+                paren_depth = max(0, paren_depth - 1)
+            buf.append(c)
+            i += 1
+            continue
+        line += script.count('\n', i + 1, end)
+        buf.append(script[i:end])
+        i = end
+    if has_sql:
+        yield ('query', ''.join(buf).strip(), start_line)
+
+
+def _find_comment_end(script, start):
+    """
+    The index after the end of the, possibly nested, block comment at start.
+    """
+    depth = 0
+    i = start
+    while i < len(script):
+        if script.startswith('/*', i):
+            depth += 1
+            i += 2
+        elif script.startswith('*/', i):
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return i
+        else:
+            i += 1
+    return len(script)
+
+
+def _find_string_end(script, start, escapes, quote="'"):
+    """
+    The index after the closing quote of the string literal or the quoted
+    identifier at start. A doubled quote does not close it and neither does a
+    backslash escaped one in E'' strings.
+    """
+    i = start + 1
+    while i < len(script):
+        c = script[i]
+        if escapes and c == '\\':
+            i += 2
+            continue
+        if c == quote:
+            if script.startswith(quote, i + 1):
+                i += 2
+                continue
+            return i + 1
+        i += 1
+    return len(script)
+
+
+def _is_escape_string_prefix(script, quote_index):
+    """
+    If the string literal starting at quote_index is an E'' string.
+    """
+    if quote_index == 0 or script[quote_index - 1] not in 'eE':
+        return False
+    return quote_index < 2 or not _is_identifier_char(script[quote_index - 2])
+
+
+def _dollar_quote_tag(script, start):
+    """
+    Returns the $tag$ that starts at start or None if there is none. $1 style
+    parameters and identifiers with a $ in them are not dollar quotes.
+    """
+    if start > 0 and _is_identifier_char(script[start - 1]):
+        return None
+    end = script.find('$', start + 1)
+    if end == -1:
+        return None
+    tag = script[start + 1:end]
+    if tag and (tag[0].isdigit()
+                or not all(_is_identifier_char(c) for c in tag)):
+        return None
+    return script[start:end + 1]
+
+
+def _is_identifier_char(c):
+    return c.isalnum() or c in '_$'
+
+
+def _is_true(value):
+    """
+    Interprets a psql boolean variable the way psql does, ie by a case
+    insensitive prefix of on, true, yes or 1.
+    """
+    value = (value or '').lower()
+    if not value:
+        return False
+    if value in ('1', 'on'):
+        return True
+    return any(b.startswith(value) for b in ('true', 'yes'))
+
+
+def _raw_value(value, cursor):
+    """
+    A psycopg2 typecaster that keeps the text postgres sends for a value, so
+    the output is the same as psql's.
+    """
+    return value
+
+
+class SQLScriptExecutor(object):
+    """
+    Executes psql scripts over a long lived connection to dbname and returns
+    their output like:
+
+    psql -P format=unaligned -P pager -t -v QUIET=1 -v ON_ERROR_STOP=true
+        -v ON_ERROR_ROLLBACK=1 -q -Xf <sql_script>
+
+    would. It's a context manager that closes the connection when done:
+
+    >>> with SQLScriptExecutor(dbname='pypgtap_template') as executor:
+    ...     output = executor.execute_script(sql_script)
+
+    Each script starts with a clean session(DISCARD ALL) and any transaction
+    the script leaves open is rolled back, as if psql had exited.
+
+    *Not Thread Safe*
+    """
+
+    def __init__(
+            self, dbname=None, user_name=None, on_error_stop=True,
+            on_error_rollback=True, harness=None):
+        """
+        :param str dbname: The database to connect to. Defaults to the
+            database named after the user.
+        :param str user_name: Defaults to the USER environment variable.
+        :param utils.Harness harness: The harness to connect to. Defaults to
+            the current_harness().
+        :param bool on_error_stop: The initial value of ON_ERROR_STOP.
+        :param bool on_error_rollback: The initial value of ON_ERROR_ROLLBACK.
+        """
+        self.user_name = os.environ.get('USER', user_name)
+        if not self.user_name:
+            raise EnvironmentError(
+                'Passed in a None user ID and the fallback $USER was also not '
+                'set.')
+        self.dbname = dbname or self.user_name
+        self.harness = harness or current_harness()
+        self.variables = {
+            'ON_ERROR_STOP': 'on' if on_error_stop else 'off',
+            'ON_ERROR_ROLLBACK': 'on' if on_error_rollback else 'off',
+        }
+        self._conn = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def connect(self):
+        """
+        Opens the connection, if it's not open already.
+        """
+        if self._conn is not None and not self._conn.closed:
+            return
+        self._conn = psyc.connect(
+            dbname=self.dbname, user=self.user_name,
+            **self.harness.connect_kwargs())
+        # The scripts manage their transactions with BEGIN/COMMIT/ROLLBACK
+        self._conn.autocommit = True
+        with self._conn.cursor() as cursor:
+            cursor.execute('SELECT oid FROM pg_type')
+            oids = tuple(oid for oid, in cursor.fetchall())
+        extensions.register_type(
+            extensions.new_type(oids, 'PYPGTAP_RAW', _raw_value), self._conn)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def execute_script(self, sql_script, line_callback=None, keep_output=True):
+        """
+        Execute a psql script and return its output.
+
+        :param str sql_script: The path of the script.
+        :param callable line_callback: If given it's called with every line
+            of output as soon as it's produced. Anything it raises stops the
+            script.
+        :param bool keep_output: If False the output is only passed to
+            line_callback and an empty string is returned.
+        :return: The output of the queries in the script.
+        :rtype: str
+        :raises PyPGTAPScriptError: If a query fails while ON_ERROR_STOP is
+            set or if the script uses a meta-command that is not supported.
+        """
+        self.connect()
+        if line_callback is None and keep_output:
+            output = []
+        else:
+            output = _StreamedOutput(line_callback, keep_output)
+        errors = []
+        variables = dict(self.variables)
+        try:
+            self._execute_file(sql_script, variables, output, errors)
+        finally:
+            self._reset_session()
+        if errors:
+            _logger.warn('Errors executing {}:\n{}'.format(
+                sql_script, '\n'.join(errors)))
+        return ''.join(output)
+
+    def _execute_file(self, sql_script, variables, output, errors):
+        with open(sql_script) as f:
+            script = f.read()
+        for item in split_psql_script(script):
+            if item[0] == 'query':
+                _, query, line = item
+                self._execute_query(
+                    query, variables, output, errors,
+                    '{}:{}'.format(sql_script, line), sql_script)
+            else:
+                _, command, args, line = item
+                self._execute_meta_command(
+                    command, args, variables, output, errors,
+                    '{}:{}'.format(sql_script, line), sql_script)
+
+    def _execute_meta_command(
+            self, command, args, variables, output, errors, location,
+            sql_script):
+        if command in _INCLUDE_COMMANDS + _INCLUDE_RELATIVE_COMMANDS:
+            include = _unquote(args)
+            if (command in _INCLUDE_RELATIVE_COMMANDS
+                    and not os.path.isabs(include)):
+                include = os.path.join(os.path.dirname(sql_script), include)
+            self._execute_file(include, variables, output, errors)
+        elif command == 'set':
+            # psql concatenates the values after the name
+            words = args.split()
+            if words:
+                variables[words[0]] = ''.join(
+                    _unquote(w) for w in words[1:])
+        elif command == 'unset':
+            variables.pop(args, None)
+        elif command in ('echo', 'qecho'):
+            output.append(_unquote(args) + '\n')
+        else:
+            raise PyPGTAPScriptError(
+                'psql:{}: invalid or unsupported command \\{}'.format(
+                    location, command),
+                rc=ON_ERROR_STOP_RC, cmd=str(sql_script))
+
+    def _execute_query(
+            self, query, variables, output, errors, location, sql_script):
+        use_savepoint = (
+            _is_true(variables.get('ON_ERROR_ROLLBACK'))
+            and self._transaction_status() ==
+            extensions.TRANSACTION_STATUS_INTRANS)
+        with self._conn.cursor() as cursor:
+            if use_savepoint:
+                cursor.execute('SAVEPOINT ' + _SAVEPOINT)
+            try:
+                cursor.execute(query)
+            except psyc.Error as e:
+                if (use_savepoint and self._transaction_status() ==
+                        extensions.TRANSACTION_STATUS_INERROR):
+                    cursor.execute('ROLLBACK TO ' + _SAVEPOINT)
+                message = 'psql:{}: {}'.format(
+                    location, (e.pgerror or str(e)).strip())
+                if _is_true(variables.get('ON_ERROR_STOP')):
+                    raise PyPGTAPScriptError(
+                        'Error executing a sql script. Output: %s' % message,
+                        rc=ON_ERROR_STOP_RC, cmd=str(sql_script))
+                errors.append(message)
+                return
+            if cursor.description is not None:
+                for row in cursor.fetchall():
+                    output.append('|'.join(
+                        '' if v is None else str(v) for v in row) + '\n')
+            # Like psql we must not release our savepoint if the query was
+            # one that manages savepoints.
+            if (use_savepoint and self._transaction_status() ==
+                    extensions.TRANSACTION_STATUS_INTRANS
+                    and not (cursor.statusmessage or '').startswith(
+                        ('SAVEPOINT', 'RELEASE', 'ROLLBACK'))):
+                cursor.execute('RELEASE ' + _SAVEPOINT)
+
+    def _transaction_status(self):
+        return self._conn.get_transaction_status()
+
+    def _reset_session(self):
+        """
+        Puts the session back to the state of a fresh connection.
+        """
+        for notice in self._conn.notices:
+            _logger.debug(notice.strip())
+        del self._conn.notices[:]
+        with self._conn.cursor() as cursor:
+            if (self._transaction_status() !=
+                    extensions.TRANSACTION_STATUS_IDLE):
+                cursor.execute('ROLLBACK')
+            cursor.execute('DISCARD ALL')
+
+
+class _StreamedOutput(list):
+    """
+    The output of a script that also hands each line to a callback when it's
+    appended. Without keep_output the lines are only handed over.
+    """
+
+    def __init__(self, line_callback=None, keep_output=True):
+        super(_StreamedOutput, self).__init__()
+        self.line_callback = line_callback
+        self.keep_output = keep_output
+
+    def append(self, line):
+        if self.keep_output:
+            super(_StreamedOutput, self).append(line)
+        if self.line_callback is not None:
+            self.line_callback(line)
+
+
+def _unquote(arg):
+    """
+    Strips the single quotes psql allows around meta-command arguments.
+    """
+    if len(arg) > 1 and arg[0] == arg[-1] == "'":
+        return arg[1:-1].replace("''", "'")
+    return arg
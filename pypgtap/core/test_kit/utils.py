@@ -1,33 +1,396 @@
+from contextlib import contextmanager
 from functools import update_wrapper, wraps
+import hashlib
+import importlib
+import json
 import tempfile
 import os
 import logging
-from logging import config as logging_config
 import re
+import socket
+import threading
+import time
 
-import psycopg2 as psyc
+
+class LazyModule(object):
+    """
+    A module that's only imported when one of its attributes is used. The
+    command line scripts import pypgTAP for every invocation, most of which
+    never touch postgres, so they don't pay for importing its heavy
+    dependencies upfront:
+
+    >>> psyc = LazyModule('psycopg2')  # Instead of import psycopg2 as psyc
+    >>> psyc.connect(dbname='foo')  # psycopg2 is imported here
+    """
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute):
+        if self.__module is None:
+            self.__module = importlib.import_module(self.__name)
+        return getattr(self.__module, attribute)
+
+
+pkg_resources = LazyModule('pkg_resources')
+psyc = LazyModule('psycopg2')
+extensions = LazyModule('psycopg2.extensions')
 
 PG_HARNESS_DATA_DIR = os.path.join(
         tempfile.gettempdir(),
         '__rs_tap_process_flags')
 
+# Freshly initialized and bootstrapped clusters are cached here, see
+# postgres_env.start_postgres_harness
+PG_HARNESS_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(),
+        '__pypgtap_cluster_cache')
+
+# Set to the root dir of an isolated harness to make it the current harness,
+# see current_harness()
+PYPGTAP_HARNESS_ENV = 'PYPGTAP_HARNESS'
+
+# The most connections ConnectionPool keeps open per harness, database and user
+DEFAULT_POOL_SIZE = 4
+# A pooled connection idle for longer than this many seconds is checked with a
+# query before it's handed out again
+POOL_HEALTH_CHECK_AFTER = 10
+
 _logger = logging.getLogger(__name__)
 
 
+class Harness(object):
+    """
+    Where a harness keeps its cluster and how clients connect to it. The
+    default harness is the classic one that lives in PG_HARNESS_DATA_DIR and
+    listens on the default port; Clients connect to it with the libpq
+    defaults, so only one of them can run on a host.
+
+    An isolated harness made by allocate() has its own data dir, port and
+    socket directory, all of them picked automatically, so any number of them
+    can run side by side. Its settings are saved in its root dir so that other
+    processes can load() it:
+
+    >>> harness = Harness.allocate()
+    >>> start_postgres_harness(harness=harness)
+    >>> os.environ[PYPGTAP_HARNESS_ENV] = harness.root_dir  # For the children
+    """
+    SETTINGS_FILE = 'harness.json'
+
+    def __init__(self, data_dir, port=None, socket_dir='/tmp', root_dir=None):
+        """
+        :param str data_dir: The data dir of the cluster.
+        :param int port: The port the server listens on. None for the default
+            port and libpq default connection settings.
+        :param str socket_dir: The directory of the server's unix socket.
+        :param str root_dir: The directory holding everything that belongs to
+            an isolated harness. None for the default harness.
+        """
+        self.data_dir = data_dir
+        self.port = port
+        self.socket_dir = socket_dir
+        self.root_dir = root_dir
+
+    @classmethod
+    def default(cls):
+        return cls(PG_HARNESS_DATA_DIR)
+
+    @classmethod
+    def allocate(cls, root_dir=None):
+        """
+        Make an isolated harness with a fresh root dir and a free port.
+
+        :param str root_dir: The root dir to use instead of a fresh one. It's
+            created if it does not exist.
+        """
+        if root_dir is None:
+            root_dir = tempfile.mkdtemp(prefix='__pypgtap_harness_')
+        elif not os.path.exists(root_dir):
+            os.makedirs(root_dir)
+        harness = cls(
+            os.path.join(root_dir, 'data'), port=_get_free_port(),
+            socket_dir=root_dir, root_dir=root_dir)
+        with open(os.path.join(root_dir, cls.SETTINGS_FILE), 'w') as f:
+            json.dump(
+                {'data_dir': harness.data_dir, 'port': harness.port,
+                 'socket_dir': harness.socket_dir}, f)
+        return harness
+
+    @classmethod
+    def load(cls, root_dir):
+        """
+        Load the isolated harness in root_dir.
+
+        :raises IOError: If root_dir is not the root dir of a harness
+        """
+        with open(os.path.join(root_dir, cls.SETTINGS_FILE)) as f:
+            settings = json.load(f)
+        return cls(
+            str(settings['data_dir']), port=settings['port'],
+            socket_dir=str(settings['socket_dir']), root_dir=root_dir)
+
+    def server_options(self):
+        """
+        The options of the postgres process, for pg_ctl start -o
+        """
+        options = '-h localhost -k {}'.format(self.socket_dir)
+        if self.port is not None:
+            options += ' -p {}'.format(self.port)
+        return options
+
+    def client_args(self):
+        """
+        The arguments for client programs like psql. Empty for the default
+        harness.
+
+        :rtype: list[str]
+        """
+        if self.port is None:
+            return []
+        return ['-h', self.socket_dir, '-p', str(self.port)]
+
+    def connect_kwargs(self):
+        """
+        The keyword arguments for psycopg2.connect. Empty for the default
+        harness.
+
+        :rtype: dict
+        """
+        if self.port is None:
+            return {}
+        return {'host': self.socket_dir, 'port': self.port}
+
+    def __eq__(self, other):
+        return isinstance(other, Harness) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Harness(data_dir={!r}, port={!r})'.format(
+            self.data_dir, self.port)
+
+
+def current_harness():
+    """
+    The harness named by the PYPGTAP_HARNESS environment variable or else the
+    default one.
+
+    :rtype: Harness
+    """
+    root_dir = os.environ.get(PYPGTAP_HARNESS_ENV)
+    if root_dir:
+        return Harness.load(root_dir)
+    return Harness.default()
+
+
+def _get_free_port():
+    """
+    A port that nothing listens on right now.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
 def pre_create_harness_data_dir(f):
     """
-    Use as a decorator for pre creating the PG_HARNESS_DATA_DIR
+    Use as a decorator for pre creating the data dir of the harness, the
+    harness keyword argument of f. If it's None the current_harness() is
+    passed to f instead.
 
         :param function f: The wrapped function.
     """
     @wraps(f)
     def inner(*args, **kwargs):
-        if not os.path.exists(PG_HARNESS_DATA_DIR):
-            os.makedirs(PG_HARNESS_DATA_DIR)
+        harness = kwargs.get('harness') or current_harness()
+        kwargs['harness'] = harness
+        if not os.path.exists(harness.data_dir):
+            os.makedirs(harness.data_dir)
         return f(*args, **kwargs)
     return inner
 
 
+def get_glue_hash():
+    """
+    A hash of the pypgTAP glue sql scripts, in pypgtap.core.glue. Anything that
+    was bootstrapped with a glue that has a different hash is stale.
+
+    :return: The hex digest of the scripts
+    :rtype: str
+    """
+    sha = hashlib.sha1()
+    for script in sorted(pkg_resources.resource_listdir('pypgtap.core', 'glue')):
+        if script.endswith('.sql'):
+            sha.update(script)
+            sha.update(pkg_resources.resource_string('pypgtap.core.glue', script))
+    return sha.hexdigest()
+
+
+def write_json_atomically(path, data):
+    """
+    Writes data as JSON to path. It's written aside, in the directory of path,
+    and renamed so that a reader never sees half of it.
+
+    :raises IOError, OSError: If it can't be written, path is then untouched.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+class ConnectionPool(object):
+    """
+    A pool of psycopg2 connections keyed by harness, database and user. A
+    connection is handed out to one caller at a time and comes back reset to
+    the session defaults, with no transaction open:
+
+    >>> with CONNECTION_POOL.connection('my_db', 'me', harness) as conn:
+    ...     with conn.cursor() as cursor:
+    ...         cursor.execute('SELECT 1')
+
+    Up to max_size connections are open per key; Callers beyond that wait for
+    one to come back, for at most timeout seconds. A connection that has been
+    idle for a while is checked with a query before it's handed out, and a
+    broken one is replaced.
+
+    Postgres won't clone or drop a database while there are connections to
+    it, so close() the idle ones first. postgres_env does that for the
+    databases it clones and drops.
+
+    *Thread Safe*
+    """
+
+    def __init__(self, max_size=DEFAULT_POOL_SIZE, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+        # key -> [(connection, time it was returned)]
+        self._idle = {}
+        # key -> number of connections handed out
+        self._in_use = {}
+        self._condition = threading.Condition()
+
+    @staticmethod
+    def _key(dbname, user, harness):
+        return (harness.data_dir, harness.port, harness.socket_dir, dbname,
+                user)
+
+    def getconn(self, dbname, user, harness):
+        """
+        :return: A connection to dbname of the harness. Give it back with
+            putconn().
+        :raises EnvironmentError: If no connection came back in time.
+        """
+        key = self._key(dbname, user, harness)
+        deadline = time.time() + self.timeout
+        with self._condition:
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    conn, returned = idle.pop()
+                    break
+                if self._in_use.get(key, 0) + len(idle or ()) < self.max_size:
+                    conn = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise EnvironmentError(
+                        'No connection to {} was returned in {}s'.format(
+                            dbname, self.timeout))
+                self._condition.wait(remaining)
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        try:
+            if conn is not None and not self._is_healthy(conn, returned):
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = psyc.connect(
+                    dbname=dbname, user=user, **harness.connect_kwargs())
+        except BaseException:
+            self._release(key)
+            raise
+        return conn
+
+    def putconn(self, conn, dbname, user, harness):
+        """
+        Gives a connection of getconn() back. Its transaction is rolled back
+        and its session reset; It's closed if that fails or the pool has
+        enough idle connections.
+        """
+        key = self._key(dbname, user, harness)
+        try:
+            if not conn.closed:
+                conn.reset()
+        except psyc.Error:
+            _logger.debug('Discarding a broken connection to %s', dbname)
+            conn.close()
+        with self._condition:
+            idle = self._idle.setdefault(key, [])
+            if conn.closed or len(idle) >= self.max_size:
+                conn.close()
+            else:
+                idle.append((conn, time.time()))
+        self._release(key)
+
+    def _release(self, key):
+        with self._condition:
+            self._in_use[key] -= 1
+            self._condition.notify()
+
+    def _is_healthy(self, conn, returned):
+        if conn.closed or (conn.get_transaction_status()
+                           != extensions.TRANSACTION_STATUS_IDLE):
+            return False
+        if time.time() - returned < POOL_HEALTH_CHECK_AFTER:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psyc.Error:
+            return False
+
+    @contextmanager
+    def connection(self, dbname, user, harness):
+        """
+        A connection of getconn() that's given back on exit.
+        """
+        conn = self.getconn(dbname, user, harness)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn, dbname, user, harness)
+
+    def close(self, dbname=None, harness=None):
+        """
+        Closes the idle connections, all of them or those to dbname and/or of
+        the harness. Connections that are handed out are not affected.
+        """
+        with self._condition:
+            for key in self._idle.keys():
+                if harness is not None and key[:3] != self._key(
+                        None, None, harness)[:3]:
+                    continue
+                if dbname is not None and key[3] != dbname:
+                    continue
+                for conn, _ in self._idle.pop(key):
+                    conn.close()
+
+
+# The pool of the ExecuteQueryHelper connections
+CONNECTION_POOL = ConnectionPool()
+
+
 class ExecuteQueryHelper(object):
     """
     A Convenient decorator that manages the closing and opening of connection to
@@ -40,6 +403,18 @@ class ExecuteQueryHelper(object):
 
     psycopg.connect('dbname=%s user=%s'.format(user_name, user_name))
     By default the user name is chosen to be the USER environment variable.
+
+    The decorated function also accepts optional dbname and harness keyword
+    arguments that are consumed by the decorator to connect to a database
+    other than the default one; For example a database cloned from the pypgTAP
+    template in an isolated harness:
+
+    >>> manager.get_project_dir(dbname='pypgtap_template_1', harness=harness)
+
+    When harness is None the current_harness() is used.
+
+    The connections come from the CONNECTION_POOL, so the decorated functions
+    don't pay for connecting every time they are called.
     """
     def __init__(self, user_name=None):
         self.user_name = os.environ.get('USER', user_name)
@@ -55,10 +430,12 @@ class ExecuteQueryHelper(object):
         update_wrapper(self, function)
 
         def wrapped_f(*args, **kwargs):
+            dbname = kwargs.pop('dbname', None) or self.user_name
+            harness = kwargs.pop('harness', None) or current_harness()
             _logger.debug("Starting execute of %s" % (self.function.__name__))
             try:
-                with psyc.connect('dbname={} user={}'.format(
-                        self.user_name, self.user_name)) as conn:
+                with CONNECTION_POOL.connection(
+                        dbname, self.user_name, harness) as conn:
                     with conn.cursor() as cursor:
                         res = self.function(*args, cursor=cursor, **kwargs)
                         conn.commit()
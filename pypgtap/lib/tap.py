@@ -1,7 +1,7 @@
 #
 # TAP.py - TAP parser
 #
-# A pyparsing parser to process the output of the Perl
+# A line oriented parser to process the output of the Perl
 #   "Test Anything Protocol"
 #   (http://search.cpan.org/~petdance/TAP-1.00/TAP.pm)
 #
@@ -19,55 +19,50 @@
 #   Bail out!
 # optionally followed by a reason for bailing
 #
+# The TAPTest and TAPSummary classes are from the pyparsing TAP parser,
 # Copyright 2008, by Paul McGuire
 # Borrowed from pyparsing wiki:
 # https://pyparsing.wikispaces.com/file/detail/TAP.py
+#
+# The pyparsing grammar itself is in tap_grammar.py. It's too slow for the
+# tens of thousands of assertions a data quality test emits, so the
+# tapOutputParser here looks at one line at a time instead. It gives the same
+# results on the output of the grammar's examples, but unlike the grammar it
+# skips the lines it does not understand instead of giving up on the rest of
+# the output, and it allows a '#' in a description when escaped as '\#' like
+# pgTAP does.
 
-from pyparsing import ParserElement, LineEnd, Optional, Word, nums, Regex, \
-    Literal, CaselessLiteral, Group, OneOrMore, Suppress, restOfLine, \
-    FollowedBy, empty
-
-__all__ = ['tapOutputParser', 'TAPTest', 'TAPSummary']
-
-# newlines are significant whitespace, so set default skippable
-# whitespace to just spaces and tabs
-ParserElement.setDefaultWhitespaceChars(" \t")
-NL = LineEnd().suppress()
-
-integer = Word(nums)
-plan = '1..' + integer("ubound")
-
-OK, NOT_OK = map(Literal, ['ok', 'not ok'])
-testStatus = (OK | NOT_OK)
-
-description = Regex("[^#\n]+")
-description.setParseAction(lambda t: t[0].lstrip('- '))
+from collections import namedtuple
+import re
 
-TODO, SKIP = map(CaselessLiteral, 'TODO SKIP'.split())
-directive = Group(Suppress('#') + (TODO + restOfLine |
-    FollowedBy(SKIP) +
-        restOfLine.copy().setParseAction(lambda t: ['SKIP', t[0]])))
+__all__ = ['tapOutputParser', 'TAPParser', 'TAPParseError', 'TAPTest',
+           'TAPSummary', 'TAPAggregate', 'TestLine', 'BailLine']
 
+# A parsed "ok"/"not ok" line. The number is None when the line has none and
+# the directive is one of 'TODO', 'SKIP' or None.
+TestLine = namedtuple('TestLine', 'passed number directive')
+# A parsed "Bail out!" line
+BailLine = namedtuple('BailLine', 'reason')
 
-commentLine = Suppress("#") + empty + restOfLine
+_NUMBER = re.compile(r'[ \t]*(\d*)')
+_PLAN = re.compile(r'1\.\.(\d+)')
 
-testLine = Group(
-    Optional(OneOrMore(commentLine + NL))("comments") +
-    testStatus("passed") +
-    Optional(integer)("testNumber") +
-    Optional(description)("description") +
-    Optional(directive)("directive")
-)
-bailLine = Group(Literal("Bail out!")("BAIL") +
-                    empty + Optional(restOfLine)("reason"))
 
-tapOutputParser = Optional(Group(plan)("plan") + NL) & \
-            Group(OneOrMore((testLine | bailLine) + NL))("tests")
+class TAPParseError(ValueError):
+    """
+    Raised when there is no TAP in the output.
+    """
 
 
 class TAPTest(object):
 
+    __slots__ = ('num', 'passed', 'skipped', 'todo')
+
     def __init__(self, results):
+        """
+        :param results: The pyparsing results of a test line of the grammar
+            in tap_grammar.py. See fromLine() for the others.
+        """
         self.num = results.testNumber
         self.passed = (results.passed == "ok")
         self.skipped = self.todo = False
@@ -75,48 +70,86 @@ class TAPTest(object):
             self.skipped = (results.directive[0][0] == 'SKIP')
             self.todo = (results.directive[0][0] == 'TODO')
 
+    @classmethod
+    def fromLine(cls, num, passed=True, directive=None):
+        """
+        :param int num: The number of the test.
+        :param bool passed: If the test passed.
+        :param str directive: 'TODO', 'SKIP' or None, like in a TestLine.
+        """
+        test = cls.__new__(cls)
+        test.num = num
+        test.passed = passed
+        test.skipped = (directive == 'SKIP')
+        test.todo = (directive == 'TODO')
+        return test
+
     @classmethod
     def bailedTest(cls, num):
-        ret = TAPTest(empty.parseString(""))
-        ret.num = num
-        ret.skipped = True
-        return ret
+        return cls.fromLine(num, passed=False, directive='SKIP')
 
 
 class TAPSummary(object):
 
     def __init__(self, results):
+        """
+        :param results: The pyparsing results of the grammar in
+            tap_grammar.py. See fromLines() for the others.
+        """
+        lines = []
+        for res in results.tests:
+            if res.BAIL:
+                lines.append(BailLine(res.reason))
+                continue
+            directive = None
+            if res.directive:
+                directive = res.directive[0][0]
+            lines.append(TestLine(
+                res.passed == "ok",
+                int(res.testNumber) if res.testNumber != "" else None,
+                directive))
+        self._summarize(
+            lines, int(results.plan.ubound) if results.plan else None)
+
+    @classmethod
+    def fromLines(cls, lines, ubound=None):
+        """
+        :param list lines: The TestLine and BailLine of the output in order.
+        :param int ubound: The n of the 1..n plan, if there was one.
+        :rtype: TAPSummary
+        """
+        summary = cls.__new__(cls)
+        summary._summarize(lines, ubound)
+        return summary
+
+    def _summarize(self, lines, ubound):
         self.passedTests = []
         self.failedTests = []
         self.skippedTests = []
         self.todoTests = []
         self.bonusTests = []
         self.bail = False
-        if results.plan:
-            expected = range(1, int(results.plan.ubound) + 1)
+        if ubound is not None:
+            expected = range(1, ubound + 1)
         else:
-            expected = range(1, len(results.tests) + 1)
+            expected = range(1, len(lines) + 1)
 
-        for i, res in enumerate(results.tests):
+        for i, res in enumerate(lines):
             # test for bail out
-            if res.BAIL:
-                #~ print "Test suite aborted: " + res.reason
-                #~ self.failedTests += expected[i:]
+            if isinstance(res, BailLine):
                 self.bail = True
                 self.skippedTests += [TAPTest.bailedTest(ii)
                                                          for ii in expected[i:]]
                 self.bailReason = res.reason
                 break
 
-            #~ print res.dump()
             testnum = i + 1
-            if res.testNumber != "":
-                if testnum != int(res.testNumber):
-                    print "ERROR! test %(testNumber)s out of sequence" % res
-                testnum = int(res.testNumber)
-            res["testNumber"] = testnum
+            if res.number is not None:
+                if testnum != res.number:
+                    print "ERROR! test %s out of sequence" % res.number
+                testnum = res.number
 
-            test = TAPTest(res)
+            test = TAPTest.fromLine(testnum, res.passed, res.directive)
             if test.passed:
                 self.passedTests.append(test)
             else:
@@ -128,8 +161,8 @@ class TAPSummary(object):
             if test.todo and test.passed:
                 self.bonusTests.append(test)
 
-        self.passedSuite = not self.bail and (
-            set(self.failedTests) - set(self.todoTests) == set())
+        self.passedSuite = not self.bail and all(
+            test.todo for test in self.failedTests)
 
     def summary(self, showPassed=False, showAll=False):
         testListStr = lambda tl: "[" + ", ".join(str(t.num) for t in tl) + "]"
@@ -150,9 +183,246 @@ class TAPSummary(object):
             summaryText.append("FAILED")
         return "\n".join(summaryText)
 
-# create TAPSummary objects from tapOutput parsed results, by setting
-# class as parse action
-tapOutputParser.setParseAction(TAPSummary)
+
+def parseLine(line):
+    """
+    Parses one line of TAP output.
+
+    :param str line: The line, with or without its line end.
+    :return: A TestLine, a BailLine, the int n of a 1..n plan or None if the
+        line is none of those, like a comment.
+    """
+    line = line.lstrip(' \t')
+    if line.startswith('ok'):
+        passed, rest = True, line[2:]
+    elif line.startswith('not ok'):
+        passed, rest = False, line[6:]
+    elif line.startswith('Bail out!'):
+        return BailLine(line[9:].strip(' \t\r\n'))
+    elif line.startswith('1..'):
+        plan = _PLAN.match(line)
+        return int(plan.group(1)) if plan else None
+    else:
+        return None
+    number = _NUMBER.match(rest)
+    directive = None
+    hash_index = rest.find('#', number.end())
+    # pgTAP escapes the '#' in descriptions
+    while hash_index > 0 and rest[hash_index - 1] == '\\':
+        hash_index = rest.find('#', hash_index + 1)
+    if hash_index != -1:
+        directive = rest[hash_index + 1:].lstrip(' \t')[:4].upper()
+        if directive not in ('TODO', 'SKIP'):
+            directive = None
+    return TestLine(
+        passed, int(number.group(1)) if number.group(1) else None, directive)
+
+
+class TAPParser(object):
+    """
+    Parses TAP output into a TAPSummary:
+
+    >>> tapOutputParser.parseString(output)[0].passedSuite
+
+    Only the first plan counts and the lines that are not TAP are skipped.
+    """
+
+    def parseString(self, tapOutput):
+        """
+        :param str tapOutput: The TAP output.
+        :return: A list with the TAPSummary, like a pyparsing parser returns.
+        :rtype: list[TAPSummary]
+        :raises TAPParseError: If there are no test lines in the output.
+        """
+        return [self.parseLines(tapOutput.splitlines())]
+
+    def parseLines(self, lines):
+        """
+        :param iterable lines: The lines of TAP output, for example an open
+            file.
+        :rtype: TAPSummary
+        :raises TAPParseError: If there are no test lines in lines.
+        """
+        tests = []
+        ubound = None
+        for line in lines:
+            parsed = parseLine(line)
+            if parsed is None:
+                continue
+            if isinstance(parsed, int):
+                if ubound is None:
+                    ubound = parsed
+            else:
+                tests.append(parsed)
+        if not tests:
+            raise TAPParseError('No TAP test lines found')
+        return TAPSummary.fromLines(tests, ubound)
+
+
+tapOutputParser = TAPParser()
+
+
+class _OutputState(object):
+    """
+    What TAPAggregate needs to remember about an output it's still reading.
+    """
+
+    __slots__ = ('index', 'ubound', 'bailIndex', 'afterBail')
+
+    def __init__(self):
+        self.index = 0
+        self.ubound = None
+        self.bailIndex = None
+        self.afterBail = 0
+
+
+class TAPAggregate(object):
+    """
+    The results of any number of TAP outputs, in memory that does not grow
+    with the number of passing tests. Every test is counted but only the
+    failed, todo and skipped ones are kept, as (source, TAPTest) pairs where
+    source names the output they came from, typically the test file. The
+    counts agree with the ones of a TAPSummary of each output.
+
+    Lines are added as they arrive, the outputs of different sources can be
+    interleaved:
+
+    >>> aggregate = TAPAggregate()
+    >>> for line in output:
+    ...     aggregate.addLine(line, source='test_a.sql')
+    >>> aggregate.closeAll()
+    >>> total.merge(aggregate)
+
+    *Not Thread Safe*
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.passed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.todo = 0
+        self.bonus = 0
+        # The failed tests that were not todo
+        self.unexpectedFailures = 0
+        self.failedTests = []
+        self.skippedTests = []
+        self.todoTests = []
+        # (source, reason) of each bail out
+        self.bails = []
+        self._outputs = {}
+
+    @property
+    def passedSuite(self):
+        return not self.bails and self.unexpectedFailures == 0
+
+    def addLine(self, line, source=None):
+        """
+        Adds a line of the output of source.
+        """
+        parsed = parseLine(line)
+        if parsed is None:
+            return
+        state = self._outputs.get(source)
+        if state is None:
+            state = self._outputs[source] = _OutputState()
+        if isinstance(parsed, int):
+            if state.ubound is None:
+                state.ubound = parsed
+            return
+        if state.bailIndex is not None:
+            state.afterBail += 1
+            return
+        if isinstance(parsed, BailLine):
+            state.bailIndex = state.index
+            self.bails.append((source, parsed.reason))
+            return
+        state.index += 1
+        self.total += 1
+        if parsed.passed and parsed.directive is None:
+            self.passed += 1
+            return
+        test = TAPTest.fromLine(
+            state.index if parsed.number is None else parsed.number,
+            parsed.passed, parsed.directive)
+        if test.passed:
+            self.passed += 1
+        else:
+            self.failed += 1
+            self.failedTests.append((source, test))
+            if not test.todo:
+                self.unexpectedFailures += 1
+        if test.skipped:
+            self.skipped += 1
+            self.skippedTests.append((source, test))
+        if test.todo:
+            self.todo += 1
+            self.todoTests.append((source, test))
+            if test.passed:
+                self.bonus += 1
+
+    def addLines(self, lines, source=None):
+        """
+        Adds all the lines of the output of source and closes it.
+        """
+        for line in lines:
+            self.addLine(line, source)
+        self.close(source)
+
+    def close(self, source=None):
+        """
+        Marks the output of source as complete. The tests a bail out left
+        unrun are counted as skipped, which needs the plan that may be at the
+        end of the output.
+        """
+        state = self._outputs.pop(source, None)
+        if state is None or state.bailIndex is None:
+            return
+        if state.ubound is not None:
+            expected = state.ubound
+        else:
+            expected = state.bailIndex + 1 + state.afterBail
+        self.skipped += max(0, expected - state.bailIndex)
+
+    def closeAll(self):
+        for source in self._outputs.keys():
+            self.close(source)
+
+    def merge(self, other):
+        """
+        Adds the results of the other TAPAggregate, whose outputs are all
+        closed first.
+        """
+        other.closeAll()
+        for name in ('total', 'passed', 'failed', 'skipped', 'todo', 'bonus',
+                     'unexpectedFailures'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.failedTests.extend(other.failedTests)
+        self.skippedTests.extend(other.skippedTests)
+        self.todoTests.extend(other.todoTests)
+        self.bails.extend(other.bails)
+
+    def summary(self):
+        testListStr = lambda tl: "[" + ", ".join(
+            "%s:%s" % (source, t.num) if source is not None else str(t.num)
+            for source, t in tl) + "]"
+        summaryText = ["TESTS: %d PASSED: %d FAILED: %d SKIPPED: %d "
+                       "TODO: %d BONUS: %d" % (
+                           self.total, self.passed, self.failed, self.skipped,
+                           self.todo, self.bonus)]
+        if self.failedTests:
+            summaryText.append("FAILED: %s" % testListStr(self.failedTests))
+        if self.skippedTests:
+            summaryText.append("SKIPPED: %s" % testListStr(self.skippedTests))
+        if self.todoTests:
+            summaryText.append("TODO: %s" % testListStr(self.todoTests))
+        for source, reason in self.bails:
+            summaryText.append("BAILED OUT: %s %s" % (source or '', reason))
+        if self.passedSuite:
+            summaryText.append("PASSED")
+        else:
+            summaryText.append("FAILED")
+        return "\n".join(summaryText)
 
 if __name__ == "__main__":
     test1 = """\
@@ -172,56 +442,20 @@ if __name__ == "__main__":
         ok
         """
     test3 = """\
-        ok - created Board
-        ok
-        ok
-        not ok
-        ok
-        ok
-        ok
-        ok
-        # +------+------+------+------+
-        # |      |16G   |      |05C   |
-        # |      |G N C |      |C C G |
-        # |      |  G   |      |  C  +|
-        # +------+------+------+------+
-        # |10C   |01G   |      |03C   |
-        # |R N G |G A G |      |C C C |
-        # |  R   |  G   |      |  C  +|
-        # +------+------+------+------+
-        # |      |01G   |17C   |00C   |
-        # |      |G A G |G N R |R N R |
-        # |      |  G   |  R   |  G   |
-        # +------+------+------+------+
-        ok - board has 7 tiles + starter tile
-        1..9
-        """
-    test4 = """\
         1..4
         ok 1 - Creating test program
         ok 2 - Test program runs, no error
         not ok 3 - infinite loop # TODO halting problem unsolved
         not ok 4 - infinite loop 2 # TODO halting problem unsolved
         """
-    test5 = """\
+    test4 = """\
         1..20
         ok - database handle
         not ok - failed database login
         Bail out! Couldn't connect to database.
         """
-    test6 = """\
-        ok 1 - retrieving servers from the database
-        # need to ping 6 servers
-        ok 2 - pinged diamond
-        ok 3 - pinged ruby
-        not ok 4 - pinged sapphire
-        ok 5 - pinged onyx
-        not ok 6 - pinged quartz
-        ok 7 - pinged gold
-        1..7
-        """
 
-    for test in (test1,test2,test3,test4,test5,test6):
+    for test in (test1, test2, test3, test4):
         print test
         tapResult = tapOutputParser.parseString(test)[0]
         print tapResult.summary()
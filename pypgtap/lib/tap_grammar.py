@@ -0,0 +1,168 @@
+#
+# TAP.py - TAP parser
+#
+# A pyparsing parser to process the output of the Perl
+#   "Test Anything Protocol"
+#   (http://search.cpan.org/~petdance/TAP-1.00/TAP.pm)
+#
+# TAP output lines are preceded or followed by a test number range:
+#   1..n
+# with 'n' TAP output lines.
+#
+# The general format of a TAP output line is:
+#   ok/not ok (required)
+#   Test number (recommended)
+#   Description (recommended)
+#   Directive (only when necessary)
+#
+# A TAP output line may also indicate abort of the test suit with the line:
+#   Bail out!
+# optionally followed by a reason for bailing
+#
+# Copyright 2008, by Paul McGuire
+# Borrowed from pyparsing wiki:
+# https://pyparsing.wikispaces.com/file/detail/TAP.py
+#
+# This is the original grammar. It's kept to check and benchmark the line
+# oriented tap.tapOutputParser against, use that one instead.
+
+from pypgtap.lib.tap import TAPSummary
+
+__all__ = ['tapOutputParser']
+
+
+def _buildGrammar():
+    """
+    Builds the grammar. Importing pyparsing and building it is too slow to do
+    for every import of this module, so it's only done on first use of
+    tapOutputParser.
+    """
+    from pyparsing import ParserElement, LineEnd, Optional, Word, nums, \
+        Regex, Literal, CaselessLiteral, Group, OneOrMore, Suppress, \
+        restOfLine, FollowedBy, empty
+
+    # newlines are significant whitespace, so set default skippable
+    # whitespace to just spaces and tabs
+    ParserElement.setDefaultWhitespaceChars(" \t")
+    NL = LineEnd().suppress()
+
+    integer = Word(nums)
+    plan = '1..' + integer("ubound")
+
+    OK, NOT_OK = map(Literal, ['ok', 'not ok'])
+    testStatus = (OK | NOT_OK)
+
+    description = Regex("[^#\n]+")
+    description.setParseAction(lambda t: t[0].lstrip('- '))
+
+    TODO, SKIP = map(CaselessLiteral, 'TODO SKIP'.split())
+    directive = Group(Suppress('#') + (TODO + restOfLine |
+        FollowedBy(SKIP) +
+            restOfLine.copy().setParseAction(lambda t: ['SKIP', t[0]])))
+
+    commentLine = Suppress("#") + empty + restOfLine
+
+    testLine = Group(
+        Optional(OneOrMore(commentLine + NL))("comments") +
+        testStatus("passed") +
+        Optional(integer)("testNumber") +
+        Optional(description)("description") +
+        Optional(directive)("directive")
+    )
+    bailLine = Group(Literal("Bail out!")("BAIL") +
+                        empty + Optional(restOfLine)("reason"))
+
+    parser = Optional(Group(plan)("plan") + NL) & \
+                Group(OneOrMore((testLine | bailLine) + NL))("tests")
+
+    # create TAPSummary objects from tapOutput parsed results, by setting
+    # class as parse action
+    parser.setParseAction(TAPSummary)
+    return parser
+
+
+class _LazyGrammar(object):
+    """
+    Stands in for the grammar until it's used.
+    """
+    _grammar = None
+
+    def __getattr__(self, name):
+        if _LazyGrammar._grammar is None:
+            _LazyGrammar._grammar = _buildGrammar()
+        return getattr(_LazyGrammar._grammar, name)
+
+tapOutputParser = _LazyGrammar()
+
+if __name__ == "__main__":
+    test1 = """\
+        1..4
+        ok 1 - Input file opened
+        not ok 2 - First line of the input valid
+        ok 3 - Read the rest of the file
+        not ok 4 - Summarized correctly # TODO Not written yet
+        """
+    test2 = """\
+        ok 1
+        not ok 2 some description # TODO with a directive
+        ok 3 a description only, no directive
+        ok 4 # TODO directive only
+        ok a description only, no directive
+        ok # Skipped only a directive, no description
+        ok
+        """
+    test3 = """\
+        ok - created Board
+        ok
+        ok
+        not ok
+        ok
+        ok
+        ok
+        ok
+        # +------+------+------+------+
+        # |      |16G   |      |05C   |
+        # |      |G N C |      |C C G |
+        # |      |  G   |      |  C  +|
+        # +------+------+------+------+
+        # |10C   |01G   |      |03C   |
+        # |R N G |G A G |      |C C C |
+        # |  R   |  G   |      |  C  +|
+        # +------+------+------+------+
+        # |      |01G   |17C   |00C   |
+        # |      |G A G |G N R |R N R |
+        # |      |  G   |  R   |  G   |
+        # +------+------+------+------+
+        ok - board has 7 tiles + starter tile
+        1..9
+        """
+    test4 = """\
+        1..4
+        ok 1 - Creating test program
+        ok 2 - Test program runs, no error
+        not ok 3 - infinite loop # TODO halting problem unsolved
+        not ok 4 - infinite loop 2 # TODO halting problem unsolved
+        """
+    test5 = """\
+        1..20
+        ok - database handle
+        not ok - failed database login
+        Bail out! Couldn't connect to database.
+        """
+    test6 = """\
+        ok 1 - retrieving servers from the database
+        # need to ping 6 servers
+        ok 2 - pinged diamond
+        ok 3 - pinged ruby
+        not ok 4 - pinged sapphire
+        ok 5 - pinged onyx
+        not ok 6 - pinged quartz
+        ok 7 - pinged gold
+        1..7
+        """
+
+    for test in (test1,test2,test3,test4,test5,test6):
+        print test
+        tapResult = tapOutputParser.parseString(test)[0]
+        print tapResult.summary()
+        print
@@ -0,0 +1,67 @@
+"""
+The purpose of this script is to manage the harness daemon, a long lived
+harness that leases databases to test runs. See
+pypgtap.core.test_kit.harness_daemon for details.
+
+$ harness_daemon start      # In the background, returns once it's ready
+$ run_all_tests --daemon -w my_project
+$ harness_daemon status
+$ harness_daemon stop
+
+run serves in the foreground, which is what start runs in the background.
+"""
+import json
+import logging
+from optparse import OptionParser
+
+from pypgtap.core.test_kit.harness_daemon import DAEMON_ROOT_DIR, \
+    DEFAULT_SPARES, HarnessDaemon, daemon_request, start_daemon, stop_daemon
+
+_COMMANDS = ('start', 'stop', 'status', 'run')
+
+
+def get_cli_options():
+    """
+    Returns the result of parser.parse_args() where parser is of type
+    OptionParser.
+    """
+    usage = "usage: %prog [options] {}".format('|'.join(_COMMANDS))
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+        "--root-dir", dest="root_dir", default=DAEMON_ROOT_DIR,
+        help='where the daemon keeps its socket, log and harness.')
+    parser.add_option(
+        "--spares", dest="spares", default=DEFAULT_SPARES, type="int",
+        help='the number of databases kept ready to be leased.')
+    parser.add_option(
+        "--idle-timeout", dest="idle_timeout", default=None, type="int",
+        help='stop after this many seconds without leases.')
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in _COMMANDS:
+        parser.error('expected one of {}'.format(', '.join(_COMMANDS)))
+    return options, args
+
+
+def main():
+    options, args = get_cli_options()
+    command = args[0]
+    if command == 'start':
+        start_daemon(
+            options.root_dir, spares=options.spares,
+            idle_timeout=options.idle_timeout)
+    elif command == 'stop':
+        stop_daemon(options.root_dir)
+    elif command == 'status':
+        print json.dumps(
+            daemon_request({'op': 'status'}, options.root_dir), indent=2)
+    else:
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+        HarnessDaemon(
+            options.root_dir, spares=options.spares,
+            idle_timeout=options.idle_timeout).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+The purpose of this script is to load JSON lines fixtures into a table from
+the client side, with a pool of processes parsing the file and COPY FROM STDIN
+loading it. See pypgtap.core.test_kit.json_loader.load_json for details.
+
+The paths are relative to the project directory of the database. psql test
+scripts stream the rows into their own transaction with \\copy, the script
+writing them to stdout, in the order of the JSONPath expressions:
+
+\\copy events (id, name) FROM PROGRAM 'load_json --stdout ev.json paths.json'
+
+They can also call it with \\! because PyPGTAPTestManager runs psql with
+PGDATABASE set to the database of the test. It then loads in a transaction of
+its own, which commits, so the table must be committed and the rows are not
+rolled back with the test:
+
+\\! load_json public events fixtures/events.json fixtures/events_jsonpaths.json
+"""
+from optparse import OptionParser
+import sys
+
+from pypgtap.core.test_kit.json_loader import load_json, write_json_rows, \
+    DEFAULT_CHUNK_SIZE
+
+
+def get_cli_options():
+    """
+    Returns the result of parser.parse_args() where parser is of type
+    OptionParser.
+    """
+    usage = ("usage: %prog [options] schema table json_file json_path_file\n"
+             "       %prog [options] --stdout json_file json_path_file")
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+        "-d", "--dbname", dest="dbname", default=None,
+        help='the database of the table. default is $PGDATABASE.')
+    parser.add_option(
+        "-p", "--project-dir", dest="project_path", default=None,
+        help=(
+            'the directory the files are relative to. default is the project '
+            'directory of the database or else the working directory.'))
+    parser.add_option(
+        "-j", "--processes", dest="processes", default=None, type="int",
+        help='the number of processes parsing the file. default is one per core.')
+    parser.add_option(
+        "--chunk-size", dest="chunk_size", default=DEFAULT_CHUNK_SIZE,
+        type="int", help='the bytes a process parses at a time.')
+    parser.add_option(
+        "--stdout", dest="stdout", default=False,
+        help=(
+            'write the rows to stdout in the text format of COPY instead of '
+            'loading them, for psql\'s \\copy ... FROM PROGRAM.'),
+        action="store_true")
+    options, args = parser.parse_args()
+    if options.stdout and len(args) != 2:
+        parser.error('expected json_file json_path_file')
+    if not options.stdout and len(args) != 4:
+        parser.error('expected schema table json_file json_path_file')
+    return options, args
+
+
+def main():
+    options, args = get_cli_options()
+    if options.stdout:
+        json_file, json_path_file = args
+        write_json_rows(
+            json_file, json_path_file, sys.stdout, dbname=options.dbname,
+            project_path=options.project_path, processes=options.processes,
+            chunk_size=options.chunk_size)
+        return
+    schema, table, json_file, json_path_file = args
+    rows = load_json(
+        schema, table, json_file, json_path_file, dbname=options.dbname,
+        project_path=options.project_path, processes=options.processes,
+        chunk_size=options.chunk_size)
+    print 'Loaded {} rows into {}.{}'.format(rows, schema, table)
@@ -14,10 +14,20 @@ TAP parser in python which will then just signal failure were any tests
 to fail.
 """
 
+from contextlib import contextmanager
 from optparse import OptionParser
+import os
+import sys
+import threading
+import time
 
-from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager
-from pypgtap.lib.tap import tapOutputParser
+from pypgtap.core.test_kit.pypgtap_error import PyPGTAPAbort, \
+    PyPGTAPSubprocessError
+from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager, \
+    PYPGTAP_TEMPLATE_DB
+from pypgtap.core.test_kit.result_cache import ResultCache
+from pypgtap.core.test_kit import sharding
+from pypgtap.lib.tap import TAPAggregate, TAPParseError, tapOutputParser
 
 
 def get_cli_options():
@@ -33,34 +43,427 @@ def get_cli_options():
             'specify the project dirs: -w foo -w bam ... default is the pwd '
             'from where you run the script.'),
         action="append")
+    parser.add_option(
+        "-t", "--template", dest="use_template", default=False,
+        help=(
+            'bootstrap pgTAP and the pypgTAP glue once into a template '
+            'database and run each project in a clone of it.'),
+        action="store_true")
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", default=1, type="int",
+        help=(
+            'the number of test files of a project to run concurrently, each '
+            'in its own clone of the project database. default is 1.'))
+    parser.add_option(
+        "--in-process", dest="in_process", default=False,
+        help=(
+            'execute the sql scripts over a long lived psycopg2 connection '
+            'instead of a psql subprocess per script.'),
+        action="store_true")
+    parser.add_option(
+        "-x", "--fail-fast", dest="fail_fast", default=False,
+        help=(
+            'stop at the first failing test(a not ok that is not a TODO) or '
+            'Bail out!, killing the running test scripts.'),
+        action="store_true")
+    parser.add_option(
+        "--compact", dest="compact", default=False,
+        help=(
+            'do not print or keep the TAP outputs, only count the tests and '
+            'report the failed, todo and skipped ones in a summary per '
+            'project and one for the whole run.'),
+        action="store_true")
+    parser.add_option(
+        "--result-cache", dest="result_cache", default=False,
+        help=(
+            'record the outcome of every test file and the hash of the files '
+            'it depends on in the result cache.'),
+        action="store_true")
+    parser.add_option(
+        "--changed-only", dest="changed_only", default=False,
+        help=(
+            'skip the test files that passed the last time and have not '
+            'changed since, nor have their includes, fixtures or the glue. '
+            'Implies --result-cache.'),
+        action="store_true")
+    parser.add_option(
+        "--shard", dest="shard", default=None,
+        help=(
+            'run only the K-th of N shards of the test files of all the '
+            'projects, as K/N. The shards are balanced with the durations '
+            'recorded by earlier runs. Implies --record-durations.'))
+    parser.add_option(
+        "--record-durations", dest="record_durations", default=False,
+        help=(
+            'record how long every test file took in the {} file of its '
+            'project, which --shard balances the shards with.'.format(
+                sharding.DURATIONS_FILE)),
+        action="store_true")
+    parser.add_option(
+        "--daemon", dest="use_daemon", default=False,
+        help=(
+            'run the tests in a database leased from the harness daemon, '
+            'starting it if needed, instead of the current harness. Implies '
+            '--template.'),
+        action="store_true")
+    parser.add_option(
+        "--watch", dest="watch", default=False,
+        help=(
+            'keep the bootstrapped harness warm and watch the projects, '
+            'running the test files again when they, or the files they '
+            'include, change. Stop it with Ctrl-C.'),
+        action="store_true")
+    parser.add_option(
+        "--watch-interval", dest="watch_interval", default=1.0, type="float",
+        help='the seconds between two looks at the projects. default is 1.')
     return parser.parse_args()
 
 
-def run_tests(project_dirs):
+def is_failure_line(line):
+    """
+    Tells if a line of TAP output fails the test run: a "not ok" without a
+    TODO directive or a "Bail out!".
+
+    :param str line: A line of TAP output.
+    :rtype: bool
+    """
+    line = line.strip()
+    if line.startswith('Bail out!'):
+        return True
+    if not line.startswith('not ok'):
+        return False
+    _, _, directive = line.partition('#')
+    return not directive.strip().upper().startswith('TODO')
+
+
+class TAPLineReporter(object):
+    """
+    A line_callback for PyPGTAPTestManager.execute_project_test() that looks
+    at the TAP output while the tests are running. Failures are reported on
+    stderr as soon as their line arrives and with fail_fast the run is aborted
+    right there. With echo every line is written to stdout as it arrives,
+    which only makes sense when the test files run one at a time. If there is
+    an aggregate, a TAPAggregate, the lines are added to it.
+    """
+
+    def __init__(self, fail_fast=False, echo=False, aggregate=None):
+        self.fail_fast = fail_fast
+        self.echo = echo
+        self.aggregate = aggregate
+        self.failed = False
+        self._lock = threading.Lock()
+
+    def __call__(self, test, line):
+        failure = is_failure_line(line)
+        with self._lock:
+            if self.echo:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            elif failure:
+                sys.stderr.write('{}: {}\n'.format(test, line.rstrip()))
+            if self.aggregate is not None:
+                self.aggregate.addLine(line, source=test)
+            self.failed = self.failed or failure
+        if failure and self.fail_fast:
+            raise PyPGTAPAbort('{} failed: {}'.format(test, line.rstrip()))
+
+
+@contextmanager
+def _shared_manager(in_process, result_cache=None, use_daemon=False):
+    """
+    A PyPGTAPTestManager bootstrapped into the template database, or with
+    use_daemon into a database leased from the harness daemon, which is
+    already bootstrapped.
+    """
+    if use_daemon:
+        # Imported here, the harness daemon client needs SocketServer.
+        from pypgtap.core.test_kit.harness_daemon import lease_db
+        with lease_db() as lease:
+            with PyPGTAPTestManager(
+                    template_db=lease.dbname, in_process=in_process,
+                    harness=lease.harness,
+                    result_cache=result_cache) as manager:
+                yield manager
+    else:
+        with PyPGTAPTestManager(
+                template_db=PYPGTAP_TEMPLATE_DB, in_process=in_process,
+                result_cache=result_cache) as manager:
+            yield manager
+
+
+def _project_managers(project_dirs, use_template, in_process,
+                      result_cache=None, use_daemon=False):
+    """
+    Yields a (project_dir, PyPGTAPTestManager) pair for each project. Without
+    use_template or use_daemon every project gets a freshly bootstrapped
+    manager, else a single _shared_manager() is shared.
+    """
+    if use_template or use_daemon:
+        with _shared_manager(in_process, result_cache, use_daemon) as manager:
+            for w in project_dirs:
+                yield w, manager
+    else:
+        for w in project_dirs:
+            with PyPGTAPTestManager(
+                    in_process=in_process,
+                    result_cache=result_cache) as manager:
+                yield w, manager
+
+
+def _get_shard(project_dirs, shard):
+    """
+    :return: The project_dirs with tests in the shard and the set of those
+        tests.
+    :rtype: tuple
+    """
+    index, count = sharding.parse_shard(shard)
+    finder = PyPGTAPTestManager()
+    project_tests = [(w, finder.get_project_test_scripts(w))
+                     for w in project_dirs]
+    all_tests = [t for _, tests in project_tests for t in tests]
+    only_tests = set(sharding.shard_tests(
+        all_tests, sharding.load_durations(project_dirs), index, count))
+    print 'Shard {}: {} of {} test files\n'.format(
+        shard, len(only_tests), len(all_tests))
+    return ([w for w, tests in project_tests if only_tests.intersection(tests)],
+            only_tests)
+
+
+def run_tests(project_dirs, use_template=False, jobs=1, in_process=False,
+              fail_fast=False, compact=False, result_cache=False,
+              changed_only=False, shard=None, use_daemon=False,
+              record_durations=False):
     """
     Takes a list of valid project directories and runs the tests using PyPGTAPTestManager
+
+    :param list[str] project_dirs: The project directories.
+    :param bool use_template: If True the glue is bootstrapped once into a
+        template database that is cloned for each project.
+    :param int jobs: The number of test files to run concurrently.
+    :param bool in_process: If True the sql scripts are executed in process
+        instead of by psql.
+    :param bool fail_fast: If True the tests stop at the first failure.
+    :param bool compact: If True the TAP outputs are neither printed nor
+        kept in memory, a summary of each project and of the whole run is
+        printed instead. All the projects are run before failing.
+    :param bool result_cache: If True the outcomes of the test files are
+        recorded in the result_cache.ResultCache.
+    :param bool changed_only: If True the test files that passed and have
+        not changed since are skipped, it implies result_cache.
+    :param str shard: If given as K/N only the K-th of N shards of the test
+        files is run, see sharding.shard_tests(). The projects without a test
+        in the shard are not run at all.
+    :param bool use_daemon: If True the tests run in a database leased from
+        the harness daemon, see harness_daemon.lease_db().
+    :param bool record_durations: If True the durations of the test files
+        are recorded for the next sharded runs, see
+        sharding.record_durations(). It's implied by shard.
+    :raises ValueError: If any of the tests failed.
     """
     if project_dirs is None:
         raise ValueError(
             'must supply project directories or test scripts as argument')
+    only_tests = None
+    if shard is not None:
+        project_dirs, only_tests = _get_shard(project_dirs, shard)
 
     # This will actually create all the functions that pgtap
     # needs. After this you can actually run the tests
-    # Now just execute each of the projects
-    for w in project_dirs or []:
-        with PyPGTAPTestManager() as manager:
-            outputs = manager.execute_project_test(w)
-            failed_tests = []
-            print '{} project test summary:\n'.format(w)
-            for i, test_output in enumerate(outputs):
-                tapResult = tapOutputParser.parseString(test_output)[0]
+    # Now just execute each of the projects. When the test files run one at a
+    # time their TAP output is printed while they run, else it's printed in
+    # order once they are all done.
+    reporter = TAPLineReporter(
+        fail_fast=fail_fast, echo=(jobs == 1 and not compact))
+    total = TAPAggregate()
+    cache = ResultCache() if result_cache or changed_only else None
+    for w, manager in _project_managers(
+            project_dirs, use_template, in_process, cache, use_daemon):
+        print '{} project test summary:\n'.format(w)
+        sys.stdout.flush()
+        if compact:
+            reporter.aggregate = TAPAggregate()
+        try:
+            outputs = manager.execute_project_test(
+                w, jobs=jobs, line_callback=reporter,
+                keep_output=not compact, changed_only=changed_only,
+                only_tests=only_tests)
+        except PyPGTAPAbort as e:
+            raise ValueError('Failed Tests. Stopped because {}'.format(e))
+        finally:
+            if record_durations or shard is not None:
+                sharding.record_durations(w, manager.test_durations)
+            manager.test_durations.clear()
+        if compact:
+            reporter.aggregate.closeAll()
+            print reporter.aggregate.summary() + '\n'
+            total.merge(reporter.aggregate)
+            continue
+        failed_tests = []
+        for i, test_output in enumerate(outputs):
+            tapResult = tapOutputParser.parseString(test_output)[0]
+            if not reporter.echo:
                 print test_output
-                if len(tapResult.failedTests):
-                    failed_tests.append(tapResult.failedTests)
-            if failed_tests:
-                raise ValueError('Failed Tests. See the TAP outputs above.')
+            if len(tapResult.failedTests):
+                failed_tests.append(tapResult.failedTests)
+        if failed_tests or reporter.failed:
+            raise ValueError('Failed Tests. See the TAP outputs above.')
+    if compact:
+        print 'Total test summary:\n\n' + total.summary()
+        if not total.passedSuite:
+            raise ValueError('Failed Tests. See the summaries above.')
+
+
+class _ProjectWatch(object):
+    """
+    What watch_tests() knows about a project: the state of its tree and the
+    hashes of its test files the last time they ran.
+    """
+
+    def __init__(self, project_dir):
+        self.project_dir = project_dir
+        self.tree_state = None
+        # test -> the hash it last ran with
+        self.test_hashes = {}
+        # test -> the hash of a changed test that has not run yet
+        self._changed_hashes = {}
+
+    def changed_tests(self, manager):
+        """
+        The test files that changed since they last ran, all of them the first
+        time. The hashes are only computed when something in the project tree
+        changed. They are only taken as the ones the tests last ran with once
+        ran() is told the tests ran.
+
+        :rtype: list[str]
+        """
+        tree_state = _get_tree_state(self.project_dir)
+        if tree_state == self.tree_state:
+            return []
+        self.tree_state = tree_state
+        test_hashes = manager.get_test_hashes(
+            self.project_dir, manager.get_project_test_scripts(self.project_dir))
+        changed = sorted(
+            test for test, test_hash in test_hashes.iteritems()
+            if self.test_hashes.get(test) != test_hash)
+        self._changed_hashes = dict(
+            (test, test_hashes[test]) for test in changed)
+        self.test_hashes = dict(
+            (test, test_hash) for test, test_hash in test_hashes.iteritems()
+            if test not in self._changed_hashes)
+        return changed
+
+    def ran(self, tests):
+        """
+        Records that the changed tests ran. The ones that did not, e.g.
+        because psql failed before they started, run again the next time the
+        project tree changes.
+
+        :param list[str] tests: Some of the last changed_tests().
+        """
+        for test in tests:
+            self.test_hashes[test] = self._changed_hashes.pop(test)
+
+
+def _get_tree_state(project_dir):
+    """
+    The modification time and size of every file in project_dir.
+
+    :rtype: dict
+    """
+    state = {}
+    for dir_name, _, files in os.walk(project_dir):
+        for f in files:
+            path = os.path.join(dir_name, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed while we were looking
+                continue
+            state[path] = (stat.st_mtime, stat.st_size)
+    return state
+
+
+def _run_changed_tests(manager, project_dir, tests, jobs):
+    """
+    Runs the tests of project_dir and prints the TAPSummary of each one.
+
+    :return: The tests that ran, i.e. printed some output. The others were
+        stopped by the PyPGTAPSubprocessError of one of them.
+    :rtype: list[str]
+    """
+    print '{}: running {} changed test file(s)\n'.format(
+        project_dir, len(tests))
+    sys.stdout.flush()
+    outputs = {}
+
+    def collect(test, line):
+        outputs.setdefault(test, []).append(line)
+    try:
+        manager.execute_project_test(
+            project_dir, jobs=jobs, line_callback=collect, keep_output=False,
+            only_tests=set(tests))
+    except PyPGTAPSubprocessError as e:
+        print '{}\n'.format(e)
+    for test in tests:
+        try:
+            summary = tapOutputParser.parseLines(outputs.get(test, [])).summary()
+        except TAPParseError:
+            summary = 'No TAP output'
+        print '{}:\n{}\n'.format(test, summary)
+    sys.stdout.flush()
+    return [test for test in tests if test in outputs]
+
+
+def watch_tests(project_dirs, jobs=1, in_process=False, use_daemon=False,
+                interval=1.0, rounds=None):
+    """
+    Runs the tests of the projects, then watches the projects and runs the
+    test files again when their content or the files they include change;
+    See PyPGTAPTestManager.get_test_hashes(). The harness is bootstrapped only
+    once, into the template database or a database leased from the harness
+    daemon, and the TAPSummary of every test file that ran is printed.
+
+    :param list[str] project_dirs: The project directories.
+    :param int jobs: The number of test files to run concurrently.
+    :param bool in_process: If True the sql scripts are executed in process
+        instead of by psql.
+    :param bool use_daemon: If True the tests run in a database leased from
+        the harness daemon.
+    :param float interval: The seconds between two looks at the projects.
+    :param int rounds: The number of looks, None to watch till interrupted.
+    """
+    if project_dirs is None:
+        raise ValueError(
+            'must supply project directories or test scripts as argument')
+    watches = [_ProjectWatch(w) for w in project_dirs]
+    with _shared_manager(in_process, use_daemon=use_daemon) as manager:
+        looks = 0
+        try:
+            while rounds is None or looks < rounds:
+                if looks:
+                    time.sleep(interval)
+                looks += 1
+                for watch in watches:
+                    tests = watch.changed_tests(manager)
+                    if tests:
+                        watch.ran(_run_changed_tests(
+                            manager, watch.project_dir, tests, jobs))
+        except KeyboardInterrupt:
+            pass
 
 
 def main():
     options, args = get_cli_options()
-    run_tests(options.project_dirs)
+    if options.watch:
+        watch_tests(
+            options.project_dirs, jobs=options.jobs,
+            in_process=options.in_process, use_daemon=options.use_daemon,
+            interval=options.watch_interval)
+        return
+    run_tests(
+        options.project_dirs, use_template=options.use_template,
+        jobs=options.jobs, in_process=options.in_process,
+        fail_fast=options.fail_fast, compact=options.compact,
+        result_cache=options.result_cache, changed_only=options.changed_only,
+        shard=options.shard, use_daemon=options.use_daemon,
+        record_durations=options.record_durations)
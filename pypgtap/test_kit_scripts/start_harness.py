@@ -0,0 +1,65 @@
+"""
+The purpose of this script is to start the pypgTAP harness from the command
+line. See pypgtap.core.test_kit.postgres_env.start_postgres_harness for
+details. Stop it with stop_harness.
+
+With --isolated a new harness, with its own data dir, port and socket
+directory, is started so any number of them can run on one host. The last line
+printed is a shell command that makes it the current harness of run_all_tests
+and stop_harness:
+
+$ eval "$(start_harness --isolated | tail -1)"
+$ run_all_tests -w my_project
+$ stop_harness
+"""
+import sys
+
+from optparse import OptionParser
+
+from pypgtap.core.test_kit.postgres_env import start_postgres_harness
+from pypgtap.core.test_kit.utils import Harness, PYPGTAP_HARNESS_ENV
+
+
+def get_cli_options():
+    """
+    Returns the result of parser.parse_args() where parser is of type
+    OptionParser.
+    """
+    usage = "usage: %prog options"
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+        "-c", "--cache", dest="use_cache", default=False,
+        help=(
+            'start from a cached copy of a freshly initialized cluster with '
+            'the pypgTAP glue bootstrapped in its template database, creating '
+            'the cache entry if there is none.'),
+        action="store_true")
+    parser.add_option(
+        "-f", "--fast", dest="fast", default=False,
+        help=(
+            'run a throw away server without fsync, synchronous commit, full '
+            'page writes and with minimal WAL. Only use it for tests.'),
+        action="store_true")
+    parser.add_option(
+        "--tmpfs", dest="tmpfs_dir", default=None, metavar="DIR",
+        help=(
+            'keep the data dir in DIR, a tmpfs mount like /dev/shm. Best '
+            'combined with --fast.'))
+    parser.add_option(
+        "-i", "--isolated", dest="isolated", default=False,
+        help=(
+            'start a new harness on a free port with its own data and socket '
+            'directories and print the command that selects it.'),
+        action="store_true")
+    return parser.parse_args()
+
+
+def main():
+    options, args = get_cli_options()
+    harness = Harness.allocate() if options.isolated else None
+    start_postgres_harness(
+        use_cache=options.use_cache, fast=options.fast,
+        tmpfs_dir=options.tmpfs_dir, harness=harness)
+    if harness is not None:
+        sys.stdout.flush()
+        print 'export {}={}'.format(PYPGTAP_HARNESS_ENV, harness.root_dir)
@@ -0,0 +1,147 @@
+"""
+Unit tests for the leases of pypgtap.core.test_kit.harness_daemon. The harness
+and the databases are mocked out.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import MagicMock, patch
+
+from pypgtap.core.test_kit import harness_daemon as under_test
+from pypgtap.core.test_kit.pypgtap_error import PyPGTAPDaemonError
+from pypgtap.core.test_kit.utils import Harness
+
+
+class HarnessDaemonTest(unittest.TestCase):
+
+    """Tests the leases and the requests of the HarnessDaemon"""
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.daemon = under_test.HarnessDaemon(self.root_dir, spares=1)
+        self.daemon.harness = Harness.allocate(
+            root_dir=os.path.join(self.root_dir, 'harness'))
+        self.daemon._manager = MagicMock()
+        clone_ids = iter(xrange(1, 100))
+        self.daemon._manager._clone_db.side_effect = (
+            lambda source: '{}_{}'.format(source, next(clone_ids)))
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def _drops(self):
+        drops = []
+        while not self.daemon._drops.empty():
+            drops.append(self.daemon._drops.get())
+        return [db for db in drops if db is not None]
+
+    def test_lease_and_release(self):
+        """
+        A spare database is leased first, else a new one is cloned and marked as
+        bootstrapped. Released databases are dropped.
+        """
+        self.daemon._spare_dbs.append('spare')
+        first = self.daemon.handle({'op': 'lease', 'pid': os.getpid()})
+        second = self.daemon.handle({'op': 'lease'})
+        self.assertEquals('spare', first['dbname'])
+        self.assertEquals('pypgtap_template_1', second['dbname'])
+        self.assertEquals(self.daemon.harness.root_dir, first['harness_root_dir'])
+        self.daemon._manager._set_db_glue_hash.assert_called_once_with(
+            'pypgtap_template_1', under_test.get_glue_hash(),
+            harness=self.daemon.harness)
+        self.assertEquals(2, len(self.daemon.status()['leases']))
+        self.daemon.handle({'op': 'release', 'lease_id': first['lease_id']})
+        self.assertEquals(['spare'], self._drops())
+        self.assertEquals(1, len(self.daemon.status()['leases']))
+
+    def test_lease_while_recycling(self):
+        """
+        Leasing while the recycler fills the spares never clones the template twice at a time.
+        """
+        self.daemon.spares = 3
+        clone_ids = iter(xrange(1, 100))
+        cloning = []
+        overlaps = []
+
+        def clone_db(source):
+            cloning.append(source)
+            overlaps.append(len(cloning) > 1)
+            time.sleep(0.01)
+            cloning.pop()
+            return '{}_{}'.format(source, next(clone_ids))
+
+        self.daemon._manager._clone_db.side_effect = clone_db
+        recycler = threading.Thread(target=self.daemon._recycle)
+        recycler.start()
+        try:
+            leases = [self.daemon.lease(60) for _ in xrange(5)]
+        finally:
+            self.daemon._stopped.set()
+            recycler.join()
+        self.assertEquals(5, len(set(lease['dbname'] for lease in leases)))
+        self.assertTrue(len(overlaps) >= 5)
+        self.assertFalse(any(overlaps))
+
+    def test_expiry(self):
+        """
+        Leases that ran out of time or whose process exited expire, renewed ones don't.
+        """
+        expiring = self.daemon.lease(60)
+        renewed = self.daemon.lease(60)
+        self.daemon.renew(renewed['lease_id'], 600)
+        with patch.object(
+                under_test.postgres_env, '_is_process_alive', return_value=False):
+            dead = self.daemon.lease(600, pid=1234)
+        self._drops()
+        with patch.object(
+                under_test.postgres_env, '_is_process_alive', return_value=False):
+            self.assertFalse(self.daemon._expire_leases(time.time() + 120))
+        self.assertEquals(
+            sorted([expiring['dbname'], dead['dbname']]), sorted(self._drops()))
+        with self.assertRaises(ValueError):
+            self.daemon.renew(expiring['lease_id'])
+        self.assertTrue(self.daemon._expire_leases(time.time() + 1200))
+
+    def test_drop_db(self):
+        """
+        The clones a client made of its leased database are dropped along with it.
+        """
+        with patch.object(under_test, '_list_databases', return_value=['lease_1_1']) \
+                as mock_list, \
+                patch.object(under_test, 'postgres_env') as mock_env:
+            self.daemon._drop_db('lease_1')
+            mock_list.assert_called_once_with(
+                'lease\\_1\\_%', harness=self.daemon.harness)
+            self.assertEquals(
+                ['lease_1_1', 'lease_1'],
+                [args[0] for args, _ in mock_env.drop_db.call_args_list])
+
+    def test_requests(self):
+        """
+        The clients talk to the daemon over its unix socket and its errors are raised.
+        """
+        socket_path = os.path.join(self.root_dir, under_test._SOCKET)
+        server = under_test._DaemonServer(socket_path, under_test._RequestHandler)
+        server.harness_daemon = self.daemon
+        thread = threading.Thread(target=server.serve_forever, args=(0.1,))
+        thread.start()
+        try:
+            self.assertTrue(under_test.is_daemon_running(self.root_dir))
+            with patch.object(under_test, 'start_daemon') as mock_start:
+                lease = under_test.lease_db(root_dir=self.root_dir)
+                mock_start.assert_called_once_with(self.root_dir)
+            self.assertEquals('pypgtap_template_1', lease.dbname)
+            self.assertEquals(self.daemon.harness, lease.harness)
+            lease.renew(10)
+            lease.release()
+            with self.assertRaisesRegexp(PyPGTAPDaemonError, 'expired'):
+                lease.renew()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.assertFalse(under_test.is_daemon_running(self.root_dir))
@@ -0,0 +1,146 @@
+"""
+Unit tests for pypgtap.core.test_kit.json_loader. The connection is mocked
+out; See the integration tests for loading into the harness.
+"""
+from cStringIO import StringIO
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+
+from pypgtap.core.test_kit import json_loader as under_test
+from pypgtap.core.test_kit.utils import Harness
+
+
+class LoadJSONTest(unittest.TestCase):
+
+    """Tests under_test.load_json"""
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.project_dir, 'paths.json'), 'w') as f:
+            json.dump({'jsonpaths': ['$.a', '$.b']}, f)
+        self.lines = ['{"a": %d, "b": "tab\\there %d"}' % (i, i) for i in xrange(50)]
+        self.lines.insert(10, '{"a": 100}')
+        with open(os.path.join(self.project_dir, 'data.json'), 'w') as f:
+            f.write('\n'.join(self.lines) + '\n\n')
+        self.conn = MagicMock()
+        self.cursor = self.conn.cursor.return_value.__enter__.return_value
+        self.cursor.fetchall.return_value = [('a',), ('b',), ('c',)]
+        self.copied = []
+        self.cursor.copy_expert.side_effect = \
+            lambda statement, f: self.copied.append((statement, f.read()))
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+
+    def _load(self, **kwargs):
+        with patch.object(under_test.psyc, 'connect', return_value=self.conn) \
+                as mock_connect:
+            rows = under_test.load_json(
+                's', 't', 'data.json', 'paths.json', dbname='db',
+                project_path=self.project_dir, **kwargs)
+        self.assertEquals('db', mock_connect.call_args[1]['dbname'])
+        return rows
+
+    def _copied_rows(self):
+        return ''.join(data for _, data in self.copied).splitlines()
+
+    def test_load(self):
+        """
+        Every line is copied once, in order, into the first columns of the
+        table, with the missing values as NULL, no matter how the file is
+        split between the processes.
+        """
+        expected = ['0\t"tab\\\\there 0"'] + [
+            '{}\t"tab\\\\there {}"'.format(i, i) for i in xrange(1, 10)] + \
+            ['100\t\\N'] + ['{}\t"tab\\\\there {}"'.format(i, i) for i in xrange(10, 50)]
+        for processes, chunk_size in ((1, 1 << 20), (1, 7), (3, 100)):
+            self.copied = []
+            self.assertEquals(
+                51, self._load(processes=processes, chunk_size=chunk_size))
+            self.assertEquals(expected, self._copied_rows())
+            self.assertEquals(
+                'COPY "s"."t" ("a", "b") FROM STDIN', self.copied[0][0])
+        self.assertTrue(self.conn.commit.called)
+        self.assertTrue(self.conn.close.called)
+
+    def test_connection(self):
+        """
+        Without a harness the PGHOST and PGPORT a test script passes to its
+        \\! commands win over the current harness.
+        """
+        harness = Harness('data_dir', port=5433, socket_dir='/tmp/h')
+        with patch.object(under_test, 'current_harness', return_value=harness), \
+                patch.dict(os.environ, {'PGHOST': '/tmp/other', 'PGPORT': '5434'}), \
+                patch.object(under_test.psyc, 'connect', return_value=self.conn) \
+                as mock_connect:
+            under_test.load_json(
+                's', 't', 'data.json', 'paths.json', processes=1,
+                project_path=self.project_dir)
+            self.assertNotIn('host', mock_connect.call_args[1])
+            self.assertNotIn('port', mock_connect.call_args[1])
+            under_test.load_json(
+                's', 't', 'data.json', 'paths.json', processes=1,
+                project_path=self.project_dir, harness=harness)
+            self.assertEquals('/tmp/h', mock_connect.call_args[1]['host'])
+            self.assertEquals(5433, mock_connect.call_args[1]['port'])
+
+    def test_caller_connection(self):
+        """
+        With the caller's connection the rows are loaded in its transaction, which is left alone,
+        and the project path is looked up in a savepoint.
+        """
+        self.cursor.fetchone.return_value = (self.project_dir,)
+        with patch.object(under_test.psyc, 'connect') as mock_connect:
+            self.assertEquals(51, under_test.load_json(
+                's', 't', 'data.json', 'paths.json', processes=1, connection=self.conn))
+        self.assertFalse(mock_connect.called)
+        self.assertFalse(self.conn.commit.called)
+        self.assertFalse(self.conn.close.called)
+        self.assertFalse(self.conn.rollback.called)
+        statements = [args[0] for args, _ in self.cursor.execute.call_args_list]
+        self.assertEquals(
+            ['SAVEPOINT pypgtap_project_path', 'SELECT get_project_path()',
+             'RELEASE SAVEPOINT pypgtap_project_path'], statements[:3])
+
+    def test_write_json_rows(self):
+        """
+        The rows are written the way they are copied, without connecting when the project path is
+        given.
+        """
+        self._load(processes=1)
+        out = StringIO()
+        with patch.object(under_test.psyc, 'connect') as mock_connect:
+            self.assertEquals(51, under_test.write_json_rows(
+                'data.json', 'paths.json', out, project_path=self.project_dir,
+                processes=3, chunk_size=100))
+        self.assertFalse(mock_connect.called)
+        self.assertEquals(self._copied_rows(), out.getvalue().splitlines())
+
+    def test_too_many_paths(self):
+        self.cursor.fetchall.return_value = [('a',)]
+        with self.assertRaises(ValueError):
+            self._load(processes=1)
+        self.assertFalse(self.conn.commit.called)
+        self.assertTrue(self.conn.close.called)
+
+    def test_load_compressed(self):
+        with open(os.path.join(self.project_dir, 'data.json')) as f:
+            data = f.read()
+        with gzip.open(os.path.join(self.project_dir, 'data.json.gz'), 'wb') as f:
+            f.write(data)
+        self._load(processes=1)
+        expected = self._copied_rows()
+        for processes, chunk_size in ((1, 7), (3, 100)):
+            self.copied = []
+            with patch.object(under_test.psyc, 'connect', return_value=self.conn):
+                self.assertEquals(51, under_test.load_json(
+                    's', 't', 'data.json.gz', 'paths.json',
+                    project_path=self.project_dir, processes=processes,
+                    chunk_size=chunk_size))
+            self.assertEquals(expected, self._copied_rows())
@@ -0,0 +1,69 @@
+"""
+Checks that the command line scripts don't import the heavy dependencies
+before they need them, see benchmarks/bench_startup.py for their startup times.
+"""
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from mock import patch
+
+from pypgtap.core.test_kit import utils as under_test
+
+_MODULES = [
+    'pypgtap.test_kit_scripts.start_harness',
+    'pypgtap.test_kit_scripts.run_all_tests',
+    'pypgtap.test_kit_scripts.harness_daemon',
+    'pypgtap.test_kit_scripts.load_json',
+    'pypgtap.core.test_kit.postgres_env',
+    'pypgtap.lib.tap_grammar',
+]
+_HEAVY_MODULES = [
+    'pkg_resources', 'psycopg2', 'pyparsing', 'multiprocessing', 'jsonpath_rw']
+
+
+class LazyImportsTest(unittest.TestCase):
+
+    def _imported(self, modules, candidates):
+        """
+        The candidates that importing modules in a fresh interpreter imports
+        """
+        code = 'import json, sys\n{}\nprint json.dumps([m for m in {!r} if m in sys.modules])'
+        code = code.format(
+            '\n'.join('import {}'.format(m) for m in modules), candidates)
+        env = dict(os.environ)
+        env.setdefault('USER', 'pypgtap')
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        return json.loads(output)
+
+    def test_entry_points(self):
+        """
+        Importing the scripts imports none of the heavy modules
+        """
+        self.assertEquals([], self._imported(_MODULES, _HEAVY_MODULES))
+
+    def test_run_all_tests_without_daemon(self):
+        """
+        run_all_tests only imports the harness daemon client, and SocketServer, for --daemon
+        """
+        self.assertEquals([], self._imported(
+            ['pypgtap.test_kit_scripts.run_all_tests'],
+            ['pypgtap.core.test_kit.harness_daemon', 'SocketServer']))
+
+    def test_lazy_module(self):
+        """
+        The module is imported on first use and can be patched like a module
+        """
+        lazy = under_test.LazyModule('json')
+        with patch('importlib.import_module', wraps=under_test.importlib.import_module) \
+                as mock_import:
+            self.assertEquals('[1]', lazy.dumps([1]))
+            self.assertEquals('{}', lazy.dumps({}))
+            mock_import.assert_called_once_with('json')
+        with patch.object(lazy, 'dumps', return_value='patched'):
+            self.assertEquals('patched', lazy.dumps([1]))
+        self.assertEquals('[1]', lazy.dumps([1]))
+        with self.assertRaises(AttributeError):
+            lazy.does_not_exist
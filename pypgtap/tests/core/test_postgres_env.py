@@ -0,0 +1,304 @@
+"""
+Unit tests for the parts of pypgtap.core.test_kit.postgres_env that don't need
+postgres. The pg_ctl calls are mocked out; See the integration tests for the
+real thing.
+"""
+import os
+import shutil
+import socket
+import stat
+import struct
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from pypgtap.core.test_kit import postgres_env as under_test
+from pypgtap.core.test_kit.utils import Harness
+
+
+class ClusterCacheTest(unittest.TestCase):
+
+    """Tests the cluster cache used by start_postgres_harness"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'data')
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        os.makedirs(self.data_dir)
+        self.harness = Harness(self.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _make_cluster(self, cluster_dir):
+        os.makedirs(os.path.join(cluster_dir, 'base', '1'))
+        with open(os.path.join(cluster_dir, 'PG_VERSION'), 'w') as f:
+            f.write('9.3\n')
+        with open(os.path.join(cluster_dir, 'base', '1', '1259'), 'w') as f:
+            f.write('relation')
+
+    def test_copy_cluster(self):
+        """
+        The copy has all the files, doesn't share them with the source and
+        is only accessible by the owner.
+        """
+        src = os.path.join(self.tmp_dir, 'src')
+        self._make_cluster(src)
+        under_test._copy_cluster(src, self.data_dir)
+        copied = os.path.join(self.data_dir, 'base', '1', '1259')
+        with open(copied) as f:
+            self.assertEquals('relation', f.read())
+        self.assertEquals(1, os.stat(copied).st_nlink)
+        self.assertEquals(0700, stat.S_IMODE(os.stat(self.data_dir).st_mode))
+
+    def test_start_from_cache(self):
+        """
+        When the cluster is cached it's copied instead of running initdb and
+        bootstrapping.
+        """
+        with patch.object(under_test, 'PG_HARNESS_CACHE_DIR', self.cache_dir), \
+                patch.object(under_test, '_cluster_cache_key', return_value='key'), \
+                patch.object(under_test, '_copy_cluster') as mock_copy, \
+                patch.object(under_test, '_start_server') as mock_start, \
+                patch.object(under_test, 'create_default_db') as mock_create, \
+                patch.object(under_test.subprocess, 'call', return_value=0) \
+                as mock_call:
+            self._make_cluster(os.path.join(self.cache_dir, 'key'))
+            under_test.start_postgres_harness(
+                'user', use_cache=True, harness=self.harness)
+            mock_copy.assert_called_once_with(
+                os.path.join(self.cache_dir, 'key'), self.data_dir)
+            mock_start.assert_called_once_with(self.harness)
+            self.assertEquals(0, mock_create.call_count)
+            for args, _ in mock_call.call_args_list:
+                self.assertNotIn('initdb', args[0])
+
+    def test_populate_cache(self):
+        """
+        On a cache miss the cluster is initialized as usual and then cached.
+        """
+        with patch.object(under_test, 'PG_HARNESS_CACHE_DIR', self.cache_dir), \
+                patch.object(under_test, '_cluster_cache_key', return_value='key'), \
+                patch.object(under_test, '_start_server'), \
+                patch.object(under_test, 'create_default_db'), \
+                patch.object(under_test.subprocess, 'call', return_value=0), \
+                patch.object(under_test, '_cache_cluster') as mock_cache:
+            under_test.start_postgres_harness(
+                'user', use_cache=True, harness=self.harness)
+            mock_cache.assert_called_once_with(
+                self.harness, os.path.join(self.cache_dir, 'key'))
+
+
+class FastModeTest(unittest.TestCase):
+
+    """Tests the fast mode and tmpfs options of start_postgres_harness"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'data')
+        self.tmpfs_dir = os.path.join(self.tmp_dir, 'tmpfs')
+        os.makedirs(self.data_dir)
+        self.harness = Harness(self.data_dir)
+        os.makedirs(self.tmpfs_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _fake_initdb(self, cmd_lst, **kwargs):
+        if 'initdb' in cmd_lst:
+            open(os.path.join(self.data_dir, 'postgresql.conf'), 'w').close()
+        return 0
+
+    def test_fast_mode(self):
+        """
+        initdb does not sync and the fast mode settings end up in
+        postgresql.conf
+        """
+        with patch.object(under_test, '_start_server'), \
+                patch.object(under_test, 'create_default_db'), \
+                patch.object(under_test.subprocess, 'call',
+                             side_effect=self._fake_initdb) as mock_call:
+            under_test.start_postgres_harness(
+                'user', fast=True, harness=self.harness)
+            self.assertIn('-N', mock_call.call_args_list[0][0][0])
+            with open(os.path.join(self.data_dir, 'postgresql.conf')) as f:
+                conf = f.read()
+            for name, value in under_test.FAST_MODE_SETTINGS:
+                self.assertIn("{} = '{}'\n".format(name, value), conf)
+
+    def test_tmpfs(self):
+        """
+        The data dir links to the tmpfs and both are removed on stop
+        """
+        with patch.object(under_test, '_start_server'), \
+                patch.object(under_test, 'create_default_db'), \
+                patch.object(under_test, 'is_harness_running', return_value=False), \
+                patch.object(under_test.subprocess, 'call',
+                             side_effect=self._fake_initdb):
+            under_test.start_postgres_harness(
+                'user', tmpfs_dir=self.tmpfs_dir, harness=self.harness)
+            self.assertTrue(os.path.islink(self.data_dir))
+            self.assertEquals(
+                os.path.realpath(self.tmpfs_dir),
+                os.path.dirname(os.path.realpath(self.data_dir)))
+            self.assertTrue(os.path.exists(os.path.join(
+                os.path.realpath(self.data_dir), 'postgresql.conf')))
+            under_test.stop_postgres_harness(harness=self.harness)
+            self.assertFalse(os.path.lexists(self.data_dir))
+            self.assertEquals([], os.listdir(self.tmpfs_dir))
+
+
+class FastStopTest(unittest.TestCase):
+
+    """Tests stop_postgres_harness(fast=True)"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.tmpfs_dir = os.path.join(self.tmp_dir, 'tmpfs')
+        os.makedirs(self.tmpfs_dir)
+        self.harness = Harness.allocate(
+            root_dir=os.path.join(self.tmp_dir, 'harness'))
+        os.makedirs(self.harness.data_dir)
+        under_test._link_data_dir(self.harness, self.tmpfs_dir)
+        open(os.path.join(self.harness.data_dir, 'PG_VERSION'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fast_stop(self):
+        """
+        The server is aborted and the dirs are renamed aside and removed in
+        the background
+        """
+        threads = []
+        remove_in_background = under_test._remove_in_background
+
+        def remove(dirs):
+            for path in dirs:
+                self.assertTrue(os.path.basename(path).startswith(
+                    under_test._TRASH_PREFIX))
+            threads.append(remove_in_background(dirs))
+            return threads[-1]
+        with patch.object(under_test, 'is_harness_running', return_value=True), \
+                patch.object(under_test, '_stop_server') as mock_stop, \
+                patch.object(under_test, '_remove_in_background',
+                             side_effect=remove) as mock_remove:
+            under_test.stop_postgres_harness(harness=self.harness, fast=True)
+            mock_stop.assert_called_once_with(self.harness, immediate=True)
+        self.assertFalse(os.path.lexists(self.harness.root_dir))
+        self.assertEquals(2, len(mock_remove.call_args[0][0]))
+        threads[0].join()
+        self.assertEquals(['tmpfs'], os.listdir(self.tmp_dir))
+        self.assertEquals([], os.listdir(self.tmpfs_dir))
+
+    def test_collect_trash(self):
+        """
+        The next start removes what the fast stops left behind
+        """
+        with patch.object(under_test, 'is_harness_running', return_value=False), \
+                patch.object(under_test, '_remove_in_background'):
+            under_test.stop_postgres_harness(harness=self.harness, fast=True)
+        harness = Harness.allocate(
+            root_dir=os.path.join(self.tmp_dir, 'harness'))
+        with patch.object(under_test, '_start_server'), \
+                patch.object(under_test, 'create_default_db'), \
+                patch.object(under_test.subprocess, 'call', return_value=0), \
+                patch.object(under_test, '_remove_in_background') as mock_remove:
+            under_test.start_postgres_harness(
+                'user', tmpfs_dir=self.tmpfs_dir, harness=harness)
+        self.assertEquals(
+            sorted(os.path.join(d, name) for d in (self.tmp_dir, self.tmpfs_dir)
+                   for name in os.listdir(d)
+                   if name.startswith(under_test._TRASH_PREFIX)),
+            sorted(mock_remove.call_args[0][0]))
+
+
+class _FakeServer(threading.Thread):
+
+    """Answers startup packets on a unix socket with the given replies"""
+
+    def __init__(self, socket_path, replies):
+        super(_FakeServer, self).__init__()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socket_path)
+        self.sock.listen(5)
+        self.replies = replies
+        self.packets = []
+
+    def run(self):
+        for reply in self.replies:
+            conn, _ = self.sock.accept()
+            length = struct.unpack('!i', conn.recv(4))[0]
+            self.packets.append(conn.recv(length - 4))
+            conn.sendall(reply)
+            conn.recv(5)
+            conn.close()
+        self.sock.close()
+
+
+def _message(kind, body):
+    return kind + struct.pack('!i', len(body) + 4) + body
+
+
+class ReadinessTest(unittest.TestCase):
+
+    """Tests is_harness_running and wait_until_ready"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.harness = Harness.allocate(root_dir=self.tmp_dir)
+        os.makedirs(self.harness.data_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_pid_file(self, pid):
+        with open(os.path.join(
+                self.harness.data_dir, 'postmaster.pid'), 'w') as f:
+            f.write('\n'.join([
+                str(pid), self.harness.data_dir, '1400000000',
+                str(self.harness.port), self.harness.socket_dir, 'localhost',
+                '5432001 0', '']))
+
+    def test_is_harness_running(self):
+        """
+        The server runs while the process of its postmaster.pid is alive
+        """
+        self.assertFalse(under_test.is_harness_running(harness=self.harness))
+        self._write_pid_file(os.getpid())
+        self.assertTrue(under_test.is_harness_running(harness=self.harness))
+        with patch.object(under_test, '_is_process_alive', return_value=False):
+            self.assertFalse(
+                under_test.is_harness_running(harness=self.harness))
+
+    def test_wait_until_ready(self):
+        """
+        The server is ready once it stops answering that it's starting up
+        """
+        self._write_pid_file(os.getpid())
+        starting_up = _message('E', 'SFATAL\0C57P03\0Mstarting up\0\0')
+        server = _FakeServer(
+            os.path.join(self.harness.socket_dir,
+                         '.s.PGSQL.{}'.format(self.harness.port)),
+            [starting_up, starting_up, _message('R', struct.pack('!i', 0))])
+        server.start()
+        under_test.wait_until_ready(harness=self.harness, timeout=10)
+        server.join()
+        self.assertEquals(3, len(server.packets))
+        self.assertIn('database\0postgres\0', server.packets[0])
+
+    def test_not_ready(self):
+        """
+        Waiting fails when the server exited or never accepts connections
+        """
+        with patch.object(under_test, '_PID_FILE_TIMEOUT', 0.05), \
+                self.assertRaisesRegexp(EnvironmentError, 'did not start'):
+            under_test.wait_until_ready(harness=self.harness)
+        self._write_pid_file(os.getpid())
+        with self.assertRaisesRegexp(EnvironmentError, 'within'):
+            under_test.wait_until_ready(harness=self.harness, timeout=0.1)
+        with patch.object(under_test, '_is_process_alive', return_value=False), \
+                self.assertRaisesRegexp(EnvironmentError, 'exited'):
+            under_test.wait_until_ready(harness=self.harness)
@@ -4,11 +4,19 @@ in the pypgtap.core.test_kit.pypgtap_testing module.
 
 """
 import itertools as its
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
-from mock import patch
+from mock import MagicMock, patch
 
 from pypgtap.core.test_kit import pypgtap_testing as under_test
+from pypgtap.core.test_kit.pypgtap_error import PyPGTAPAbort, \
+    PyPGTAPSubprocessError
+from pypgtap.core.test_kit.utils import Harness
 
 
 class PyPGTAPTestManager(unittest.TestCase):
@@ -32,7 +40,7 @@ class PyPGTAPTestManager(unittest.TestCase):
                             as mock_wf_setter:
                         manager.execute_project_test('example_project')
                         call_arg_flattener = lambda mock: list(
-                            its.chain(*its.chain(*mock.call_args_list))
+                            its.chain(*(args for args, _ in mock.call_args_list))
                         )
                         sql_scripts = its.imap(os.path.basename, call_arg_flattener(mock_executor))
                         self.assertIn('test_hello_world.sql', sql_scripts)
@@ -88,7 +96,7 @@ class PyPGTAPTestManager(unittest.TestCase):
                 # Flatten and get the base name of the scripts!
                 sql_scripts = list(
                     its.imap(os.path.basename, its.chain(
-                            *its.chain(*mock_executor.call_args_list)))
+                            *(args for args, _ in mock_executor.call_args_list)))
                 )
                 extra_scripts = set(sql_scripts).difference(self.expected_base_scripts)
                 fewer_scripts = set(self.expected_base_scripts).difference(sql_scripts)
@@ -101,3 +109,394 @@ class PyPGTAPTestManager(unittest.TestCase):
                     len(fewer_scripts), 0,
                     msg='{} fewer script(s) detected, expected only {}'.format(
                         fewer_scripts, self.expected_base_scripts))
+
+    def test_template_mode(self):
+        """
+        In template mode the base scripts are executed only once, in the
+        template database, and every project is executed in its own clone of
+        it that is dropped afterwards.
+        """
+        with patch.object(under_test, '_execute_sql_script') as mock_executor, \
+                patch.object(under_test, 'postgres_env') as mock_env, \
+                patch.object(under_test, 'CONNECTION_POOL') as mock_pool, \
+                patch.object(under_test.PyPGTAPTestManager, '_get_db_glue_hash',
+                             return_value=None), \
+                patch.object(under_test.PyPGTAPTestManager, '_set_db_glue_hash') \
+                as mock_set_hash:
+            harness = Harness('data_dir', port=5433)
+            with under_test.PyPGTAPTestManager(
+                    template_db='tmpl', harness=harness) as manager:
+                mock_set_hash.assert_called_once_with(
+                    'tmpl', under_test.get_glue_hash(), harness=harness)
+                init_calls = mock_executor.call_count
+                self.assertTrue(init_calls >= 2)
+                for _, kwargs in mock_executor.call_args_list:
+                    self.assertEquals('tmpl', kwargs['dbname'])
+                    self.assertEquals(harness, kwargs['harness'])
+                mock_env.create_db.assert_called_once_with('tmpl', harness=harness)
+                with patch.object(manager, '_set_virtual_env_dir'):
+                    with patch.object(manager, '_set_project_dir'):
+                        manager.execute_project_test('example_project')
+                        manager.execute_project_test('example_project')
+                # No more bootstrapping, just the tests in the two clones.
+                test_calls = mock_executor.call_args_list[init_calls:]
+                self.assertEquals(
+                    ['tmpl_1', 'tmpl_2'],
+                    [kwargs['dbname'] for _, kwargs in test_calls])
+                mock_env.create_db.assert_any_call(
+                    'tmpl_1', template_db='tmpl', harness=harness)
+                mock_env.create_db.assert_any_call(
+                    'tmpl_2', template_db='tmpl', harness=harness)
+                mock_env.drop_db.assert_any_call('tmpl_2', harness=harness)
+
+    def test_concurrent_execution(self):
+        """
+        With jobs > 1 every test file runs in a clone of the project database of its own, no two
+        test files share one, and the outputs come back in the order of a serial run.
+        """
+        test_files = ['test_{}.sql'.format(i) for i in xrange(5)]
+        # Recorded by side effects, mocks don't record calls from several threads reliably
+        used_dbs, created, dropped = [], [], []
+
+        def execute(test, dbname=None, **kwargs):
+            used_dbs.append(dbname)
+            return 'out ' + test
+
+        with patch.object(under_test, '_execute_sql_script', side_effect=execute), \
+                patch.object(under_test, 'postgres_env') as mock_env:
+            mock_env.get_default_db_name.return_value = 'user'
+            mock_env.create_db.side_effect = lambda db, template_db=None, harness=None: \
+                created.append((db, template_db, harness))
+            mock_env.drop_db.side_effect = lambda db, **kwargs: dropped.append(db)
+            harness = Harness('data_dir')
+            manager = under_test.PyPGTAPTestManager(harness=harness)
+            with patch.object(manager, 'get_test_scripts', return_value=test_files), \
+                    patch.object(manager, '_set_virtual_env_dir'), \
+                    patch.object(manager, '_set_project_dir'):
+                outputs = manager.execute_project_test('example_project', jobs=2)
+            self.assertEquals(['out ' + f for f in test_files], outputs)
+        self.assertEquals(len(test_files), len(set(used_dbs)))
+        self.assertEquals(
+            set('user_{}'.format(i) for i in xrange(1, 6)), set(used_dbs))
+        self.assertEquals(sorted((db, 'user', harness) for db in used_dbs), sorted(created))
+        self.assertTrue(set(used_dbs) <= set(dropped))
+
+    def test_template_already_bootstrapped(self):
+        """
+        A template database bootstrapped with the current glue, for example in a
+        cached cluster, is not bootstrapped again.
+        """
+        with patch.object(under_test, '_execute_sql_script') as mock_executor, \
+                patch.object(under_test, 'postgres_env') as mock_env, \
+                patch.object(under_test.PyPGTAPTestManager, '_get_db_glue_hash',
+                             return_value=under_test.get_glue_hash()):
+            with under_test.PyPGTAPTestManager(template_db='tmpl') as manager:
+                self.assertTrue(manager._is_initialized)
+                self.assertEquals(0, mock_executor.call_count)
+                self.assertEquals(0, mock_env.create_db.call_count)
+
+    def test_concurrent_abort(self):
+        """
+        Once a line callback aborts a test the tests that have not started
+        are not executed and the abort propagates.
+        """
+        test_files = ['test_{}.sql'.format(i) for i in xrange(6)]
+        failed = threading.Event()
+
+        # Recorded by side effects, mocks don't record calls from several threads reliably
+        executed, created, dropped = [], [], []
+
+        def execute(test, line_callback=None, **kwargs):
+            executed.append(test)
+            if test == 'test_0.sql':
+                line_callback('not ok 1\n')
+            # The others print until they are aborted
+            failed.wait(5)
+            for i in xrange(500):
+                line_callback('ok {}\n'.format(i + 1))
+                time.sleep(0.01)
+            return 'out ' + test
+
+        def line_callback(test, line):
+            if line.startswith('not ok'):
+                failed.set()
+                raise PyPGTAPAbort(test)
+
+        with patch.object(under_test, '_execute_sql_script') as mock_executor, \
+                patch.object(under_test, 'postgres_env') as mock_env:
+            mock_executor.side_effect = execute
+            mock_env.get_default_db_name.return_value = 'user'
+            mock_env.create_db.side_effect = lambda db, **kwargs: created.append(db)
+            mock_env.drop_db.side_effect = lambda db, **kwargs: dropped.append(db)
+            manager = under_test.PyPGTAPTestManager(harness=Harness('data_dir'))
+            with patch.object(manager, 'get_test_scripts', return_value=test_files), \
+                    patch.object(manager, '_set_virtual_env_dir'), \
+                    patch.object(manager, '_set_project_dir'):
+                with self.assertRaises(PyPGTAPAbort):
+                    manager.execute_project_test(
+                        'example_project', jobs=2, line_callback=line_callback)
+            # test_0.sql and at most the one running next to it were executed
+            self.assertIn('test_0.sql', executed)
+            self.assertTrue(len(executed) <= 2)
+            # The time of the aborted test is not its duration
+            self.assertNotIn('test_0.sql', manager.test_durations)
+            # The clones of the tests that ran are dropped
+            self.assertEquals(len(executed), len(created))
+            self.assertTrue(set(created) <= set(dropped))
+
+
+class SetupSnapshotTest(unittest.TestCase):
+
+    """Tests the setup snapshots of the projects with a setup manifest"""
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.project_dir, 'tests', 'fixtures'))
+        self._write('tests/setup.sql', 'CREATE TABLE t (a int);')
+        self._write('tests/fixtures/t.json', '{"a": 1}')
+        for i in xrange(3):
+            self._write('tests/test_{}.sql'.format(i), 'SELECT 1;')
+        self._write(under_test.SETUP_MANIFEST, json.dumps(
+            {'setup_scripts': ['tests/setup.sql'], 'fixtures': ['tests/fixtures']}))
+        self.harness = Harness('data_dir')
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.project_dir, name), 'w') as f:
+            f.write(content)
+
+    def _setup_hash(self):
+        scripts, fixtures = under_test.read_setup_manifest(self.project_dir)
+        return under_test.get_setup_hash(self.project_dir, scripts, fixtures)
+
+    def test_read_setup_manifest(self):
+        scripts, fixtures = under_test.read_setup_manifest(self.project_dir)
+        self.assertEquals([os.path.join(self.project_dir, 'tests', 'setup.sql')], scripts)
+        self.assertEquals(
+            [os.path.join(self.project_dir, 'tests', 'fixtures', 't.json')], fixtures)
+        self._write(under_test.SETUP_MANIFEST, json.dumps({'setup_scripts': ['nope.sql']}))
+        with self.assertRaises(IOError):
+            under_test.read_setup_manifest(self.project_dir)
+        os.remove(os.path.join(self.project_dir, under_test.SETUP_MANIFEST))
+        self.assertIsNone(under_test.read_setup_manifest(self.project_dir))
+
+    def test_setup_hash(self):
+        """
+        The hash changes with the setup scripts and the fixtures.
+        """
+        setup_hash = self._setup_hash()
+        self.assertEquals(setup_hash, self._setup_hash())
+        self._write('tests/fixtures/t.json', '{"a": 2}')
+        fixture_hash = self._setup_hash()
+        self.assertNotEquals(setup_hash, fixture_hash)
+        self._write('tests/setup.sql', 'CREATE TABLE t (a bigint);')
+        self.assertNotEquals(fixture_hash, self._setup_hash())
+
+    def test_make_snapshot(self):
+        """
+        The setup is executed once in the snapshot and every test runs in its own clone of it.
+        """
+        with patch.object(under_test, '_execute_sql_script') as mock_executor, \
+                patch.object(under_test, 'postgres_env') as mock_env, \
+                patch.object(under_test, 'CONNECTION_POOL') as mock_pool, \
+                patch.object(under_test.PyPGTAPTestManager, '_get_db_glue_hash',
+                             return_value=None), \
+                patch.object(under_test.PyPGTAPTestManager, '_set_db_glue_hash') \
+                as mock_set_hash:
+            mock_env.get_default_db_name.return_value = 'user'
+            manager = under_test.PyPGTAPTestManager(harness=self.harness)
+            with patch.object(manager, '_set_virtual_env_dir'), \
+                    patch.object(manager, '_set_project_dir') as mock_set_project_dir:
+                manager.execute_project_test(self.project_dir, jobs=2)
+            snapshot_db = mock_set_project_dir.call_args[1]['dbname']
+            self.assertTrue(snapshot_db.startswith(under_test.SETUP_SNAPSHOT_DB_PREFIX))
+            mock_env.create_db.assert_any_call(
+                snapshot_db, template_db='user', harness=self.harness)
+            mock_set_hash.assert_called_once_with(
+                snapshot_db, self._setup_hash(), harness=self.harness)
+            calls = [(os.path.basename(args[0]), kwargs['dbname'])
+                     for args, kwargs in mock_executor.call_args_list]
+            self.assertEquals(('setup.sql', snapshot_db), calls[0])
+            test_dbs = [db for _, db in calls[1:]]
+            self.assertEquals(3, len(set(test_dbs)))
+            for db in test_dbs:
+                mock_env.create_db.assert_any_call(
+                    db, template_db=snapshot_db, harness=self.harness)
+                mock_env.drop_db.assert_any_call(db, harness=self.harness)
+            self.assertEquals('postgres', mock_pool.connection.call_args[0][0])
+            cursor = mock_pool.connection.return_value.__enter__.return_value \
+                .cursor.return_value.__enter__.return_value
+            statements = [args[0].split('(')[0] for args, _ in cursor.execute.call_args_list]
+            key = cursor.execute.call_args_list[0][0][1]
+            self.assertEquals(
+                ['SELECT pg_advisory_lock', 'SELECT pg_advisory_lock_shared',
+                 'SELECT pg_advisory_unlock', 'SELECT pg_advisory_unlock_all'], statements)
+            self.assertEquals([key] * 3, [args[1] for args, _ in cursor.execute.call_args_list[:3]])
+
+    def test_snapshot_lock(self):
+        """
+        The snapshot is made under the exclusive lock and the tests run under the shared one,
+        which are given up even when a test fails.
+        """
+        events = []
+        cursor = MagicMock()
+        cursor.execute.side_effect = lambda query, *args: events.append(query.split('(')[0])
+
+        def execute(test, **kwargs):
+            events.append(os.path.basename(test))
+            if test.endswith('test_1.sql'):
+                raise PyPGTAPSubprocessError('failed', 3, test)
+            return ''
+
+        with patch.object(under_test, '_execute_sql_script', side_effect=execute), \
+                patch.object(under_test, 'postgres_env') as mock_env, \
+                patch.object(under_test, 'CONNECTION_POOL') as mock_pool, \
+                patch.object(under_test.PyPGTAPTestManager, '_get_db_glue_hash',
+                             return_value=None), \
+                patch.object(under_test.PyPGTAPTestManager, '_set_db_glue_hash'):
+            mock_pool.connection.return_value.__enter__.return_value.cursor.return_value \
+                .__enter__.return_value = cursor
+            mock_env.get_default_db_name.return_value = 'user'
+            manager = under_test.PyPGTAPTestManager(harness=self.harness)
+            with patch.object(manager, '_set_virtual_env_dir'), \
+                    patch.object(manager, '_set_project_dir'), \
+                    self.assertRaises(PyPGTAPSubprocessError):
+                manager.execute_project_test(self.project_dir)
+        self.assertEquals(
+            ['SELECT pg_advisory_lock', 'setup.sql', 'SELECT pg_advisory_lock_shared',
+             'SELECT pg_advisory_unlock'], events[:4])
+        self.assertIn('test_1.sql', events[4:-1])
+        self.assertTrue(set(events[4:-1]) <= set(['test_0.sql', 'test_1.sql', 'test_2.sql']))
+        self.assertEquals('SELECT pg_advisory_unlock_all', events[-1])
+
+    def test_reuse_snapshot(self):
+        """
+        A snapshot of the same setup is not made again.
+        """
+        with patch.object(under_test, '_execute_sql_script') as mock_executor, \
+                patch.object(under_test, 'postgres_env') as mock_env, \
+                patch.object(under_test, 'CONNECTION_POOL'), \
+                patch.object(under_test.PyPGTAPTestManager, '_get_db_glue_hash',
+                             return_value=self._setup_hash()), \
+                patch.object(under_test.PyPGTAPTestManager, '_set_db_glue_hash') \
+                as mock_set_hash:
+            manager = under_test.PyPGTAPTestManager(harness=self.harness)
+            with patch.object(manager, '_set_project_dir') as mock_set_project_dir:
+                manager.execute_project_test(self.project_dir)
+            self.assertEquals(0, mock_set_project_dir.call_count)
+            self.assertEquals(0, mock_set_hash.call_count)
+            self.assertEquals(
+                ['test_0.sql', 'test_1.sql', 'test_2.sql'],
+                sorted(os.path.basename(args[0]) for args, _ in mock_executor.call_args_list))
+            self.assertEquals(3, mock_env.create_db.call_count)
+
+    def test_setup_hashed_once(self):
+        """
+        The setup is hashed once per run, for the snapshot and for the hashes of the tests.
+        """
+        setup_hash = self._setup_hash()
+        result_cache = MagicMock()
+        with patch.object(under_test, '_execute_sql_script'), \
+                patch.object(under_test, 'postgres_env'), \
+                patch.object(under_test, 'CONNECTION_POOL'), \
+                patch.object(under_test.PyPGTAPTestManager, '_get_db_glue_hash',
+                             return_value=setup_hash), \
+                patch.object(under_test, 'get_setup_hash',
+                             wraps=under_test.get_setup_hash) as mock_hash:
+            manager = under_test.PyPGTAPTestManager(
+                harness=self.harness, result_cache=result_cache)
+            manager.execute_project_test(self.project_dir)
+        self.assertEquals(1, mock_hash.call_count)
+        (project_dir, outcomes), _ = result_cache.record.call_args
+        test = os.path.join(self.project_dir, 'tests', 'test_0.sql')
+        self.assertEquals(
+            under_test.get_test_hash(test, self.project_dir, setup_hash), outcomes[test][0])
+        self.assertEquals(manager.get_test_hashes(self.project_dir, [test])[test],
+                          outcomes[test][0])
+
+
+class StreamProcessOutputTest(unittest.TestCase):
+
+    """Tests under_test._stream_process_output"""
+
+    def test_lines_arrive_while_running(self):
+        lines = []
+        stdout, stderr, returncode = under_test._stream_process_output(
+            ['sh', '-c', 'echo ok 1; echo oops >&2; echo ok 2; exit 3'],
+            lines.append)
+        self.assertEquals(['ok 1\n', 'ok 2\n'], lines)
+        self.assertEquals('ok 1\nok 2\n', stdout)
+        self.assertEquals('oops\n', stderr)
+        self.assertEquals(3, returncode)
+
+    def test_without_keeping_output(self):
+        lines = []
+        stdout, _, _ = under_test._stream_process_output(
+            ['sh', '-c', 'echo ok 1'], lines.append, keep_output=False)
+        self.assertEquals(['ok 1\n'], lines)
+        self.assertEquals('', stdout)
+
+    def test_callback_kills_process(self):
+        """
+        The process is killed as soon as the callback raises, it does not
+        get to finish.
+        """
+        def line_callback(line):
+            raise PyPGTAPAbort(line)
+
+        start = time.time()
+        with self.assertRaises(PyPGTAPAbort):
+            under_test._stream_process_output(
+                ['sh', '-c', 'echo not ok 1; exec sleep 30'], line_callback)
+        self.assertTrue(time.time() - start < 10)
+
+
+class ExecuteSQLScriptTest(unittest.TestCase):
+
+    """Tests under_test._execute_sql_script with a fake psql in the PATH"""
+
+    def setUp(self):
+        self.bin_dir = tempfile.mkdtemp()
+        self.psql = os.path.join(self.bin_dir, 'psql')
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.bin_dir + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.bin_dir)
+
+    def _fake_psql(self, script):
+        with open(self.psql, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(self.psql, 0755)
+
+    def test_output(self):
+        self._fake_psql('echo 1..1; echo ok 1\n')
+        lines = []
+        self.assertEquals(
+            '1..1\nok 1\n', under_test._execute_sql_script('test_a.sql'))
+        self.assertEquals(
+            '1..1\nok 1\n', under_test._execute_sql_script(
+                'test_a.sql', line_callback=lines.append))
+        self.assertEquals(['1..1\n', 'ok 1\n'], lines)
+
+    def test_error(self):
+        self._fake_psql('echo ok 1; echo "ERROR: boom" >&2; exit 3\n')
+        for line_callback in (None, lambda line: None):
+            with self.assertRaises(PyPGTAPSubprocessError) as info:
+                under_test._execute_sql_script(
+                    'test_a.sql', line_callback=line_callback)
+            self.assertEquals(3, info.exception.rc)
+            self.assertIn('ERROR: boom', info.exception.msg)
+
+    def test_connection_environment(self):
+        """
+        The commands a script runs with \\! connect to the script's database.
+        """
+        self._fake_psql('echo $PGDATABASE $PGHOST $PGPORT\n')
+        self.assertEquals(
+            'db /tmp/h 5433\n', under_test._execute_sql_script(
+                'test_a.sql', dbname='db',
+                harness=Harness('data_dir', port=5433, socket_dir='/tmp/h')))
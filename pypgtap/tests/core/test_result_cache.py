@@ -0,0 +1,119 @@
+"""
+Unit tests for the result cache of incremental test runs in
+pypgtap.core.test_kit.result_cache.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from pypgtap.core.test_kit import pypgtap_testing
+from pypgtap.core.test_kit import result_cache as under_test
+from pypgtap.core.test_kit.utils import Harness
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    """Tests the test hashes, the outcomes and the cache"""
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.project_dir, 'tests', 'common'))
+        os.makedirs(os.path.join(self.project_dir, 'fixtures'))
+        self.test_file = os.path.join(self.project_dir, 'tests', 'test_events.sql')
+        self._write('tests/test_events.sql', (
+            "\\ir common/load.sql\n"
+            "SELECT ok(true);\n"))
+        self._write('tests/common/load.sql', (
+            "SELECT copy_json('public', 'events', 'fixtures/events.json', "
+            "'fixtures/paths.json');\n"
+            "\\! load_json public users fixtures/users.json fixtures/paths.json\n"))
+        for fixture in ('events.json', 'users.json', 'paths.json'):
+            self._write('fixtures/' + fixture, '{}')
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.project_dir, name), 'w') as f:
+            f.write(content)
+
+    def _hash(self):
+        return under_test.get_test_hash(self.test_file, self.project_dir)
+
+    def test_test_hash(self):
+        """
+        The hash changes with the included scripts and the fixtures of the copy_json call and
+        of the \\! command.
+        """
+        hashes = set([self._hash()])
+        self._write('tests/common/load.sql', '-- no more loading\n')
+        hashes.add(self._hash())
+        self._write('tests/common/load.sql', (
+            "SELECT copy_json('public', 'events', 'fixtures/events.json', "
+            "'fixtures/paths.json');\n"
+            "\\! load_json public users fixtures/users.json fixtures/paths.json\n"))
+        self.assertIn(self._hash(), hashes)
+        for fixture in ('events.json', 'users.json'):
+            self._write('fixtures/' + fixture, '{"changed": true}')
+            hashes.add(self._hash())
+        self.assertEquals(4, len(hashes))
+        self.assertNotEquals(
+            self._hash(),
+            under_test.get_test_hash(self.test_file, self.project_dir, 'setup'))
+
+    def test_outcomes(self):
+        lines = []
+        outcomes = under_test.TestOutcomes(lambda test, line: lines.append(line))
+        for line in ('1..2\n', 'ok 1\n', 'not ok 2 # TODO later\n'):
+            outcomes('a.sql', line)
+        for line in ('1..3\n', 'ok 1\n', 'ok 2\n'):
+            outcomes('b.sql', line)
+        outcomes('c.sql', 'not ok 1\n')
+        outcomes('d.sql', 'Bail out!\n')
+        self.assertTrue(outcomes.passed('a.sql'))
+        for test in ('b.sql', 'c.sql', 'd.sql', 'e.sql'):
+            self.assertFalse(outcomes.passed(test), msg=test)
+        self.assertEquals(8, len(lines))
+
+    def test_record(self):
+        cache_dir = os.path.join(self.project_dir, 'cache')
+        cache = under_test.ResultCache(cache_dir)
+        cache.record(self.project_dir, {self.test_file: ('hash', True)})
+        self.assertTrue(cache.passed(self.project_dir, self.test_file, 'hash'))
+        self.assertFalse(cache.passed(self.project_dir, self.test_file, 'other'))
+        # A new cache reads what was saved
+        cache = under_test.ResultCache(cache_dir)
+        self.assertTrue(cache.passed(self.project_dir, self.test_file, 'hash'))
+        cache.record(self.project_dir, {self.test_file: ('hash', False)})
+        self.assertFalse(cache.passed(self.project_dir, self.test_file, 'hash'))
+
+    def test_changed_only(self):
+        """
+        Only the tests that did not pass or changed since are executed again.
+        """
+        self._write('tests/test_users.sql', "SELECT ok(true);\n")
+        cache = under_test.ResultCache(os.path.join(self.project_dir, 'cache'))
+
+        def execute(test, line_callback=None, **kwargs):
+            passed = not test.endswith('test_users.sql')
+            line_callback('ok 1\n' if passed else 'not ok 1\n')
+            return test
+
+        with patch.object(pypgtap_testing, '_execute_sql_script', side_effect=execute) \
+                as mock_executor:
+            manager = pypgtap_testing.PyPGTAPTestManager(
+                harness=Harness('data_dir'), result_cache=cache)
+            with patch.object(manager, '_set_virtual_env_dir'), \
+                    patch.object(manager, '_set_project_dir'):
+                self.assertEquals(
+                    2, len(manager.execute_project_test(self.project_dir, changed_only=True)))
+                self.assertEquals(
+                    [os.path.join(self.project_dir, 'tests', 'test_users.sql')],
+                    manager.execute_project_test(self.project_dir, changed_only=True))
+                self._write('fixtures/events.json', '{"changed": true}')
+                self.assertEquals(
+                    2, len(manager.execute_project_test(self.project_dir, changed_only=True)))
+            self.assertEquals(5, mock_executor.call_count)
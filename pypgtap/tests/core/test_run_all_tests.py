@@ -0,0 +1,129 @@
+"""
+Unit tests for the streaming TAP checks and the watch mode of
+pypgtap.test_kit_scripts.run_all_tests.
+"""
+from contextlib import contextmanager
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from pypgtap.core.test_kit import pypgtap_testing
+from pypgtap.core.test_kit.pypgtap_error import PyPGTAPAbort, \
+    PyPGTAPSubprocessError
+from pypgtap.core.test_kit.utils import Harness
+from pypgtap.test_kit_scripts import run_all_tests as under_test
+
+
+class TAPLineReporterTest(unittest.TestCase):
+
+    """Tests under_test.is_failure_line and under_test.TAPLineReporter"""
+
+    def test_is_failure_line(self):
+        self.assertTrue(under_test.is_failure_line('not ok 2 - login\n'))
+        self.assertTrue(under_test.is_failure_line('Bail out! no database\n'))
+        self.assertTrue(under_test.is_failure_line('not ok 3 # skip later\n'))
+        self.assertFalse(under_test.is_failure_line('ok 1 - login\n'))
+        self.assertFalse(under_test.is_failure_line('# not ok in a comment\n'))
+        self.assertFalse(
+            under_test.is_failure_line('not ok 4 - loop # TODO halting\n'))
+
+    def test_fail_fast(self):
+        reporter = under_test.TAPLineReporter(fail_fast=True)
+        reporter('test_a.sql', 'ok 1\n')
+        self.assertFalse(reporter.failed)
+        with self.assertRaises(PyPGTAPAbort):
+            reporter('test_a.sql', 'not ok 2\n')
+        self.assertTrue(reporter.failed)
+
+    def test_no_fail_fast(self):
+        reporter = under_test.TAPLineReporter()
+        reporter('test_a.sql', 'Bail out!\n')
+        self.assertTrue(reporter.failed)
+
+
+class WatchTest(unittest.TestCase):
+
+    """Tests under_test.watch_tests"""
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.project_dir, 'tests'))
+        self._write('tests/common.sql', 'SELECT 1;')
+        self._write('tests/test_a.sql', '\\ir common.sql\nSELECT ok(true);')
+        self._write('tests/test_b.sql', 'SELECT ok(true);')
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.project_dir, name), 'w') as f:
+            f.write(content)
+
+    def _watch(self, changes, execute=None):
+        """
+        Watches the project for len(changes) + 1 rounds, making a change before every round but
+        the first.
+
+        :return: The tests run in every round that ran some, by name. The number of scripts
+            executed is left in self.executions.
+        """
+        manager = pypgtap_testing.PyPGTAPTestManager(harness=Harness('data_dir'))
+        rounds = len(changes) + 1
+        changes = iter(changes)
+
+        @contextmanager
+        def shared_manager(*args, **kwargs):
+            yield manager
+
+        def passing(test, line_callback=None, **kwargs):
+            line_callback('1..1\n')
+            line_callback('ok 1\n')
+            return ''
+
+        with patch.object(under_test, '_shared_manager', shared_manager), \
+                patch.object(under_test.time, 'sleep', side_effect=lambda _: next(changes)()), \
+                patch.object(pypgtap_testing, '_execute_sql_script',
+                             side_effect=execute or passing) as mock_executor, \
+                patch.object(under_test, '_run_changed_tests',
+                             wraps=under_test._run_changed_tests) as mock_run, \
+                patch.object(manager, '_set_virtual_env_dir'), \
+                patch.object(manager, '_set_project_dir'):
+            under_test.watch_tests([self.project_dir], rounds=rounds)
+        self.executions = mock_executor.call_count
+        return [[os.path.basename(test) for test in args[2]]
+                for args, _ in mock_run.call_args_list]
+
+    def test_watch(self):
+        """
+        All the tests run first, then only the ones whose file or included files changed.
+        """
+        self.assertEquals(
+            [['test_a.sql', 'test_b.sql'], ['test_a.sql'], ['test_b.sql']],
+            self._watch([
+                lambda: None,
+                lambda: self._write('tests/common.sql', 'SELECT 42;'),
+                lambda: self._write('tests/test_b.sql', 'SELECT ok(false);')]))
+        self.assertEquals(4, self.executions)
+
+    def test_watch_psql_error(self):
+        """
+        The tests a psql error kept from running run again on the next change, the ones that
+        ran don't.
+        """
+        self._write('tests/test_c.sql', 'SELECT ok(true);')
+
+        def execute(test, line_callback=None, **kwargs):
+            if os.path.basename(test) == 'test_b.sql':
+                raise PyPGTAPSubprocessError('psql: could not connect', 2, test)
+            line_callback('1..1\n')
+            line_callback('ok 1\n')
+            return ''
+
+        self.assertEquals(
+            [['test_a.sql', 'test_b.sql', 'test_c.sql'], ['test_b.sql', 'test_c.sql']],
+            self._watch([
+                lambda: None,
+                lambda: self._write('notes.txt', 'not a test')], execute))
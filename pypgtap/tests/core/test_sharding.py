@@ -0,0 +1,77 @@
+"""
+Unit tests for the duration balanced shards of pypgtap.core.test_kit.sharding.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+from pypgtap.core.test_kit import sharding as under_test
+
+
+class ShardingTest(unittest.TestCase):
+
+    """Tests the shards and the recorded durations"""
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+
+    def test_parse_shard(self):
+        self.assertEquals((2, 4), under_test.parse_shard('2/4'))
+        for shard in ('0/4', '5/4', '2', 'a/b', '1/2/3'):
+            with self.assertRaises(ValueError):
+                under_test.parse_shard(shard)
+
+    def test_balanced(self):
+        """
+        The longest tests go first into the least loaded shard, every test is in exactly one
+        shard and the shards keep the order of the tests.
+        """
+        durations = {'a': 10, 'b': 7, 'c': 5, 'd': 4, 'e': 3, 'f': 1}
+        tests = sorted(durations)
+        shards = [under_test.shard_tests(tests, durations, k, 2) for k in (1, 2)]
+        self.assertEquals([['a', 'd', 'f'], ['b', 'c', 'e']], shards)
+        self.assertEquals(
+            shards, [under_test.shard_tests(list(reversed(tests)), durations, k, 2)[::-1]
+                     for k in (1, 2)])
+
+    def test_fallback(self):
+        """
+        Without durations the tests are dealt out round robin by name, and new tests are taken
+        to last the mean of the known ones.
+        """
+        tests = ['t{}'.format(i) for i in xrange(5)]
+        self.assertEquals(['t0', 't3'], under_test.shard_tests(tests, {}, 1, 3))
+        self.assertEquals(['t1', 't4'], under_test.shard_tests(tests, {}, 2, 3))
+        self.assertEquals([], under_test.shard_tests(tests[:1], {}, 2, 2))
+        durations = {'t0': 9, 't1': 1}
+        self.assertEquals(['t0', 't4'], under_test.shard_tests(tests, durations, 1, 2))
+        self.assertEquals(['t1', 't2', 't3'], under_test.shard_tests(tests, durations, 2, 2))
+
+    def test_record_durations(self):
+        test = os.path.join(self.project_dir, 'tests', 'test_a.sql')
+        other = os.path.join(self.project_dir, 'tests', 'test_b.sql')
+        under_test.record_durations(self.project_dir, {test: 1.23456, other: 2})
+        under_test.record_durations(self.project_dir, {test: 3})
+        with open(os.path.join(self.project_dir, under_test.DURATIONS_FILE)) as f:
+            self.assertEquals(
+                {'tests/test_a.sql': 3, 'tests/test_b.sql': 2}, json.load(f))
+        self.assertEquals(
+            {test: 3, other: 2}, under_test.load_durations([self.project_dir]))
+        self.assertEquals({}, under_test.load_durations(['/does/not/exist']))
+
+    def test_record_durations_unwritable(self):
+        """
+        A project dir that can't be written only gets a warning, and no half written file.
+        """
+        test = os.path.join(self.project_dir, 'tests', 'test_a.sql')
+        with patch.object(under_test, 'write_json_atomically', side_effect=OSError('denied')), \
+                patch.object(under_test, '_logger') as mock_logger:
+            under_test.record_durations(self.project_dir, {test: 1})
+        self.assertEquals(1, mock_logger.warn.call_count)
+        self.assertEquals([], os.listdir(self.project_dir))
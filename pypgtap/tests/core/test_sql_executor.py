@@ -0,0 +1,193 @@
+"""
+Unit tests for the in process psql emulation in
+pypgtap.core.test_kit.sql_executor. The connection is faked; See the
+integration tests for executing scripts on the harness.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+import psycopg2 as psyc
+from psycopg2 import extensions
+
+from pypgtap.core.test_kit import sql_executor as under_test
+from pypgtap.core.test_kit.pypgtap_error import PyPGTAPScriptError
+
+
+class SplitPsqlScriptTest(unittest.TestCase):
+
+    """Tests under_test.split_psql_script"""
+
+    def test_quoting(self):
+        """
+        Semicolons in strings, identifiers, dollar quotes, comments and
+        parentheses don't end a query.
+        """
+        script = """
+            -- a comment; with a semicolon
+            SELECT 'a;b', "c;d", E'\\';';
+            CREATE FUNCTION f() RETURNS int AS $body$ SELECT 1; $body$
+                LANGUAGE sql;
+            /* a /* nested; */ comment */ SELECT $$;$$, $1
+            ;
+            CREATE RULE r AS ON INSERT TO t DO INSTEAD (SELECT 1; SELECT 2);
+            SELECT 'unterminated at the end'"""
+        queries = [item[1] for item in under_test.split_psql_script(script)]
+        self.assertEquals(5, len(queries))
+        self.assertTrue(queries[0].endswith("""SELECT 'a;b', "c;d", E'\\';'"""))
+        self.assertTrue(queries[1].endswith('LANGUAGE sql'))
+        self.assertTrue(queries[2].endswith('SELECT $$;$$, $1'))
+        self.assertTrue(queries[3].endswith('(SELECT 1; SELECT 2)'))
+        self.assertEquals("SELECT 'unterminated at the end'", queries[4])
+
+    def test_meta_commands(self):
+        """
+        Meta-commands are returned with their arguments and line numbers and
+        \\g executes the query buffer.
+        """
+        script = "BEGIN;\n\\ir 'other.sql'\nSELECT 1 \\g\n\\set ON_ERROR_STOP off\n"
+        self.assertEquals([
+            ('query', 'BEGIN', 1),
+            ('meta', 'ir', "'other.sql'", 2),
+            ('query', 'SELECT 1', 3),
+            ('meta', 'set', 'ON_ERROR_STOP off', 4)],
+            list(under_test.split_psql_script(script)))
+
+    def test_comments_only(self):
+        self.assertEquals(
+            [], list(under_test.split_psql_script('-- nothing\n/* here */\n')))
+
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.statusmessage = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query):
+        self.conn.executed.append(query)
+        self.description = None
+        self.statusmessage = query.split()[0].upper()
+        if query.startswith('SELECT oid FROM pg_type'):
+            self.description, self._rows = [('oid',)], [(25,)]
+        elif query in self.conn.results:
+            self.description, self._rows = [('c',)], self.conn.results[query]
+        elif query == 'BEGIN':
+            self.conn.status = extensions.TRANSACTION_STATUS_INTRANS
+        elif query.startswith(('COMMIT', 'ROLLBACK', 'DISCARD')) \
+                and not query.startswith('ROLLBACK TO'):
+            self.conn.status = extensions.TRANSACTION_STATUS_IDLE
+        elif query.startswith('ROLLBACK TO'):
+            self.conn.status = extensions.TRANSACTION_STATUS_INTRANS
+        elif query.startswith('FAIL'):
+            if self.conn.status == extensions.TRANSACTION_STATUS_INTRANS:
+                self.conn.status = extensions.TRANSACTION_STATUS_INERROR
+            raise psyc.ProgrammingError()
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConnection(object):
+
+    def __init__(self, results):
+        self.results = results
+        self.executed = []
+        self.notices = []
+        self.closed = False
+        self.autocommit = False
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def close(self):
+        self.closed = True
+
+
+class SQLScriptExecutorTest(unittest.TestCase):
+
+    """Tests under_test.SQLScriptExecutor with a fake connection"""
+
+    def setUp(self):
+        self.script_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.script_dir)
+
+    def _write_script(self, name, text):
+        path = os.path.join(self.script_dir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def _execute(self, script, results=None, **kwargs):
+        conn = FakeConnection(results or {})
+        with patch.object(under_test.psyc, 'connect', return_value=conn), \
+                patch.object(under_test.extensions, 'register_type'):
+            with under_test.SQLScriptExecutor(
+                    dbname='db', user_name='user', **kwargs) as executor:
+                return executor.execute_script(script), conn
+
+    def test_output_format(self):
+        """
+        Rows are printed unaligned and tuples only, NULLs as empty strings
+        and included scripts are resolved relative to the including one.
+        """
+        self._write_script('included.sql', 'SELECT 2;\n')
+        script = self._write_script(
+            'test_main.sql', 'SELECT 1;\n\\ir included.sql\n')
+        output, conn = self._execute(script, results={
+            'SELECT 1': [('1..2', None)], 'SELECT 2': [('ok 1',), ('ok 2',)]})
+        self.assertEquals('1..2|\nok 1\nok 2\n', output)
+        self.assertTrue(conn.autocommit)
+        self.assertEquals('DISCARD ALL', conn.executed[-1])
+
+    def test_on_error_rollback(self):
+        """
+        Inside a transaction every query runs in a savepoint that is rolled
+        back to when the query fails and ON_ERROR_STOP is off.
+        """
+        script = self._write_script(
+            'test_rollback.sql', 'BEGIN;\nFAIL;\nSELECT 1;\nROLLBACK;\n')
+        output, conn = self._execute(
+            script, results={'SELECT 1': [('ok 1',)]}, on_error_stop=False)
+        self.assertEquals('ok 1\n', output)
+        self.assertEquals([
+            'BEGIN', 'SAVEPOINT pg_psql_temporary_savepoint', 'FAIL',
+            'ROLLBACK TO pg_psql_temporary_savepoint',
+            'SAVEPOINT pg_psql_temporary_savepoint', 'SELECT 1',
+            'RELEASE pg_psql_temporary_savepoint',
+            'SAVEPOINT pg_psql_temporary_savepoint', 'ROLLBACK',
+            'DISCARD ALL'], conn.executed[1:])
+
+    def test_on_error_stop(self):
+        """
+        With ON_ERROR_STOP a failing query stops the script with the psql
+        exit code and the open transaction is rolled back.
+        """
+        script = self._write_script(
+            'test_stop.sql', 'BEGIN;\nFAIL;\nSELECT 1;\n')
+        with self.assertRaises(PyPGTAPScriptError) as info:
+            self._execute(script)
+        self.assertEquals(under_test.ON_ERROR_STOP_RC, info.exception.rc)
+        self.assertEquals(script, info.exception.cmd)
+        self.assertIn('test_stop.sql:2', info.exception.msg)
+
+    def test_unsupported_meta_command(self):
+        script = self._write_script('test_copy.sql', '\\copy t from stdin\n')
+        with self.assertRaises(PyPGTAPScriptError):
+            self._execute(script)
@@ -0,0 +1,178 @@
+"""
+Unit tests for the harness settings in pypgtap.core.test_kit.utils
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import MagicMock, patch
+
+from pypgtap.core.test_kit import utils as under_test
+
+
+class HarnessTest(unittest.TestCase):
+
+    """Tests under_test.Harness and under_test.current_harness"""
+
+    def test_default_harness(self):
+        """
+        The default harness uses the libpq defaults so clients behave like
+        they always did.
+        """
+        harness = under_test.Harness.default()
+        self.assertEquals(under_test.PG_HARNESS_DATA_DIR, harness.data_dir)
+        self.assertEquals([], harness.client_args())
+        self.assertEquals({}, harness.connect_kwargs())
+        self.assertEquals('-h localhost -k /tmp', harness.server_options())
+
+    def test_isolated_harnesses(self):
+        """
+        Allocated harnesses don't share anything and can be loaded by other
+        processes through the PYPGTAP_HARNESS environment variable.
+        """
+        harness = under_test.Harness.allocate()
+        other_harness = under_test.Harness.allocate()
+        try:
+            self.assertNotEquals(harness.root_dir, other_harness.root_dir)
+            self.assertNotEquals(harness.data_dir, other_harness.data_dir)
+            self.assertNotEquals(harness.socket_dir, other_harness.socket_dir)
+            self.assertEquals(
+                ['-h', harness.socket_dir, '-p', str(harness.port)],
+                harness.client_args())
+            self.assertEquals(
+                {'host': harness.socket_dir, 'port': harness.port},
+                harness.connect_kwargs())
+            self.assertIn('-p {}'.format(harness.port), harness.server_options())
+            with patch.dict(os.environ, {
+                    under_test.PYPGTAP_HARNESS_ENV: harness.root_dir}):
+                self.assertEquals(harness, under_test.current_harness())
+        finally:
+            shutil.rmtree(harness.root_dir)
+            shutil.rmtree(other_harness.root_dir)
+
+    def test_current_harness_default(self):
+        with patch.dict(os.environ, {under_test.PYPGTAP_HARNESS_ENV: ''}):
+            self.assertEquals(
+                under_test.Harness.default(), under_test.current_harness())
+
+
+def _connection():
+    conn = MagicMock(closed=0)
+    conn.get_transaction_status.return_value = (
+        under_test.extensions.TRANSACTION_STATUS_IDLE)
+    conn.close.side_effect = lambda: setattr(conn, 'closed', 1)
+    return conn
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    """Tests under_test.ConnectionPool"""
+
+    def setUp(self):
+        self.pool = under_test.ConnectionPool(max_size=2, timeout=0.2)
+        self.harness = under_test.Harness.default()
+        patcher = patch.object(
+            under_test.psyc, 'connect', side_effect=lambda **_: _connection())
+        self.mock_connect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse(self):
+        """
+        Connections are reused per database and reset when they come back.
+        """
+        with self.pool.connection('db', 'me', self.harness) as conn:
+            pass
+        conn.reset.assert_called_once_with()
+        with self.pool.connection('db', 'me', self.harness) as same_conn:
+            with self.pool.connection('db', 'me', self.harness) as new_conn:
+                pass
+        with self.pool.connection('other_db', 'me', self.harness):
+            pass
+        self.assertIs(conn, same_conn)
+        self.assertIsNot(conn, new_conn)
+        self.assertEquals(3, self.mock_connect.call_count)
+        self.mock_connect.assert_called_with(dbname='other_db', user='me')
+
+    def test_health_check(self):
+        """
+        Closed, broken and long idle connections that fail a query are
+        replaced.
+        """
+        with self.pool.connection('db', 'me', self.harness) as conn:
+            conn.reset.side_effect = under_test.psyc.OperationalError
+        with self.pool.connection('db', 'me', self.harness) as conn2:
+            pass
+        self.assertIsNot(conn, conn2)
+        with patch.object(under_test, 'POOL_HEALTH_CHECK_AFTER', 0):
+            conn2.cursor.side_effect = under_test.psyc.OperationalError
+            with self.pool.connection('db', 'me', self.harness) as conn3:
+                pass
+        self.assertIsNot(conn2, conn3)
+        self.assertTrue(conn2.closed)
+
+    def test_size_limit(self):
+        """
+        Callers beyond the size limit wait for a connection to come back, or
+        fail after the timeout.
+        """
+        first = self.pool.getconn('db', 'me', self.harness)
+        second = self.pool.getconn('db', 'me', self.harness)
+        with self.assertRaises(EnvironmentError):
+            self.pool.getconn('db', 'me', self.harness)
+        timer = threading.Timer(
+            0.05, self.pool.putconn, (first, 'db', 'me', self.harness))
+        timer.start()
+        self.assertIs(first, self.pool.getconn('db', 'me', self.harness))
+        timer.join()
+        self.pool.putconn(second, 'db', 'me', self.harness)
+
+    def test_close(self):
+        """
+        Only the idle connections of the given database and harness are
+        closed.
+        """
+        with self.pool.connection('db', 'me', self.harness) as conn:
+            with self.pool.connection('other_db', 'me', self.harness) as other:
+                pass
+        other_harness = under_test.Harness.allocate()
+        self.addCleanup(shutil.rmtree, other_harness.root_dir)
+        self.pool.close(dbname='db', harness=other_harness)
+        self.assertFalse(conn.closed)
+        self.pool.close(dbname='db', harness=self.harness)
+        self.assertTrue(conn.closed)
+        self.assertFalse(other.closed)
+        self.pool.close()
+        self.assertTrue(other.closed)
+
+
+class WriteJSONAtomicallyTest(unittest.TestCase):
+
+    """Tests under_test.write_json_atomically"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write(self):
+        under_test.write_json_atomically(self.path, {'b': 1, 'a': [2]})
+        under_test.write_json_atomically(self.path, {'a': 3})
+        with open(self.path) as f:
+            self.assertEquals({'a': 3}, json.load(f))
+        self.assertEquals(['data.json'], os.listdir(self.dir))
+
+    def test_failed_write(self):
+        """
+        A write that fails leaves the file as it was and nothing aside.
+        """
+        under_test.write_json_atomically(self.path, {'a': 1})
+        with self.assertRaises(TypeError):
+            under_test.write_json_atomically(self.path, {'a': object()})
+        with open(self.path) as f:
+            self.assertEquals({'a': 1}, json.load(f))
+        self.assertEquals(['data.json'], os.listdir(self.dir))
@@ -1,7 +1,12 @@
+import bz2
+import gzip
 import json
+import os
+import shutil
+import tempfile
 import unittest
 
-from mock import patch, mock_open, call
+from mock import MagicMock, patch, mock_open, call
 import pypgtap.core.glue.utils as under_test_module
 
 
@@ -57,3 +62,219 @@ class TestJSONPathParsing(unittest.TestCase):
             self.assertSequenceEqual(
                 test_values, [json.dumps(test_json['key1']),
                 None, json.dumps(test_json['key4']), None])
+
+    def test_simple_and_complex_paths(self):
+        """
+        Simple paths are looked up directly and give the same values as jsonpath_rw, a JSON
+        null is not a missing value and complex paths still go through jsonpath_rw.
+        """
+        mock_json_path_file = mock_open(read_data=json.dumps({"jsonpaths": [
+            "$.a.b[1]", "$['a']['c']", "$.a.d", "$.a.b[5]", "$..inner", "$.a.b[*]"]}))
+        self.assertEquals(('a', 'b', 1), under_test_module._compile_simple_json_path('$.a.b[1]'))
+        self.assertIsNone(under_test_module._compile_simple_json_path('$..inner'))
+        with patch('__builtin__.open', mock_json_path_file, create=True):
+            parse_function = under_test_module.get_json_path_parser_fn("does_not_matter")
+        test_json_str = """{"a": {"b": [1, {"x": "\u00e9"}], "c": null, "inner": 7}}"""
+        with patch.object(under_test_module.json, 'loads', wraps=json.loads) as mock_loads:
+            with self.assertRaises(ValueError):
+                # $.a.b[*] matches both elements of b
+                parse_function(test_json_str)
+            self.assertEquals(1, mock_loads.call_count)
+        mock_json_path_file = mock_open(read_data=json.dumps({"jsonpaths": [
+            "$.a.b[1]", "$['a']['c']", "$.a.d", "$.a.b[5]", "$..inner"]}))
+        with patch('__builtin__.open', mock_json_path_file, create=True):
+            parse_function = under_test_module.get_json_path_parser_fn("does_not_matter")
+        self.assertSequenceEqual(
+            ['{"x": "\\u00e9"}', 'null', None, None, '7'], parse_function(test_json_str))
+
+
+class TestCopyJSON(unittest.TestCase):
+
+    """This test suite tests the batched inserts of copy_json in pypgtap.core.glue.utils"""
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.project_dir, 'paths.json'), 'w') as f:
+            f.write('{"jsonpaths": ["$.a", "$.b"]}')
+        with open(os.path.join(self.project_dir, 'data.json'), 'w') as f:
+            for i in xrange(5):
+                f.write('{"a": %d}\n' % i)
+        self.database_accessor = MagicMock()
+        # The plans are their statements
+        self.database_accessor.prepare.side_effect = lambda statement, types: statement
+        self.database_accessor.execute.side_effect = self._execute
+        self.table_version = '100'
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+
+    def _execute(self, plan, values):
+        if 'pg_class' in plan:
+            return [{'oid': 16384, 'xmin': self.table_version}]
+        if 'information_schema' in plan:
+            return [{'column_name': 'a', 'data_type': 'integer'},
+                    {'column_name': 'b', 'data_type': 'text'}]
+
+    def _statements(self, mock_method):
+        return [args[0] for args, _ in mock_method.call_args_list]
+
+    def test_batches(self):
+        """
+        The lines are inserted two at a time in column order with nulls for the missing
+        values, and the last batch has the remaining line.
+        """
+        under_test_module.copy_json(
+            self.project_dir, 's', 't', 'data.json', 'paths.json', self.database_accessor,
+            batch_size=2)
+        prepares = self.database_accessor.prepare.call_args_list[2:]
+        self.assertEquals(
+            [call('INSERT into s.t values ($1, $2), ($3, $4)', ['integer', 'text'] * 2),
+             call('INSERT into s.t values ($1, $2)', ['integer', 'text'])],
+            prepares)
+        inserted = [args[1] for args, _ in self.database_accessor.execute.call_args_list[2:]]
+        self.assertEquals(
+            [['0', None, '1', None], ['2', None, '3', None], ['4', None]], inserted)
+
+    def test_bad_batch_size(self):
+        with self.assertRaises(ValueError):
+            under_test_module.copy_json(
+                self.project_dir, 's', 't', 'data.json', 'paths.json',
+                self.database_accessor, batch_size=0)
+
+    def test_cache(self):
+        """
+        With a cache the table's columns, the plans and the parsed JSONPaths are reused until
+        the table or the JSONPath file change.
+        """
+        cache = {}
+        copy_json = lambda: under_test_module.copy_json(
+            self.project_dir, 's', 't', 'data.json', 'paths.json', self.database_accessor,
+            cache=cache)
+        with patch.object(under_test_module, 'get_json_path_parser_fn',
+                          wraps=under_test_module.get_json_path_parser_fn) as mock_get_parser:
+            copy_json()
+            copy_json()
+            self.assertEquals(1, mock_get_parser.call_count)
+            statements = self._statements(self.database_accessor.execute)
+            self.assertEquals(1, sum('information_schema' in p for p in statements))
+            self.assertEquals(
+                1, sum(p.startswith('INSERT') for p in
+                       self._statements(self.database_accessor.prepare)))
+            # The table was altered
+            self.table_version = '101'
+            copy_json()
+            statements = self._statements(self.database_accessor.execute)
+            self.assertEquals(2, sum('information_schema' in p for p in statements))
+            paths = os.path.join(self.project_dir, 'paths.json')
+            os.utime(paths, (0, 0))
+            copy_json()
+            self.assertEquals(2, mock_get_parser.call_count)
+
+
+class TestOpenFixture(unittest.TestCase):
+
+    """This test suite tests open_fixture in pypgtap.core.glue.utils"""
+
+    def setUp(self):
+        self.fixture_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.fixture_dir)
+
+    def test_formats(self):
+        """
+        Plain, empty, gzip and bzip2 files give the same lines.
+        """
+        data = ''.join('{"a": %d}\n' % i for i in xrange(1000)) + '{"last": "no newline"}'
+        paths = {}
+        for name, opener in (('data.json', open), ('data.json.gz', gzip.open),
+                             ('data.json.bz2', bz2.BZ2File)):
+            paths[name] = os.path.join(self.fixture_dir, name)
+            f = opener(paths[name], 'wb')
+            f.write(data)
+            f.close()
+        for path in paths.values():
+            with under_test_module.open_fixture(path) as lines:
+                self.assertEquals(data.splitlines(True), list(lines), msg=path)
+        empty = os.path.join(self.fixture_dir, 'empty.json')
+        open(empty, 'w').close()
+        with under_test_module.open_fixture(empty) as lines:
+            self.assertEquals([], list(lines))
+
+
+class TestCopyDelimited(unittest.TestCase):
+
+    """This test suite tests the COPY statements of copy_delimited in pypgtap.core.glue.utils"""
+
+    def setUp(self):
+        self.database_accessor = MagicMock()
+        self.database_accessor.quote_ident.side_effect = lambda name: '"{}"'.format(name)
+        self.database_accessor.quote_literal.side_effect = lambda value: "'{}'".format(value)
+        self.database_accessor.execute.return_value = [{'datestyle': 'ISO, MDY'}]
+
+    def _statements(self):
+        return [args[0] for args, _ in self.database_accessor.execute.call_args_list]
+
+    def _copy(self, data_file, **kwargs):
+        under_test_module.copy_delimited(
+            '/project', 's', 't', data_file, self.database_accessor, **kwargs)
+        return self._statements()
+
+    def test_defaults(self):
+        """
+        Without ESCAPE backslashes are plain characters and \\N is null, like in Redshift.
+        """
+        self.assertEquals(
+            ["COPY \"s\".\"t\" FROM '/project/data.txt' WITH "
+             "(FORMAT csv, QUOTE E'\\x01', DELIMITER '|', NULL '\\N')"],
+            self._copy('data.txt'))
+
+    def test_options(self):
+        self.assertEquals(
+            ["COPY \"s\".\"t\" FROM '/project/data.csv' WITH "
+             "(FORMAT csv, DELIMITER ';', NULL 'nil', HEADER true)"],
+            self._copy('data.csv', csv=True, delimiter=';', null_as='nil', ignore_header=1))
+        self.database_accessor.execute.reset_mock()
+        self.assertEquals(
+            ["COPY \"s\".\"t\" FROM '/project/data.txt' WITH (FORMAT text, DELIMITER '\t')"],
+            self._copy('data.txt', escape=True, delimiter='\t'))
+
+    def test_program(self):
+        """
+        Compressed files and more than one header line are read through a program.
+        """
+        self.assertEquals(
+            ["COPY \"s\".\"t\" FROM PROGRAM 'gzip -dc /project/data.csv.gz' WITH "
+             "(FORMAT csv, DELIMITER ',', HEADER true)"],
+            self._copy('data.csv.gz', csv=True, ignore_header=1))
+        self.database_accessor.execute.reset_mock()
+        self.assertEquals(
+            ["COPY \"s\".\"t\" FROM PROGRAM 'tail -n +3 /project/data.txt' WITH "
+             "(FORMAT text, DELIMITER '|')"],
+            self._copy('data.txt', escape=True, ignore_header=2))
+        self.database_accessor.execute.reset_mock()
+        self.assertIn(
+            "PROGRAM 'bzip2 -dc /project/data.txt.bz2 | tail -n +3'",
+            self._copy('data.txt.bz2', ignore_header=2)[0])
+
+    def test_date_format(self):
+        """
+        The DateStyle is set for the COPY and restored after it.
+        """
+        statements = self._copy('data.txt', date_format='DD/MM/YYYY')
+        self.assertEquals(
+            ["SELECT current_setting('datestyle') AS datestyle",
+             "SELECT set_config('datestyle', 'ISO, DMY', false)",
+             "COPY \"s\".\"t\" FROM '/project/data.txt' WITH "
+             "(FORMAT csv, QUOTE E'\\x01', DELIMITER '|', NULL '\\N')",
+             "SELECT set_config('datestyle', 'ISO, MDY', false)"],
+            statements)
+        self.database_accessor.execute.reset_mock()
+        self.assertEquals(1, len(self._copy('data.txt', date_format='auto')))
+
+    def test_bad_options(self):
+        for kwargs in ({'date_format': 'YYYY-DD'}, {'date_format': 'MM-YYYY-DD'},
+                       {'csv': True, 'escape': True}, {'ignore_header': -1}):
+            with self.assertRaises(ValueError):
+                self._copy('data.txt', **kwargs)
+        self.assertEquals([], self._statements())
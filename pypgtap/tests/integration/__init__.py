@@ -1,21 +1,119 @@
+import atexit
+import os
 import unittest
 
 import pypgtap.core.test_kit.postgres_env as pe
+from pypgtap.core.test_kit.harness_daemon import lease_db
+from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager
+from pypgtap.core.test_kit.utils import PYPGTAP_HARNESS_ENV
+
+# Set to run the tests on the harness daemon instead of a harness of their own
+PYPGTAP_USE_DAEMON_ENV = 'PYPGTAP_USE_DAEMON'
+# Set to test, class or session to pick how long a harness lives, see
+# BaseHarnessTestManager
+PYPGTAP_HARNESS_SCOPE_ENV = 'PYPGTAP_HARNESS_SCOPE'
+HARNESS_SCOPES = ('test', 'class', 'session')
+
+# Whether the harness of the session scope was started
+_session_harness = {'started': False}
+
+
+def _start_harness():
+    pe.start_postgres_harness(use_cache=True)
+
+
+def _stop_harness():
+    # The data is thrown away, so the server is aborted and its data dir
+    # removed in the background.
+    pe.stop_postgres_harness(fast=True)
 
 
 class BaseHarnessTestManager(unittest.TestCase):
     """
     If you want to start or stop a harness extend this class.
+
+    harness_scope decides how long a harness lives. It defaults to the
+    PYPGTAP_HARNESS_SCOPE environment variable, else test:
+    * test: Every test starts a harness of its own and stops it.
+    * class: The tests of a class share a harness.
+    * session: All the tests share a harness that's stopped when the process
+      exits.
+    With the class and session scopes the tests have to clean up after
+    themselves or at least not trip over what the other tests leave behind.
+
+    With the PYPGTAP_USE_DAEMON environment variable set the tests don't start
+    a harness, they use the one of the harness daemon, which is started once
+    and kept running between test runs. Each test leases a database of its
+    own, self.dbname, while the daemon's harness is the current harness. The
+    tests only run in their leased database if they get their manager from
+    get_manager() and pass its dbname to the queries they make; what they do
+    in the default database of the daemon's harness is seen by the others.
     """
-    def setUp(self):
+    use_daemon = bool(os.environ.get(PYPGTAP_USE_DAEMON_ENV))
+    harness_scope = os.environ.get(PYPGTAP_HARNESS_SCOPE_ENV) or 'test'
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Starts the harness of the class or the session scope.
         """
-        Sets up the test harness
+        if cls.use_daemon:
+            return
+        if cls.harness_scope not in HARNESS_SCOPES:
+            raise ValueError('harness_scope must be one of {}, not {}'.format(
+                ', '.join(HARNESS_SCOPES), cls.harness_scope))
+        if cls.harness_scope == 'class':
+            _start_harness()
+        elif (cls.harness_scope == 'session' and
+                not _session_harness['started']):
+            _start_harness()
+            _session_harness['started'] = True
+            atexit.register(_stop_harness)
+
+    @classmethod
+    def tearDownClass(cls):
+        if not cls.use_daemon and cls.harness_scope == 'class':
+            _stop_harness()
 
+    def setUp(self):
+        """
+        Sets up the test harness. It's started from the cluster cache so only
+        the first test pays for initializing the cluster.
         """
-        pe.start_postgres_harness()
+        self.dbname = None
+        if not self.use_daemon:
+            if self.harness_scope == 'test':
+                _start_harness()
+            return
+        self.lease = lease_db()
+        self.dbname = self.lease.dbname
+        self._harness_env = os.environ.get(PYPGTAP_HARNESS_ENV)
+        os.environ[PYPGTAP_HARNESS_ENV] = self.lease.harness.root_dir
 
     def tearDown(self):
         """
         Tear down the test harness
         """
-        pe.stop_postgres_harness()
+        if not self.use_daemon:
+            if self.harness_scope == 'test':
+                _stop_harness()
+            return
+        if self._harness_env is None:
+            del os.environ[PYPGTAP_HARNESS_ENV]
+        else:
+            os.environ[PYPGTAP_HARNESS_ENV] = self._harness_env
+        self.lease.release()
+
+    def get_manager(self, **kwargs):
+        """
+        A PyPGTAPTestManager for the test. In daemon mode it runs in the
+        leased database, which is already bootstrapped, and the daemon's
+        harness.
+
+        :param kwargs: The arguments of PyPGTAPTestManager.
+        :rtype: PyPGTAPTestManager
+        """
+        if self.use_daemon:
+            kwargs.setdefault('template_db', self.dbname)
+            kwargs.setdefault('harness', self.lease.harness)
+        return PyPGTAPTestManager(**kwargs)
@@ -10,7 +10,6 @@ $ run_all_tests -w <Path to example/">
 """
 import logging
 
-from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager
 from pypgtap.tests.integration import BaseHarnessTestManager
 from pypgtap.lib.tap import tapOutputParser
 
@@ -23,7 +22,7 @@ class PyPGTAPETLIntegrationTest(BaseHarnessTestManager):
     in the example/ project project.
     """
     def test_hello_world(self):
-        with PyPGTAPTestManager() as manager:
+        with self.get_manager() as manager:
             output = manager.execute_project_test('example_project/', 'test_hello_world.sql')
             #  Only one test output
             self.assertEquals(1, len(output))
@@ -11,7 +11,7 @@ import unittest
 import pypgtap.core.test_kit.postgres_env as pe
 from pypgtap.core.test_kit.utils import\
     ExecuteQueryHelper, PG_HARNESS_DATA_DIR
-from pypgtap.core.test_kit.pypgtap_testing import PyPGTAPTestManager, _execute_sql_script
+from pypgtap.core.test_kit.pypgtap_testing import _execute_sql_script
 from pypgtap.tests.integration import BaseHarnessTestManager
 from pypgtap.core.test_kit.pypgtap_error import PyPGTAPSubprocessError
 
@@ -72,17 +72,19 @@ class PyPGTAPTestManagerIntegration(BaseHarnessTestManager):
         """
         If the base scripts were executed by the RsTAOtestManager._init_pgtap().
         """
-        with PyPGTAPTestManager() as manager:
+        with self.get_manager() as manager:
             self.assertEquals(
                 manager._is_initialized, True,
                 msg='The test manager was not initialized properly')
             self.assertTrue(self._internal_base_script_verify(
-                under_test_function='set_project_path'),
+                under_test_function='set_project_path',
+                dbname=manager.dbname),
                 msg='get_project_path function not found. Perhaps you '
                     ' intended to change or remove this in which case you'
                     ' should fix this test')
             self.assertTrue(self._internal_base_script_verify(
-                under_test_function='get_project_path'),
+                under_test_function='get_project_path',
+                dbname=manager.dbname),
                 msg='get_project_path function not found. Perhaps you '
                     ' intended to change or remove this in which case you'
                     ' should fix this test')
@@ -93,9 +95,10 @@ class PyPGTAPTestManagerIntegration(BaseHarnessTestManager):
         directory and test if its set properly.
         """
         mock_project_path = tempfile.mkdtemp()
-        with PyPGTAPTestManager() as manager:
-            manager._set_project_dir(mock_project_path)
-            results = manager.get_project_dir()
+        with self.get_manager() as manager:
+            manager._set_project_dir(
+                mock_project_path, dbname=manager.dbname)
+            results = manager.get_project_dir(dbname=manager.dbname)
             self.assertEquals(
                 len(results), 1,
                 msg='The project dir was not set properly!')
@@ -109,12 +112,23 @@ class PyPGTAPTestManagerIntegration(BaseHarnessTestManager):
         Tries setting the project directory to a path that does not exist and
         fails expectedly on it.
         """
-        with PyPGTAPTestManager() as manager:
+        with self.get_manager() as manager:
             # Note that because it comes through the ExecuteQueryHelper
             # the exception asserted for is not the same thats thrown by
             # the method itself(IOError).
             with self.assertRaises(IOError):
-                manager._set_project_dir('path_that_does_not_exist')
+                manager._set_project_dir(
+                    'path_that_does_not_exist', dbname=manager.dbname)
+
+    def test_in_process_execution(self):
+        """
+        The in process executor must produce the same TAP output as psql.
+        """
+        with self.get_manager() as manager:
+            psql_output = manager.execute_project_test('example_project')
+        with self.get_manager(in_process=True) as manager:
+            in_process_output = manager.execute_project_test('example_project')
+        self.assertEquals(psql_output, in_process_output)
 
     def test_failing_command(self):
         with self.assertRaises(PyPGTAPSubprocessError) as error_info:
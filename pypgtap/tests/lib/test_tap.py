@@ -0,0 +1,169 @@
+"""
+Unit tests for the line oriented TAP parser in pypgtap.lib.tap. Its results
+are checked against the ones of the pyparsing grammar it replaces.
+"""
+import unittest
+
+from pypgtap.lib import tap as under_test
+from pypgtap.lib import tap_grammar
+
+
+def _results(summary):
+    nums = lambda tests: [(t.num, t.passed, t.skipped, t.todo) for t in tests]
+    return (nums(summary.passedTests), nums(summary.failedTests),
+            nums(summary.skippedTests), nums(summary.todoTests),
+            nums(summary.bonusTests), summary.bail, summary.passedSuite,
+            getattr(summary, 'bailReason', None), summary.summary(showAll=True))
+
+
+class _Results(object):
+
+    """Stands in for the pyparsing results of tap_grammar"""
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class TAPParserTest(unittest.TestCase):
+
+    """Tests under_test.tapOutputParser"""
+
+    outputs = [
+        """\
+        1..4
+        ok 1 - Input file opened
+        not ok 2 - First line of the input valid
+        ok 3 - Read the rest of the file
+        not ok 4 - Summarized correctly # TODO Not written yet
+        """,
+        """\
+        ok 1
+        not ok 2 some description # todo with a directive
+        ok 3 a description only, no directive
+        ok 4 # TODO directive only
+        ok a description only, no directive
+        ok # Skipped only a directive, no description
+        ok
+        """,
+        """\
+        ok - created Board
+        ok
+        not ok
+        # +------+------+
+        # |      |16G   |
+        ok - board has 4 tiles + starter tile
+        1..4
+        """,
+        """\
+        1..20
+        ok - database handle
+        not ok - failed database login
+        Bail out! Couldn't connect to database.
+        """,
+        """\
+        ok 1 - retrieving servers from the database
+        # need to ping 6 servers
+        ok 2 - pinged diamond
+        not ok 3 - pinged sapphire
+        #   Failed test 3: "pinged sapphire"
+        ok 4 - pinged gold
+        1..4
+        # Looks like you failed 1 test of 4
+        """,
+    ]
+
+    def test_same_results_as_grammar(self):
+        for output in self.outputs:
+            self.assertEquals(
+                _results(tap_grammar.tapOutputParser.parseString(output)[0]),
+                _results(under_test.tapOutputParser.parseString(output)[0]),
+                msg=output)
+
+    def test_escaped_hash_and_unknown_lines(self):
+        """
+        An escaped '#' is part of the description and lines that are not TAP
+        don't stop the parser.
+        """
+        summary = under_test.tapOutputParser.parseString(
+            'ok 1 - issue \\# 42 # SKIP no network\n'
+            'Some stray NOTICE\n'
+            'not ok 2 - the \\#1 test\n'
+            '1..2\n')[0]
+        self.assertEquals([1], [t.num for t in summary.skippedTests])
+        self.assertEquals([2], [t.num for t in summary.failedTests])
+        self.assertFalse(summary.passedSuite)
+
+    def test_no_tests(self):
+        with self.assertRaises(under_test.TAPParseError):
+            under_test.tapOutputParser.parseString('# nothing to see here\n')
+
+
+class TAPAggregateTest(unittest.TestCase):
+
+    """Tests under_test.TAPAggregate"""
+
+    def test_counts_agree_with_summaries(self):
+        """
+        The interleaved outputs of several sources give the same counts as
+        a TAPSummary of each.
+        """
+        outputs = [o.splitlines() for o in TAPParserTest.outputs]
+        aggregate = under_test.TAPAggregate()
+        for i in xrange(max(len(o) for o in outputs)):
+            for source, lines in enumerate(outputs):
+                if i < len(lines):
+                    aggregate.addLine(lines[i], source=source)
+        aggregate.closeAll()
+        summaries = [under_test.TAPParser().parseLines(o) for o in outputs]
+        self.assertEquals(
+            sum(len(s.passedTests) for s in summaries), aggregate.passed)
+        self.assertEquals(
+            sum(len(s.failedTests) for s in summaries), aggregate.failed)
+        self.assertEquals(
+            sum(len(s.skippedTests) for s in summaries), aggregate.skipped)
+        self.assertEquals(
+            sum(len(s.todoTests) for s in summaries), aggregate.todo)
+        self.assertEquals(
+            sum(len(s.bonusTests) for s in summaries), aggregate.bonus)
+        self.assertEquals(
+            [(source, t.num) for source, s in enumerate(summaries)
+             for t in s.failedTests],
+            sorted((source, t.num) for source, t in aggregate.failedTests))
+        self.assertEquals([(3, "Couldn't connect to database.")], aggregate.bails)
+        self.assertFalse(aggregate.passedSuite)
+
+    def test_merge_keeps_only_interesting_tests(self):
+        first = under_test.TAPAggregate()
+        first.addLines(['1..3', 'ok 1', 'ok 2', 'not ok 3 # TODO later'], 'a')
+        second = under_test.TAPAggregate()
+        for line in ['ok 1', 'ok 2 # SKIP no network']:
+            second.addLine(line, 'b')
+        first.merge(second)
+        self.assertEquals(5, first.total)
+        self.assertEquals([('a', 3)], [(s, t.num) for s, t in first.todoTests])
+        self.assertEquals([('b', 2)], [(s, t.num) for s, t in first.skippedTests])
+        self.assertTrue(first.passedSuite)
+        self.assertIn('TESTS: 5 PASSED: 4 FAILED: 1', first.summary())
+
+    def test_compact_tests(self):
+        with self.assertRaises(AttributeError):
+            under_test.TAPTest.fromLine(1).description = 'no room for it'
+
+    def test_results_constructors(self):
+        """The constructors still take pyparsing results, as they used to"""
+        line = lambda passed, num, directive=(), BAIL='', reason='': \
+            _Results(passed=passed, testNumber=num, directive=directive,
+                     BAIL=BAIL, reason=reason)
+        tests = [line('ok', '1'), line('not ok', '2'),
+                 line('not ok', '3', [('TODO', 'later')]),
+                 line('', '', BAIL='Bail out!', reason='no db')]
+        summary = under_test.TAPSummary(
+            _Results(tests=tests, plan=_Results(ubound='5')))
+        self.assertEquals(
+            _results(under_test.tapOutputParser.parseString(
+                "1..5\nok 1\nnot ok 2\nnot ok 3 # TODO later\n"
+                "Bail out! no db\n")[0]),
+            _results(summary))
+        test = under_test.TAPTest(tests[2])
+        self.assertEquals(('3', False, False, True),
+                          (test.num, test.passed, test.skipped, test.todo))
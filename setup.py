@@ -9,11 +9,15 @@ setup(
     entry_points = {
         'console_scripts':[
             'start_harness = \
-                pypgtap.core.test_kit.postgres_env:start_postgres_harness',
+                pypgtap.test_kit_scripts.start_harness:main',
             'stop_harness = \
                 pypgtap.core.test_kit.postgres_env:stop_postgres_harness',
             'run_all_tests = \
-                pypgtap.test_kit_scripts.run_all_tests:main'
+                pypgtap.test_kit_scripts.run_all_tests:main',
+            'load_json = \
+                pypgtap.test_kit_scripts.load_json:main',
+            'harness_daemon = \
+                pypgtap.test_kit_scripts.harness_daemon:main'
         ]
     },
     package_data = {